@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# Measures what watching the GPIO button costs while nobody touches it: the
+# old _poll_GPIO, which read the pin on the Kivy clock every 0.05 s, against
+# GPIOButtons on pigpio edge callbacks. The real pigpio client talks to a
+# fake pigpiod in a child process, so the daemon's side is measured apart,
+# and the Kivy clock runs headless at the app's frame rate. After the idle
+# period one press checks that the button still works, and how fast.
+#
+# Run from the Monitor directory:
+#   python3 -m benchmarks.bench_gpio_buttons --seconds 60
+
+import argparse
+import multiprocessing
+import os
+import resource
+import time
+
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+os.environ.setdefault('KIVY_NO_CONSOLELOG', '1')
+
+import pigpio
+from kivy.clock import Clock
+
+from benchmarks.fake_pigpio import FakePigpioDaemon
+from monitor.gpio_buttons import GPIOButtons
+
+GPIO = 17
+POLL_INTERVAL = 0.05
+
+
+def usage():
+    # (CPU seconds, context switches) of this process, all threads
+    rusage = resource.getrusage(resource.RUSAGE_SELF)
+    return rusage.ru_utime + rusage.ru_stime, rusage.ru_nvcsw + rusage.ru_nivcsw
+
+
+def run_daemon(conn):
+    daemon = FakePigpioDaemon()
+    daemon.start()
+    conn.send(daemon.port)
+    while True:
+        command, *args = conn.recv()
+        if command == 'level':
+            daemon.set_level(*args)
+        elif command == 'stats':
+            conn.send((daemon.requests,) + usage())
+        else:
+            return
+
+
+class PollingButton(object):
+    # the old behaviour: read the pin on the Kivy clock every 0.05 s
+
+    def __init__(self, pi, gpio, on_change):
+        self.pi = pi
+        self.gpio = gpio
+        self.on_change = on_change
+        self.callbacks = 0
+        pi.set_mode(gpio, pigpio.INPUT)
+        pi.set_pull_up_down(gpio, pigpio.PUD_UP)
+        self._event = Clock.schedule_interval(self._poll_GPIO, POLL_INTERVAL)
+
+    def _poll_GPIO(self, dt):
+        self.callbacks += 1
+        self.on_change(not self.pi.read(self.gpio))
+
+    def cancel(self):
+        self._event.cancel()
+
+
+class EdgeButton(GPIOButtons):
+    # GPIOButtons, counting the clock callbacks it schedules
+
+    def __init__(self, pi, gpio, on_change):
+        super().__init__(pi)
+        self.callbacks = 0
+        self.add_button(gpio, on_change)
+
+    def _settle(self, button, dt):
+        self.callbacks += 1
+        super()._settle(button, dt)
+
+
+def tick_for(seconds):
+    deadline = time.monotonic() + seconds
+    ticks = 0
+    while time.monotonic() < deadline:
+        Clock.tick()
+        ticks += 1
+    return ticks
+
+
+def run(button_class, args):
+    conn, child_conn = multiprocessing.Pipe()
+    daemon = multiprocessing.Process(target=run_daemon, args=(child_conn,))
+    daemon.start()
+    pi = pigpio.pi('127.0.0.1', conn.recv())
+
+    presses = []
+    button = button_class(pi, GPIO, lambda pressed: presses.append(
+        (pressed, time.monotonic())) if pressed else None)
+    # let setup settle before measuring
+    tick_for(0.5)
+
+    conn.send(('stats',))
+    requests, daemon_cpu, daemon_switches = conn.recv()
+    callbacks = button.callbacks
+    cpu, switches = usage()
+    ticks = tick_for(args.seconds)
+    cpu, switches = [after - before for after, before in zip(usage(), (cpu, switches))]
+    callbacks = button.callbacks - callbacks
+    conn.send(('stats',))
+    requests, daemon_cpu, daemon_switches = [
+        after - before for after, before in
+        zip(conn.recv(), (requests, daemon_cpu, daemon_switches))]
+
+    # press the button and wait for the app to see it
+    del presses[:]
+    pressed_at = time.monotonic()
+    conn.send(('level', GPIO, 0))
+    while not presses and time.monotonic() - pressed_at < 1:
+        Clock.tick()
+    latency = (presses[0][1] - pressed_at) * 1000 if presses else float('nan')
+    conn.send(('level', GPIO, 1))
+    tick_for(0.2)
+
+    button.cancel()
+    pi.stop()
+    conn.send(('stop',))
+    daemon.join()
+
+    per_minute = 60 / args.seconds
+    return { 'ticks': ticks * per_minute,
+             'callbacks': callbacks * per_minute,
+             'requests': requests * per_minute,
+             'switches': switches * per_minute,
+             'cpu': cpu * 3600 / args.seconds,
+             'daemon_switches': daemon_switches * per_minute,
+             'daemon_cpu': daemon_cpu * 3600 / args.seconds,
+             'latency': latency }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the idle cost of the GPIO button, polled against edge callbacks')
+    parser.add_argument('--seconds', type=float, default=60,
+                        help='idle time to measure each implementation for')
+    args = parser.parse_args()
+
+    print(f"{'button':>8} {'frames/min':>11} {'callbacks/min':>14} {'pigpio req/min':>15} "
+          f"{'ctx sw/min':>11} {'cpu s/hour':>11} {'daemon ctx sw/min':>18} "
+          f"{'daemon cpu s/hour':>18} {'press ms':>9}")
+    for name, button_class in [('polled', PollingButton), ('edge', EdgeButton)]:
+        result = run(button_class, args)
+        print(f"{name:>8} {result['ticks']:>11.0f} {result['callbacks']:>14.1f} "
+              f"{result['requests']:>15.1f} {result['switches']:>11.1f} "
+              f"{result['cpu']:>11.2f} {result['daemon_switches']:>18.1f} "
+              f"{result['daemon_cpu']:>18.2f} {result['latency']:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# Feeds a stream of noisy lamp/set_config messages through LampService on a
+# fake pigpio backend and compares PWM writes against writing every message.
+#
+# Run from the Monitor directory:
+#   python3 -m benchmarks.bench_lamp_service --messages 1000
+
+import argparse
+import contextlib
+import io
+import json
+import random
+import time
+from types import SimpleNamespace
+
+import lamp_service
+from monitor.lamp_driver import LampDriver, FakePi
+
+
+def lamp_message(hue, brightness):
+    config = { 'client': 'monitor_service',
+               'color': { 'h': hue, 's': 1.0 },
+               'brightness': brightness,
+               'on': True }
+    return SimpleNamespace(topic=lamp_service.TOPIC_LAMP_CONFIG,
+                           payload=json.dumps(config).encode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark LampService against a fake pigpio backend')
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--interval', type=float, default=0.01,
+                        help='seconds between messages')
+    parser.add_argument('--step-chance', type=float, default=0.02,
+                        help='chance that a message is a real color change')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    pi = FakePi()
+    lamp = lamp_service.LampService(LampDriver(pi))
+    lamp._fade_thread.start()
+    initial_writes = pi.writes
+
+    hue, brightness = 0.2, 0.5
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(args.messages):
+            if random.random() < args.step_chance:
+                hue, brightness = random.uniform(0, 0.4), random.uniform(0.5, 0.83)
+            # readings jitter a little even when the load is steady
+            lamp.on_message_set_config(None, None,
+                                       lamp_message(hue + random.gauss(0, 0.002),
+                                                    brightness + random.gauss(0, 0.002)))
+            time.sleep(args.interval)
+    time.sleep(lamp_service.LAMP_FADE_SECS * 2)
+    elapsed = time.perf_counter() - start
+
+    print(f"messages:            {lamp.messages}")
+    print(f"skipped (no change): {lamp.skipped}")
+    print(f"fade steps rendered: {lamp.fade_steps}")
+    print(f"PWM writes:          {pi.writes - initial_writes}")
+    print(f"PWM writes if every message were written: {lamp.messages * 3}")
+    print(f"elapsed:             {elapsed:.2f} s")
+
+
+if __name__ == '__main__':
+    main()
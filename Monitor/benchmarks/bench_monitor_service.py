@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# Benchmarks MonitorService against a farm of emulated plugs.
+#
+# Run from the Monitor directory:
+#   python3 -m benchmarks.bench_monitor_service --outlets 1,10,50,100,200
+#
+# Publishes go to an in-memory client unless --broker host[:port] is given.
+#
+# --idle SECS instead runs the whole service for SECS against plugs whose
+# load holds steady, once polling at a fixed 3 s cadence (as before the
+# adaptive scheduler) and once with the adaptive scheduler, and reports
+# event loop wakeups, device requests and CPU time:
+#   python3 -m benchmarks.bench_monitor_service --idle 600 --outlets 10
+
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import random
+import selectors
+import statistics
+import tempfile
+import time
+from unittest import mock
+
+import kasa
+import monitor_service
+from benchmarks.fake_kasa import FakeDeviceFarm, InMemoryMQTTClient
+from monitor.poll_scheduler import PollScheduler
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+# the service's on-disk state (every *_FILENAME setting under ~/.monitor)
+STATE_FILENAMES = { name: os.path.basename(value)
+                    for name, value in vars(monitor_service).items()
+                    if name.endswith('_FILENAME') and isinstance(value, str) and
+                    os.path.dirname(value) == os.path.expanduser('~/.monitor') }
+
+
+def build_service(state_dir, broker):
+    # keep the service's on-disk state out of the real home directory
+    for name, basename in STATE_FILENAMES.items():
+        setattr(monitor_service, name, os.path.join(state_dir, basename))
+
+    service = monitor_service.MonitorService()
+    if broker is None:
+        service._client = InMemoryMQTTClient()
+    else:
+        host, _, port = broker.partition(':')
+        service._client.connect(host, port=int(port or 1883))
+        service._client.loop_start()
+    return service
+
+
+async def bench(count, args):
+    farm = FakeDeviceFarm(count, latency=args.latency, jitter=args.jitter,
+                          failure_rate=args.failure_rate,
+                          hang_rate=args.hang_rate,
+                          discovery_time=args.discovery_time)
+
+    with tempfile.TemporaryDirectory() as state_dir, \
+            mock.patch.object(kasa.Discover, 'discover', farm.discover), \
+            mock.patch.object(kasa.Discover, 'discover_single', farm.discover_single), \
+            contextlib.redirect_stdout(io.StringIO()):
+        service = build_service(state_dir, args.broker)
+        service._loop = asyncio.get_running_loop()
+        service._spool_wakeup = asyncio.Event()
+
+        start = time.perf_counter()
+        await service.check_for_outlets()
+        discovery = time.perf_counter() - start
+
+        messages = service._client.messages if args.broker is None else 0
+        cycle_times = []
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        for _ in range(args.cycles):
+            start = time.perf_counter()
+            await service.run_cycle()
+            cycle_times.append(time.perf_counter() - start)
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+
+        if args.broker is None:
+            messages = service._client.messages - messages
+        else:
+            service._client.loop_stop()
+            service._client.disconnect()
+
+    return { 'outlets': count,
+             'discovery_s': discovery,
+             'p50_ms': statistics.median(cycle_times) * 1000,
+             'p99_ms': percentile(cycle_times, 99) * 1000,
+             'cpu_ms': cpu / args.cycles * 1000,
+             'publish_per_s': messages / wall if args.broker is None else float('nan'),
+             'stale': sum(1 for s in service.outlet_statuses.values() if s.get('stale')) }
+
+
+class CountingSelector(selectors.DefaultSelector):
+    # counts the times the event loop went to sleep and woke up again;
+    # select(0) is the loop checking for I/O between ready callbacks
+
+    def __init__(self):
+        super().__init__()
+        self.wakeups = 0
+
+    def select(self, timeout=None):
+        if timeout is None or timeout > 0:
+            self.wakeups += 1
+        return super().select(timeout)
+
+
+async def idle(count, seconds, fixed, selector, args):
+    farm = FakeDeviceFarm(count, latency=args.latency, jitter=args.jitter,
+                          discovery_time=args.discovery_time, step_rate=0)
+
+    with tempfile.TemporaryDirectory() as state_dir, \
+            mock.patch.object(kasa.Discover, 'discover', farm.discover), \
+            mock.patch.object(kasa.Discover, 'discover_single', farm.discover_single), \
+            contextlib.redirect_stdout(io.StringIO()):
+        service = build_service(state_dir, None)
+        if fixed:
+            service.scheduler = PollScheduler(monitor_service.POLL_INTERVAL_MIN_SECS,
+                                              monitor_service.POLL_INTERVAL_MIN_SECS,
+                                              monitor_service.POLL_CHANGE_THRESHOLD_WATTS)
+        # discover up front, as the saved inventory would at startup
+        await service.check_for_outlets()
+
+        wakeups = selector.wakeups
+        requests = farm.requests
+        cpu_start = time.process_time()
+        try:
+            await asyncio.wait_for(service.serve(), seconds)
+        except asyncio.TimeoutError:
+            pass
+        cpu = time.process_time() - cpu_start
+        for task in (service._discovery_task, service._command_task,
+                     service._metrics_task, service._spool_task):
+            task.cancel()
+
+    minutes = seconds / 60
+    return { 'schedule': 'fixed 3 s' if fixed else 'adaptive',
+             'wakeups_per_min': (selector.wakeups - wakeups) / minutes,
+             'requests_per_min': (farm.requests - requests) / minutes,
+             'cpu_s_per_hour': cpu * 3600 / seconds }
+
+
+def run_idle(args):
+    print(f"{'outlets':>8} {'schedule':>10} {'wakeups/min':>12} "
+          f"{'requests/min':>13} {'cpu s/hour':>11}")
+    for count in [int(c) for c in args.outlets.split(',')]:
+        for fixed in (True, False):
+            random.seed(args.seed)
+            selector = CountingSelector()
+            loop = asyncio.SelectorEventLoop(selector)
+            try:
+                result = loop.run_until_complete(
+                    idle(count, args.idle, fixed, selector, args))
+            finally:
+                loop.close()
+            print(f"{count:>8} {result['schedule']:>10} "
+                  f"{result['wakeups_per_min']:>12.1f} "
+                  f"{result['requests_per_min']:>13.1f} "
+                  f"{result['cpu_s_per_hour']:>11.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark MonitorService against emulated plugs')
+    parser.add_argument('--outlets', default='1,10,50,100,200',
+                        help='comma separated outlet counts to benchmark')
+    parser.add_argument('--cycles', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='mean device response time in seconds')
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--failure-rate', type=float, default=0.01)
+    parser.add_argument('--hang-rate', type=float, default=0.0,
+                        help='fraction of requests that never get a response')
+    parser.add_argument('--discovery-time', type=float, default=0.5)
+    parser.add_argument('--broker', default=None,
+                        help='publish to a real MQTT broker at host[:port]')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--idle', type=float, default=None, metavar='SECS',
+                        help='measure wakeups and CPU of an idle service instead')
+    args = parser.parse_args()
+
+    if args.idle is not None:
+        run_idle(args)
+        return
+
+    random.seed(args.seed)
+    print(f"{'outlets':>8} {'discovery s':>12} {'cycle p50 ms':>13} "
+          f"{'cycle p99 ms':>13} {'cpu/cycle ms':>13} {'publish/s':>10} {'stale':>6}")
+    for count in [int(c) for c in args.outlets.split(',')]:
+        result = asyncio.run(bench(count, args))
+        print(f"{result['outlets']:>8} {result['discovery_s']:>12.3f} "
+              f"{result['p50_ms']:>13.1f} {result['p99_ms']:>13.1f} "
+              f"{result['cpu_ms']:>13.2f} {result['publish_per_s']:>10.1f} "
+              f"{result['stale']:>6}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# Measures frame time and GC activity of OutletGrid on a headless Kivy
+# window, against the previous clear-and-rebuild implementation.
+#
+# Run from the Monitor directory:
+#   python3 -m benchmarks.bench_outlet_grid --outlets 8 --frames 300
+
+import argparse
+import gc
+import os
+import random
+import statistics
+import time
+
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+os.environ.setdefault('KIVY_NO_CONSOLELOG', '1')
+os.environ.setdefault('SDL_VIDEODRIVER', 'offscreen')
+os.environ.setdefault('KIVY_GL_BACKEND', 'mock')
+
+from kivy.config import Config
+# don't let the clock sleep to hold 60 fps; we want the work per frame
+Config.set('graphics', 'maxfps', '0')
+
+from kivy.base import EventLoop
+from kivy.core.window import Window
+from kivy.uix.button import Button
+
+from monitor.components.outlet_grid import OutletGrid
+
+
+class RebuildingOutletGrid(OutletGrid):
+    # the old behaviour: throw every button away on each update
+
+    def update_buttons(self, *args, **kwargs):
+        self.clear_widgets()
+        for outlet in self.outlets:
+            self.add_widget(Button(text=self._get_text(outlet),
+                                   on_press=self.callback,
+                                   halign='center',
+                                   background_normal='',
+                                   color=(0, 0, 0, 1)))
+
+
+def outlet_states(count, frames):
+    outlets = { f'outlet{i}': { 'enabled': True, 'wattage': random.uniform(0, 150) }
+                for i in range(count) }
+    for _ in range(frames):
+        # like a monitor/usage message: a couple of outlets moved
+        outlets = { alias: dict(status) for alias, status in outlets.items() }
+        for alias in random.sample(sorted(outlets), min(2, count)):
+            outlets[alias]['wattage'] = round(random.uniform(0, 150), 1)
+        yield outlets
+
+
+def run(grid_class, args):
+    random.seed(args.seed)
+    grid = grid_class(cols=2)
+    grid.callback = lambda instance: None
+    Window.add_widget(grid)
+
+    frame_times = []
+    gc.collect()
+    collections = sum(stat['collections'] for stat in gc.get_stats())
+    for outlets in outlet_states(args.outlets, args.frames):
+        start = time.perf_counter()
+        grid.outlets = outlets
+        EventLoop.idle()
+        frame_times.append(time.perf_counter() - start)
+    collections = sum(stat['collections'] for stat in gc.get_stats()) - collections
+
+    Window.remove_widget(grid)
+    frame_times.sort()
+    return { 'mean_ms': statistics.mean(frame_times) * 1000,
+             'p99_ms': frame_times[int(len(frame_times) * 0.99) - 1] * 1000,
+             'gc': collections }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark OutletGrid updates on a headless window')
+    parser.add_argument('--outlets', type=int, default=8)
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    EventLoop.ensure_window()
+    print(f"{'grid':>12} {'mean frame ms':>14} {'p99 frame ms':>13} {'gc runs':>8}")
+    for name, grid_class in [('rebuild', RebuildingOutletGrid),
+                             ('incremental', OutletGrid)]:
+        result = run(grid_class, args)
+        print(f"{name:>12} {result['mean_ms']:>14.3f} {result['p99_ms']:>13.3f} "
+              f"{result['gc']:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import asyncio
+import random
+import kasa
+
+
+class FakeProtocol(object):
+
+    async def close(self):
+        pass
+
+
+class FakeEmeterPlug(object):
+    # Stands in for a kasa emeter plug: same attributes and coroutines the
+    # monitor service uses, with latency and failures drawn from its farm.
+
+    def __init__(self, farm, host, alias):
+        self.farm = farm
+        self.host = host
+        self.alias = alias
+        self.protocol = FakeProtocol()
+        self.is_on = True
+        self._power = random.uniform(1, 150)
+        self._total = random.uniform(0, 100)  # kWh
+        self.emeter_realtime = kasa.EmeterStatus({ 'power': 0, 'total': self._total })
+
+    async def update(self):
+        await self.farm.respond()
+        if self.is_on:
+            # wander around the base load, with the odd big step
+            if random.random() < self.farm.step_rate:
+                self._power = random.uniform(1, 150)
+            power = max(0.0, self._power + random.gauss(0, 0.3))
+        else:
+            power = 0.0
+        self._total += power * self.farm.poll_hours / 1000
+        self.emeter_realtime = kasa.EmeterStatus({ 'power': power, 'total': self._total })
+
+    async def turn_on(self):
+        await self.farm.respond()
+        self.is_on = True
+
+    async def turn_off(self):
+        await self.farm.respond()
+        self.is_on = False
+
+
+class FakeDeviceFarm(object):
+    # A fleet of emulated plugs with configurable response latency, jitter,
+    # error rate and hang rate (requests that never answer, to exercise the
+    # poll timeouts). step_rate is the chance per update that a plug's load
+    # jumps to a new level; with 0 the load only wanders by a fraction of a
+    # watt. discover() and discover_single() mimic kasa.Discover.
+
+    def __init__(self, count, latency=0.05, jitter=0.05, failure_rate=0.0,
+                 hang_rate=0.0, discovery_time=0.5, poll_hours=3 / 3600,
+                 step_rate=0.02):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.hang_rate = hang_rate
+        self.discovery_time = discovery_time
+        self.poll_hours = poll_hours
+        self.step_rate = step_rate
+        self.requests = 0
+        self.devices = {}
+        for i in range(count):
+            host = f'10.0.{i // 250}.{i % 250 + 1}'
+            self.devices[host] = FakeEmeterPlug(self, host, f'outlet{i}')
+
+    async def respond(self):
+        self.requests += 1
+        if random.random() < self.hang_rate:
+            await asyncio.sleep(3600)
+        await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        if random.random() < self.failure_rate:
+            raise kasa.SmartDeviceException("Simulated communication error")
+
+    async def discover(self, on_discovered=None, **kwargs):
+        await asyncio.sleep(self.discovery_time)
+        for device in self.devices.values():
+            if on_discovered is not None:
+                await on_discovered(device)
+        return dict(self.devices)
+
+    async def discover_single(self, host, **kwargs):
+        await self.respond()
+        if host not in self.devices:
+            raise kasa.SmartDeviceException(f"No device at {host}")
+        return self.devices[host]
+
+
+class InMemoryMQTTClient(object):
+    # Records publishes instead of sending them, for running without a broker.
+
+    class MessageInfo(object):
+        rc = 0
+
+        def is_published(self):
+            return True
+
+        def wait_for_publish(self, timeout=None):
+            pass
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.topics = {}
+
+    def connect(self, *args, **kwargs):
+        pass
+
+    def loop_start(self):
+        pass
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        size = len(payload) if payload is not None else 0
+        self.messages += 1
+        self.bytes += size
+        self.topics[topic] = self.topics.get(topic, 0) + 1
+        return self.MessageInfo()
@@ -0,0 +1,93 @@
+import socket
+import socketserver
+import struct
+import threading
+
+# the pigpio socket commands the monitor's GPIO code sends
+PI_CMD_READ = 3
+PI_CMD_BR1 = 10
+PI_CMD_NB = 19
+PI_CMD_NC = 21
+PI_CMD_NOIB = 99
+
+COMMAND = struct.Struct('IIII')
+REPORT = struct.Struct('HHII')
+
+
+class FakePigpioDaemon(socketserver.ThreadingTCPServer):
+    # Answers the pigpio socket protocol the way pigpiod does, for running the
+    # real pigpio client off the Pi. All GPIOs idle high (a pulled-up button
+    # that isn't pressed); set_level() changes one and sends notifications to
+    # the clients watching it. Counts the commands it answers, each of which
+    # is a round trip that wakes the daemon on a real Pi.
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        super().__init__(address, _Connection)
+        self.levels = 0xffffffff
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._handles = []   # notification sockets, by handle
+        self._watched = {}   # notification socket -> bits of the GPIOs it watches
+        self._seq = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        # a long poll interval, so the server's own wakeups don't count as
+        # the button's; nothing calls shutdown()
+        thread = threading.Thread(target=self.serve_forever, args=(3600,),
+                                  name='fake-pigpiod', daemon=True)
+        thread.start()
+
+    def set_level(self, gpio, level):
+        with self._lock:
+            if level:
+                self.levels |= 1 << gpio
+            else:
+                self.levels &= ~(1 << gpio)
+            self._seq += 1
+            report = REPORT.pack(self._seq & 0xffff, 0, 0, self.levels)
+            for sock, bits in self._watched.items():
+                if bits & (1 << gpio):
+                    sock.sendall(report)
+
+    def command(self, sock, cmd, p1, p2):
+        with self._lock:
+            self.requests += 1
+            if cmd == PI_CMD_READ:
+                return (self.levels >> p1) & 1
+            if cmd == PI_CMD_BR1:
+                return self.levels
+            if cmd == PI_CMD_NOIB:
+                # from here on this socket carries notification reports
+                self._handles.append(sock)
+                self._watched[sock] = 0
+                return len(self._handles) - 1
+            if cmd == PI_CMD_NB:
+                self._watched[self._handles[p1]] = p2
+            if cmd == PI_CMD_NC:
+                self._watched.pop(sock, None)
+            # modes, pulls and glitch filters just succeed
+            return 0
+
+
+class _Connection(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            try:
+                data = sock.recv(COMMAND.size, socket.MSG_WAITALL)
+            except OSError:
+                return
+            if len(data) < COMMAND.size:
+                return
+            cmd, p1, p2, _ = COMMAND.unpack(data)
+            result = self.server.command(sock, cmd, p1, p2)
+            sock.sendall(COMMAND.pack(cmd, p1, p2, result & 0xffffffff))
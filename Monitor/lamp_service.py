@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import threading
+import paho.mqtt.client as mqtt
+
+from variables import *
+from monitor.lamp_driver import LampDriver, FakePi
+
+MQTT_CLIENT_ID = "lamp_service"
+
+OFF = (0.0, 0.0, 0.0)
+
+
+class InvalidMessage(Exception):
+    pass
+
+
+def hue_distance(a, b):
+    # signed shortest way around the hue circle from a to b
+    return (b - a + 0.5) % 1.0 - 0.5
+
+
+class LampService(object):
+    # Drives the lamp from lamp/set_config. Targets that wouldn't visibly
+    # differ from the last accepted one are dropped (hysteresis on hue,
+    # saturation and brightness), and accepted changes are rendered as
+    # interpolated fades on a separate thread so the MQTT thread never
+    # waits on the PWM writes.
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.messages = 0
+        self.skipped = 0
+        self.fade_steps = 0
+        self._client = self._create_and_configure_broker_client()
+        self._condition = threading.Condition()
+        self._target = None
+        self._accepted = OFF
+        self._rendered = OFF
+        self._fade_thread = threading.Thread(target=self.run_fades, daemon=True)
+
+    def _create_and_configure_broker_client(self):
+        client = mqtt.Client(client_id=MQTT_CLIENT_ID, protocol=MQTT_VERSION)
+        client.will_set(client_state_topic(MQTT_CLIENT_ID), "0",
+                        qos=2, retain=True)
+        client.enable_logger()
+        client.on_connect = self.on_connect
+        client.message_callback_add(TOPIC_LAMP_CONFIG,
+                                    self.on_message_set_config)
+        return client
+
+    def on_connect(self, client, userdata, rc, unknown):
+        self._client.publish(client_state_topic(MQTT_CLIENT_ID), "1",
+                             qos=2, retain=True)
+        self._client.subscribe(TOPIC_LAMP_CONFIG, qos=1)
+
+    def on_message_set_config(self, client, userdata, msg):
+        try:
+            config = json.loads(msg.payload.decode('utf-8'))
+            if 'color' not in config or 'brightness' not in config:
+                raise InvalidMessage()
+            if config.get('on', True):
+                target = (config['color']['h'], config['color'].get('s', 1.0),
+                          config['brightness'])
+            else:
+                target = OFF
+            self.set_target(target)
+        except (InvalidMessage, ValueError, KeyError, TypeError):
+            print("Invalid lamp configuration. " + str(msg.payload))
+
+    def _is_visible_change(self, target):
+        accepted = self._accepted
+        if (target == OFF) != (accepted == OFF):
+            return True
+        if target == OFF:
+            return False
+        return (abs(hue_distance(accepted[0], target[0])) >= LAMP_HUE_HYSTERESIS or
+                abs(target[1] - accepted[1]) >= LAMP_SATURATION_HYSTERESIS or
+                abs(target[2] - accepted[2]) >= LAMP_BRIGHTNESS_HYSTERESIS)
+
+    def set_target(self, target):
+        with self._condition:
+            self.messages += 1
+            if not self._is_visible_change(target):
+                self.skipped += 1
+                return
+            self._accepted = target
+            self._target = target
+            self._condition.notify()
+
+    def _blend(self, start, end, t):
+        if start == OFF:
+            # fade in from black at the target colour rather than from red
+            start = (end[0], end[1], 0.0)
+        elif end == OFF:
+            end = (start[0], start[1], 0.0)
+        return ((start[0] + hue_distance(start[0], end[0]) * t) % 1.0,
+                start[1] + (end[1] - start[1]) * t,
+                start[2] + (end[2] - start[2]) * t)
+
+    def _render(self, state):
+        self.fade_steps += 1
+        self.driver.set_lamp_state(state[0], state[1], state[2], state[2] > 0)
+        self._rendered = state
+
+    def run_fades(self):
+        step_interval = 1.0 / LAMP_FADE_STEPS_PER_SEC
+        steps = max(1, round(LAMP_FADE_SECS * LAMP_FADE_STEPS_PER_SEC))
+        while True:
+            with self._condition:
+                while self._target is None:
+                    self._condition.wait()
+                target, self._target = self._target, None
+
+            start = self._rendered
+            for step in range(1, steps + 1):
+                self._render(self._blend(start, target, step / steps))
+                with self._condition:
+                    # a new target restarts the fade from wherever we are now
+                    if self._condition.wait_for(lambda: self._target is not None,
+                                                timeout=step_interval if step < steps else 0):
+                        break
+            else:
+                self._rendered = target
+
+    def serve(self):
+        self._fade_thread.start()
+        self._client.connect(MQTT_BROKER_HOST,
+                             port=MQTT_BROKER_PORT,
+                             keepalive=MQTT_BROKER_KEEP_ALIVE_SECS)
+        self._client.loop_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Lamp service')
+    parser.add_argument('--fake-pigpio', action='store_true',
+                        help='record PWM writes instead of driving the GPIOs')
+    args = parser.parse_args()
+
+    lamp = LampService(LampDriver(FakePi() if args.fake_pigpio else None))
+    lamp.serve()
@@ -0,0 +1,67 @@
+import json
+import math
+import os
+
+HOURS = 24
+
+
+class AverageProfile(object):
+    # The backend's average wattage for each UTC hour of the day, as published
+    # retained on monitor/average. Kept on disk so the service starts with the
+    # last profile it heard and keeps comparing against it while offline.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.hours = self._load()
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                hours = json.load(f)['hours']
+        except (OSError, ValueError, KeyError, TypeError):
+            return [0] * HOURS
+        if not self._valid(hours):
+            return [0] * HOURS
+        return hours
+
+    def _valid_wattage(self, wattage):
+        # bool is an int, and json accepts NaN and Infinity
+        return type(wattage) in (int, float) and math.isfinite(wattage)
+
+    def _valid(self, hours):
+        return (isinstance(hours, list) and len(hours) == HOURS and
+                all(self._valid_wattage(wattage) for wattage in hours))
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            json.dump({ 'hours': self.hours }, f)
+        os.replace(temp_filename, self.filename)
+
+    def update(self, message):
+        # accepts the full profile, { "hours": [...] }, or the older
+        # single-hour { "hour": h, "wattage": w }; returns False if invalid
+        if 'hours' in message:
+            if not self._valid(message['hours']):
+                return False
+            hours = list(message['hours'])
+        elif 'hour' in message and 'wattage' in message:
+            # 3.0 == 3, but can't index the list
+            if type(message['hour']) is not int or message['hour'] not in range(HOURS) or \
+                    not self._valid_wattage(message['wattage']):
+                return False
+            hours = list(self.hours)
+            hours[message['hour']] = message['wattage']
+        else:
+            return False
+
+        if hours != self.hours:
+            # replaced rather than changed in place, so readers on other
+            # threads always see a whole profile
+            self.hours = hours
+            self._save()
+        return True
+
+    def average(self, hour):
+        return self.hours[hour]
@@ -0,0 +1,82 @@
+import asyncio
+import time
+import kasa
+from collections import deque
+
+
+class OutletCommandQueue(object):
+    # Pending turn_on/turn_off commands keyed by outlet alias. Toggling the
+    # same outlet again before its command runs replaces the queued state, so
+    # only the latest request for each outlet reaches the device.
+
+    def __init__(self, timeout, on_applied=None, latency_history=100):
+        self.timeout = timeout
+        self.on_applied = on_applied
+        self.latencies = deque(maxlen=latency_history)
+        self.coalesced = 0
+        self.failed = 0
+        self._pending = {}
+        self._wakeup = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, alias, device, state):
+        # only call this from the event loop thread
+        if alias in self._pending:
+            self.coalesced += 1
+        self._pending[alias] = (device, state, time.monotonic())
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        if self._pending:
+            self._wakeup.set()
+
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # commands arriving while this batch is in flight wait for the
+            # next one, so two commands for one outlet never race
+            batch, self._pending = self._pending, {}
+            await asyncio.gather(*[self._apply(alias, *command)
+                                   for alias, command in batch.items()])
+
+    async def _apply(self, alias, device, state, queued_at):
+        try:
+            if state:
+                await asyncio.wait_for(device.turn_on(), self.timeout)
+            else:
+                await asyncio.wait_for(device.turn_off(), self.timeout)
+        except asyncio.TimeoutError as e:
+            self.failed += 1
+            print(f"Timed out turning {'on' if state else 'off'} {alias}: {e!r}")
+            # as when polling: the late reply would otherwise be read by the
+            # plug's next query
+            await device.protocol.close()
+            return
+        except kasa.SmartDeviceException as e:
+            self.failed += 1
+            print(f"Failed to turn {'on' if state else 'off'} {alias}: {e!r}")
+            return
+        except Exception as e:
+            # e.g. a socket dropped mid-write; one bad plug mustn't take down
+            # the task that applies every other command
+            self.failed += 1
+            print(f"Unexpected error turning {'on' if state else 'off'} {alias}: {e!r}")
+            return
+
+        latency = time.monotonic() - queued_at
+        self.latencies.append(latency)
+        if self.on_applied:
+            self.on_applied(alias, state, latency)
+
+    def latency_stats(self):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return { 'count': len(ordered),
+                 'mean': sum(ordered) / len(ordered),
+                 'p50': ordered[len(ordered) // 2],
+                 'max': ordered[-1] }
@@ -3,29 +3,54 @@ from kivy.uix.button import Button
 from kivy.properties import DictProperty
 from kivy.clock import Clock
 
+TEXT_COLOR = (0, 0, 0, 1)
+STALE_COLOR = (.5, .5, .5, 1)
+
 
 class OutletGrid(GridLayout):
     outlets = DictProperty({})
 
     def __init__(self, **kwargs):
         super(OutletGrid, self).__init__(**kwargs)
+        self._buttons = {}
+        self._trigger_update = Clock.create_trigger(self.update_buttons)
 
     def _get_wattage(self, outlet):
         return self.outlets[outlet]['wattage']
 
     def _get_enabled(self, outlet):
         return self.outlets[outlet]['enabled']
-    
+
+    def _get_text(self, outlet):
+        enabled_text = '(On)' if self._get_enabled(outlet) else '(Off)'
+        return f'{outlet} {enabled_text}\n{self._get_wattage(outlet)} W'
+
+    def _get_color(self, outlet):
+        return STALE_COLOR if self.outlets[outlet].get('stale') else TEXT_COLOR
+
     def on_outlets(self, instance, value):
-        Clock.schedule_once(self.update_buttons)
-        
+        self._trigger_update()
+
     def update_buttons(self, *args, **kwargs):
-        self.clear_widgets()
+        # keep one button per outlet and only touch the ones that changed;
+        # widgets are only created or removed when the set of outlets changes
+        for outlet in [o for o in self._buttons if o not in self.outlets]:
+            self.remove_widget(self._buttons.pop(outlet))
+
         for outlet in self.outlets:
-            enabled_text = '(On)' if self._get_enabled(outlet) else '(Off)'
-            new_button = Button(text=f'{outlet} {enabled_text}\n{self._get_wattage(outlet)} W', 
+            text = self._get_text(outlet)
+            color = self._get_color(outlet)
+            button = self._buttons.get(outlet)
+            if button is None:
+                button = Button(text=text,
                                 on_press=self.callback,
                                 halign='center',
                                 background_normal='',
-                                color=(0,0,0,1))
-            self.add_widget(new_button)
+                                color=color)
+                self._buttons[outlet] = button
+                self.add_widget(button)
+                continue
+            if button.text != text:
+                button.text = text
+            if tuple(button.color) != color:
+                button.color = color
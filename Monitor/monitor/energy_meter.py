@@ -0,0 +1,35 @@
+class EnergyMeter(object):
+    # Per-outlet energy from the plugs' cumulative emeter counters, so the
+    # result doesn't depend on how often we poll. update() takes the latest
+    # counter readings (Wh) and returns the energy used since the previous
+    # reading of each outlet. Outlets seen for the first time only set a
+    # baseline and are left out of the result.
+
+    def __init__(self):
+        self._counters = {}
+        self.resets = 0
+
+    def __contains__(self, alias):
+        return alias in self._counters
+
+    def update(self, readings):
+        energy = {}
+        for alias, counter in readings.items():
+            last = self._counters.get(alias)
+            self._counters[alias] = counter
+            if last is None:
+                continue
+            if counter < last:
+                # the plug's counter was reset (power loss, factory reset),
+                # so everything it has counted since happened after our last reading
+                self.resets += 1
+                energy[alias] = counter
+            else:
+                energy[alias] = counter - last
+        return energy
+
+    def retain(self, aliases):
+        # forget the baselines of outlets that have gone away
+        for alias in list(self._counters):
+            if alias not in aliases:
+                del self._counters[alias]
@@ -0,0 +1,60 @@
+from functools import partial
+from kivy.clock import Clock
+import pigpio
+
+DEBOUNCE_SECS = 0.02
+
+
+class _Button(object):
+    def __init__(self, gpio, on_change, active_level):
+        self.gpio = gpio
+        self.on_change = on_change
+        self.active_level = active_level
+        self.level = None
+        self.pressed = None
+        self.callback = None
+
+
+class GPIOButtons(object):
+    # Edge-triggered buttons on pigpio callbacks, so nothing runs while nobody
+    # touches the device. pigpio's glitch filter drops contact bounce in the
+    # daemon; what gets through is settled in software by acting on the
+    # latest level once it has held for the debounce period. on_change(pressed)
+    # is always called on the Kivy clock, since pigpio calls back on its own
+    # thread.
+
+    def __init__(self, pi, debounce=DEBOUNCE_SECS):
+        self.pi = pi
+        self.debounce = debounce
+        self._buttons = {}
+
+    def add_button(self, gpio, on_change, pull=pigpio.PUD_UP):
+        # with a pull-up the button pulls the pin low when pressed
+        active_level = 0 if pull == pigpio.PUD_UP else 1
+        button = _Button(gpio, on_change, active_level)
+        self._buttons[gpio] = button
+
+        self.pi.set_mode(gpio, pigpio.INPUT)
+        self.pi.set_pull_up_down(gpio, pull)
+        self.pi.set_glitch_filter(gpio, int(self.debounce * 1000000))
+        button.level = self.pi.read(gpio)
+        button.callback = self.pi.callback(gpio, pigpio.EITHER_EDGE, self._on_edge)
+        Clock.schedule_once(partial(self._settle, button))
+
+    def _on_edge(self, gpio, level, tick):
+        if level == pigpio.TIMEOUT:
+            return
+        button = self._buttons[gpio]
+        button.level = level
+        Clock.schedule_once(partial(self._settle, button), self.debounce)
+
+    def _settle(self, button, dt):
+        pressed = button.level == button.active_level
+        if pressed != button.pressed:
+            button.pressed = pressed
+            button.on_change(pressed)
+
+    def cancel(self):
+        for button in self._buttons.values():
+            button.callback.cancel()
+        self._buttons = {}
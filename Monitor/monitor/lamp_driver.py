@@ -1,5 +1,10 @@
 import colorsys
-import pigpio
+
+try:
+    import pigpio
+except ImportError:
+    # off the Pi the driver can still run against FakePi
+    pigpio = None
 
 PWM_FREQUENCY = 1000
 PWM_RANGE = 1000
@@ -11,13 +16,33 @@ BLUE_GPIO = 13
 RGBs = [RED_GPIO, GREEN_GPIO, BLUE_GPIO]
 
 
-class LampDriver(object):
+class FakePi(object):
+    # Records PWM writes instead of driving GPIOs, for running off-device.
+
     def __init__(self):
-        self.pi = pigpio.pi()
+        self.duty_cycles = {}
+        self.writes = 0
+
+    def set_PWM_frequency(self, gpio, frequency):
+        pass
+
+    def set_PWM_range(self, gpio, pwm_range):
+        pass
+
+    def set_PWM_dutycycle(self, gpio, dutycycle):
+        self.duty_cycles[gpio] = dutycycle
+        self.writes += 1
+
+
+class LampDriver(object):
+    def __init__(self, pi=None):
+        self.pi = pi if pi is not None else pigpio.pi()
+        self._duty_cycles = {}
         for g in RGBs:
             self.pi.set_PWM_frequency(g, PWM_FREQUENCY)
             self.pi.set_PWM_range(g, PWM_RANGE)
             self.pi.set_PWM_dutycycle(g, 0)
+            self._duty_cycles[g] = 0
 
     def set_lamp_state(self, hue, saturation, brightness, is_on):
         rgb = [0.0, 0.0, 0.0]
@@ -27,5 +52,12 @@ class LampDriver(object):
             for c in range(len(rgb)):
                 rgb[c] = rgb[c] * brightness
 
+        # only write the channels whose duty cycle actually changes
+        written = 0
         for i in range(len(RGBs)):
-            self.pi.set_PWM_dutycycle(RGBs[i], rgb[i] * PWM_RANGE)
+            duty_cycle = round(rgb[i] * PWM_RANGE)
+            if self._duty_cycles[RGBs[i]] != duty_cycle:
+                self.pi.set_PWM_dutycycle(RGBs[i], duty_cycle)
+                self._duty_cycles[RGBs[i]] = duty_cycle
+                written += 1
+        return written
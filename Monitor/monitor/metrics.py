@@ -0,0 +1,85 @@
+import bisect
+import time
+from contextlib import contextmanager
+
+# seconds; covers a fast local publish up to a device timing out
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram(object):
+    # Fixed buckets, so observing is a bisect and an increment with no
+    # allocation and memory doesn't grow with the number of observations.
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return { 'count': self.count,
+                 'sum': self.sum,
+                 'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'],
+                                     self.counts)) }
+
+
+class Metrics(object):
+    # Stage timings, counters and gauges for the monitor service, exported as
+    # JSON for the metrics topic or in the Prometheus text format.
+
+    def __init__(self, prefix='monitor_'):
+        self.prefix = prefix
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def increment(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def snapshot(self):
+        return { 'timings': { name: histogram.snapshot()
+                              for name, histogram in self.histograms.items() },
+                 'counters': dict(self.counters),
+                 'gauges': dict(self.gauges) }
+
+    def prometheus_text(self):
+        lines = []
+        for name, histogram in sorted(self.histograms.items()):
+            metric = f'{self.prefix}{name}_seconds'
+            lines.append(f'# TYPE {metric} histogram')
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram.count}')
+            lines.append(f'{metric}_sum {histogram.sum}')
+            lines.append(f'{metric}_count {histogram.count}')
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'# TYPE {self.prefix}{name}_total counter')
+            lines.append(f'{self.prefix}{name}_total {value}')
+        for name, value in sorted(self.gauges.items()):
+            lines.append(f'# TYPE {self.prefix}{name} gauge')
+            lines.append(f'{self.prefix}{name} {value}')
+        return '\n'.join(lines) + '\n'
@@ -1,16 +1,18 @@
 import platform
 from kivy.app import App
-from kivy.properties import NumericProperty, AliasProperty, BooleanProperty, StringProperty, DictProperty, ListProperty
+from kivy.properties import AliasProperty, BooleanProperty, StringProperty, DictProperty
 from kivy.clock import Clock
 from kivy.uix.popup import Popup
 from kivy.uix.label import Label
 from kivy.uix.button import Button
 import json
 import os
+import threading
 from paho.mqtt.client import Client
 import pigpio
 from variables import *
 import monitor.ip_info
+from monitor.gpio_buttons import GPIOButtons
 
 import colorsys
 import datetime
@@ -24,54 +26,46 @@ class MonitorApp(App):
     #_updated = False
     #_updatingUI = False
 
-    _outlets = DictProperty({})
-    _wattage = NumericProperty(0)
-    _difference = NumericProperty(0)
-    _diff_color = ListProperty([0.2, 1.0, 0.5])
-    
-    def _get_outlets(self):
-        return self._outlets
+    # everything a monitor/usage message shows, replaced as one snapshot per
+    # frame: each property below is recomputed once per frame however many
+    # of its inputs changed, and not at all in frames where none did
+    usage = DictProperty({ 'outlets': {},
+                           'wattage': 0,
+                           'difference': 0,
+                           'diff_color': [0.2, 1.0, 0.5] })
 
-    def _set_outlets(self, value):
-        self._outlets = value
+    def _get_outlets(self):
+        return self.usage['outlets']
 
     def _get_wattage(self):
-        return self._wattage
+        return self.usage['wattage']
 
-    def _set_wattage(self, value):
-        self._wattage = value
-    
     def _get_difference(self):
-        return self._difference
-    
-    def _set_difference(self, value):
-        self._difference = value
+        return self.usage['difference']
 
     def _get_color(self):
-        return self._diff_color
-    
-    def _set_color(self, value):
-        self._diff_color = value
-
-    def _get_color(self):
-        return self._diff_color
+        return self.usage['diff_color']
 
     def _get_difference_text(self):
-        text_color = '%02x%02x%02x' % tuple(map(lambda x: round(x * 255), colorsys.hsv_to_rgb(*self.diff_color)))
-        plus_or_minus = '±' if (self.difference == 0) else ('+' if (self.difference > 0) else '-')
+        difference = self.usage['difference']
+        text_color = '%02x%02x%02x' % tuple(map(lambda x: round(x * 255), colorsys.hsv_to_rgb(*self.usage['diff_color'])))
+        plus_or_minus = '±' if (difference == 0) else ('+' if (difference > 0) else '-')
 
-        return f'[color={text_color}]{plus_or_minus} {abs(self.difference):.2f} W[/color]'
+        return f'[color={text_color}]{plus_or_minus} {abs(difference):.2f} W[/color]'
 
-    outlets = AliasProperty(_get_outlets, _set_outlets, bind=['_outlets'])
-    wattage = AliasProperty(_get_wattage, _set_wattage, bind=['_wattage'])
-    difference = AliasProperty(_get_difference, _set_difference, bind=['_difference'])
-    diff_color = AliasProperty(_get_color, _set_color, bind=['_diff_color'])
-    diff_text = AliasProperty(_get_difference_text, bind=['difference', 'diff_color'])
+    outlets = AliasProperty(_get_outlets, bind=['usage'])
+    wattage = AliasProperty(_get_wattage, bind=['usage'])
+    difference = AliasProperty(_get_difference, bind=['usage'])
+    diff_color = AliasProperty(_get_color, bind=['usage'])
+    diff_text = AliasProperty(_get_difference_text, bind=['usage'])
     time_text = StringProperty('')
     gpio17_pressed = BooleanProperty(False)
 
     def on_start(self):
         self.mqtt_broker_bridged = False
+        self._state_lock = threading.Lock()
+        self._pending_state = {}
+        self._apply_state_trigger = Clock.create_trigger(self._apply_pending_state)
         self.mqtt = Client(client_id=MQTT_CLIENT_ID)
         self.mqtt.enable_logger()
         self.mqtt.will_set(client_state_topic(MQTT_CLIENT_ID), "0",
@@ -102,17 +96,47 @@ class MonitorApp(App):
             self.mqtt_broker_bridged = False
 
     def receive_new_state(self, client, userdata, message):
+        # runs on the MQTT network thread: parse here, and fold the message
+        # into the latest pending snapshot that the Kivy clock applies once
+        # per frame, so a burst of messages costs a single redraw
         new_state = json.loads(message.payload.decode('utf-8'))
-        
-        if 'outlets' in new_state:
-            self.outlets = new_state['outlets']
 
-        if 'wattage' in new_state:
-            self.wattage = self._sig_figures(new_state['wattage'])
-        if 'difference' in new_state:
-            self.difference = new_state['difference']
-        if 'diff_color' in new_state:
-            self.diff_color = new_state['diff_color']
+        with self._state_lock:
+            pending = self._pending_state
+            if 'outlets' in new_state:
+                if new_state.get('keyframe', True):
+                    pending['outlets'] = dict(new_state['outlets'])
+                    pending['replace_outlets'] = True
+                else:
+                    # deltas only carry the outlets that changed
+                    pending.setdefault('outlets', {}).update(new_state['outlets'])
+            for key in ('wattage', 'difference', 'diff_color'):
+                if key in new_state:
+                    pending[key] = new_state[key]
+
+        self._apply_state_trigger()
+
+    def _apply_pending_state(self, dt):
+        with self._state_lock:
+            state, self._pending_state = self._pending_state, {}
+
+        usage = dict(self.usage)
+        if 'outlets' in state:
+            if state.get('replace_outlets'):
+                outlets = state['outlets']
+            else:
+                outlets = dict(self.outlets)
+                outlets.update(state['outlets'])
+            if outlets != self.outlets:
+                usage['outlets'] = outlets
+        if 'wattage' in state:
+            usage['wattage'] = self._sig_figures(state['wattage'])
+        for key in ('difference', 'diff_color'):
+            if key in state:
+                usage[key] = state[key]
+
+        # a single assignment, which doesn't dispatch if nothing changed
+        self.usage = usage
 
     def press_callback(self, instance):
         outlet_name = instance.text.split()[0]
@@ -134,9 +158,8 @@ class MonitorApp(App):
 
     def set_up_GPIO_and_device_status_popup(self):
         self.pi = pigpio.pi()
-        self.pi.set_mode(17, pigpio.INPUT)
-        self.pi.set_pull_up_down(17, pigpio.PUD_UP)
-        Clock.schedule_interval(self._poll_GPIO, 0.05)
+        self.gpio_buttons = GPIOButtons(self.pi)
+        self.gpio_buttons.add_button(17, self._on_gpio17)
         self.network_status_popup = self._build_network_status_popup()
         self.network_status_popup.bind(on_open=self.update_device_status_popup)
 
@@ -164,8 +187,11 @@ class MonitorApp(App):
         else:
             self.network_status_popup.dismiss()
 
-    def _poll_GPIO(self, dt):
-        self.gpio17_pressed = not self.pi.read(17)
+    def _on_gpio17(self, pressed):
+        self.gpio17_pressed = pressed
+
+    def on_stop(self):
+        self.gpio_buttons.cancel()
 
     def _update_time(self, dt):
         self.time_text = datetime.datetime.now().strftime('%I:%M:%S %p')
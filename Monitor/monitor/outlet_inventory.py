@@ -0,0 +1,37 @@
+import json
+import os
+import kasa
+
+
+class OutletInventory(object):
+    # Persists the known outlet hosts (and their kasa device class) so the
+    # service can start polling right away instead of waiting on a broadcast.
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        outlets = {}
+        for host, class_name in saved.items():
+            device_class = getattr(kasa, class_name, None)
+            if not (isinstance(device_class, type) and
+                    issubclass(device_class, kasa.SmartDevice)):
+                print(f"Ignoring unknown device type {class_name} for {host}")
+                continue
+            outlets[host] = device_class(host)
+        return outlets
+
+    def save(self, outlets):
+        saved = { host: type(device).__name__
+                  for host, device in outlets.items() }
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            json.dump(saved, f)
+        os.replace(temp_filename, self.filename)
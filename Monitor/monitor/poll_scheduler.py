@@ -0,0 +1,57 @@
+import asyncio
+import time
+
+
+class PollScheduler(object):
+    # Paces the poll loop against monotonic deadlines, so the time spent
+    # polling doesn't stretch the period. The period also adapts to the load:
+    # it drops to min_interval as soon as the total wattage moves by
+    # change_threshold from the last reference reading, and backs off towards
+    # max_interval while readings are steady.
+
+    def __init__(self, min_interval, max_interval, change_threshold,
+                 backoff=1.5):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.change_threshold = change_threshold
+        self.backoff = backoff
+
+        self.interval = min_interval
+        self.overruns = 0
+        self._deadline = None
+        self._reference_wattage = None
+        self._wakeup = None
+
+    def observe(self, wattage):
+        if (self._reference_wattage is None or
+                abs(wattage - self._reference_wattage) >= self.change_threshold):
+            self._reference_wattage = wattage
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+
+    def poke(self):
+        # poll again right away, e.g. after an outlet was switched
+        self.interval = self.min_interval
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def wait(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+
+        now = time.monotonic()
+        if self._deadline is None:
+            self._deadline = now
+        self._deadline += self.interval
+        if self._deadline < now:
+            # the cycle overran; skip ahead rather than bursting to catch up
+            self.overruns += 1
+            self._deadline = now
+
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), self._deadline - now)
+            self._deadline = time.monotonic()
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
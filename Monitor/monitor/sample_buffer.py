@@ -0,0 +1,199 @@
+import json
+import mmap
+import os
+import struct
+import time
+
+# Header: magic, layout version, capacity, max outlets, next write index, sample count
+HEADER = struct.Struct('<4sIIIQQ')
+MAGIC = b'OSMP'
+VERSION = 1
+
+TIMESTAMP_SIZE = 8  # float64 seconds since the epoch
+POWER_SIZE = 4      # float32 watts
+STATE_SIZE = 1      # uint8, 1 if the outlet was on
+
+
+class SampleBuffer(object):
+    # Fixed-size ring buffer of (timestamp, per-outlet power, on/off) samples.
+    #
+    # Samples live in one flat buffer split into three regions (timestamps,
+    # power and on/off columns), so memory is capacity * (8 + 5 * max_outlets)
+    # bytes regardless of uptime. Given a filename, the buffer is memory-mapped
+    # and the alias-to-column mapping is saved next to it, so history survives
+    # a restart. retain() hands the columns of outlets that are gone back for
+    # new outlets to use.
+
+    def __init__(self, capacity, max_outlets, filename=None):
+        self.capacity = capacity
+        self.max_outlets = max_outlets
+        self.filename = filename
+        self._dropped = set()
+
+        self._power_offset = HEADER.size + capacity * TIMESTAMP_SIZE
+        self._state_offset = self._power_offset + capacity * max_outlets * POWER_SIZE
+        size = self._state_offset + capacity * max_outlets * STATE_SIZE
+
+        if filename is None:
+            self._buffer = bytearray(size)
+            self._reset()
+        else:
+            self._columns = None
+            self._buffer = self._map_file(filename, size)
+            if self._columns is None:
+                self._columns = self._load_columns()
+
+        view = memoryview(self._buffer)
+        self._timestamps = view[HEADER.size:self._power_offset].cast('d')
+        self._power = view[self._power_offset:self._state_offset].cast('f')
+        self._states = view[self._state_offset:size]
+
+    def _map_file(self, filename, size):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT)
+        try:
+            fresh = os.fstat(fd).st_size != size
+            if fresh:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            buffer = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        self._buffer = buffer
+        magic, version, capacity, max_outlets, _, _ = HEADER.unpack_from(buffer)
+        if fresh or (magic, version, capacity, max_outlets) != \
+                (MAGIC, VERSION, self.capacity, self.max_outlets):
+            self._reset()
+        return buffer
+
+    def _reset(self):
+        HEADER.pack_into(self._buffer, 0, MAGIC, VERSION,
+                         self.capacity, self.max_outlets, 0, 0)
+        self._columns = {}
+        self._save_columns()
+
+    def _columns_filename(self):
+        return self.filename + '.outlets'
+
+    def _load_columns(self):
+        try:
+            with open(self._columns_filename()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            # samples can't be attributed to outlets without the mapping
+            self._reset()
+            return self._columns
+
+    def _save_columns(self):
+        if self.filename is None:
+            return
+        temp_filename = self._columns_filename() + '.tmp'
+        with open(temp_filename, 'w') as f:
+            json.dump(self._columns, f)
+        os.replace(temp_filename, self._columns_filename())
+
+    @property
+    def _next_index(self):
+        return HEADER.unpack_from(self._buffer)[4]
+
+    def __len__(self):
+        return HEADER.unpack_from(self._buffer)[5]
+
+    def _column(self, alias):
+        column = self._columns.get(alias)
+        if column is not None:
+            return column
+        free = sorted(set(range(self.max_outlets)) - set(self._columns.values()))
+        if not free:
+            if alias not in self._dropped:
+                self._dropped.add(alias)
+                print(f"No sample history column left for {alias}; "
+                      f"all {self.max_outlets} are in use")
+            return None
+        column = free[0]
+        self._columns[alias] = column
+        self._save_columns()
+        return column
+
+    def retain(self, aliases):
+        # frees the columns of every outlet not in aliases, e.g. after it was
+        # unplugged or renamed, and clears their history so a new outlet
+        # doesn't inherit it
+        gone = [alias for alias in self._columns if alias not in aliases]
+        if not gone:
+            return
+        for alias in gone:
+            column = self._columns.pop(alias)
+            for offset in range(column, self.capacity * self.max_outlets,
+                                self.max_outlets):
+                self._power[offset] = 0.0
+                self._states[offset] = 0
+        self._dropped.clear()
+        self._save_columns()
+
+    def append(self, outlet_statuses, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        index = self._next_index
+        count = len(self)
+        row = index * self.max_outlets
+
+        for column in range(self.max_outlets):
+            self._power[row + column] = 0.0
+            self._states[row + column] = 0
+
+        for alias, status in outlet_statuses.items():
+            column = self._column(alias)
+            if column is None:
+                # out of columns; memory stays bounded at max_outlets
+                continue
+            self._power[row + column] = status['wattage']
+            self._states[row + column] = 1 if status['enabled'] else 0
+
+        self._timestamps[index] = timestamp
+        HEADER.pack_into(self._buffer, 0, MAGIC, VERSION,
+                         self.capacity, self.max_outlets,
+                         (index + 1) % self.capacity,
+                         min(count + 1, self.capacity))
+
+    def window_stats(self, alias, minutes, now=None):
+        # min/max/mean power and fraction of samples switched on for one
+        # outlet over the last `minutes`, newest sample first; None if empty
+        column = self._columns.get(alias)
+        if column is None:
+            return None
+        if now is None:
+            now = time.time()
+        cutoff = now - minutes * 60
+
+        count = 0
+        total = 0.0
+        on = 0
+        low = float('inf')
+        high = float('-inf')
+        index = self._next_index
+        for _ in range(len(self)):
+            index = (index - 1) % self.capacity
+            if self._timestamps[index] < cutoff:
+                break
+            offset = index * self.max_outlets + column
+            power = self._power[offset]
+            total += power
+            on += self._states[offset]
+            low = min(low, power)
+            high = max(high, power)
+            count += 1
+
+        if count == 0:
+            return None
+        return { 'min': low,
+                 'max': high,
+                 'mean': total / count,
+                 'on_fraction': on / count,
+                 'samples': count }
+
+    def flush(self):
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.flush()
@@ -0,0 +1,70 @@
+import json
+
+
+class UsageDeltaEncoder(object):
+    # Decides what goes out on monitor/usage. A full keyframe is published
+    # retained every keyframe_interval seconds (and whenever the set of
+    # outlets changes) so late subscribers can rebuild the state. In between,
+    # only outlets whose wattage moved past the deadband, or whose on/off or
+    # stale flag changed, are sent, and nothing is sent if neither any outlet
+    # nor the total moved.
+
+    def __init__(self, outlet_deadband, total_deadband, keyframe_interval):
+        self.outlet_deadband = outlet_deadband
+        self.total_deadband = total_deadband
+        self.keyframe_interval = keyframe_interval
+
+        self.messages_sent = 0
+        self.messages_suppressed = 0
+        self.bytes_sent = 0
+        self.bytes_saved = 0
+
+        self._sent_outlets = {}
+        self._sent_wattage = None
+        self._last_keyframe = None
+
+    def _outlet_changed(self, sent, status):
+        return (sent.get('enabled') != status.get('enabled') or
+                sent.get('stale', False) != status.get('stale', False) or
+                abs(sent['wattage'] - status['wattage']) >= self.outlet_deadband)
+
+    def _needs_keyframe(self, outlets, now):
+        return (self._last_keyframe is None or
+                now - self._last_keyframe >= self.keyframe_interval or
+                outlets.keys() != self._sent_outlets.keys())
+
+    def encode(self, usage, now):
+        # returns (payload, retain), or None if there's nothing worth sending
+        outlets = usage['outlets']
+        keyframe = json.dumps(dict(usage, keyframe=True)).encode('utf-8')
+
+        if self._needs_keyframe(outlets, now):
+            self._last_keyframe = now
+            self._sent_outlets = { alias: dict(status)
+                                   for alias, status in outlets.items() }
+            self._sent_wattage = usage['wattage']
+            self.messages_sent += 1
+            self.bytes_sent += len(keyframe)
+            return keyframe, True
+
+        changed = { alias: status for alias, status in outlets.items()
+                    if self._outlet_changed(self._sent_outlets[alias], status) }
+        if not changed and abs(usage['wattage'] - self._sent_wattage) < self.total_deadband:
+            self.messages_suppressed += 1
+            self.bytes_saved += len(keyframe)
+            return None
+
+        delta = json.dumps(dict(usage, outlets=changed, keyframe=False)).encode('utf-8')
+        for alias, status in changed.items():
+            self._sent_outlets[alias] = dict(status)
+        self._sent_wattage = usage['wattage']
+        self.messages_sent += 1
+        self.bytes_sent += len(delta)
+        self.bytes_saved += len(keyframe) - len(delta)
+        return delta, False
+
+    def stats(self):
+        return { 'messages_sent': self.messages_sent,
+                 'messages_suppressed': self.messages_suppressed,
+                 'bytes_sent': self.bytes_sent,
+                 'bytes_saved': self.bytes_saved }
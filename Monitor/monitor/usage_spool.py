@@ -0,0 +1,101 @@
+import json
+import os
+
+
+class UsageSpool(object):
+    # Append-only on-disk log of hourly usage records. Records stay pending
+    # until commit() moves the delivered offset past them; once everything
+    # has been delivered the log is truncated.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset_filename = filename + '.offset'
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self._drop_partial_record()
+        self._offset = self._load_offset()
+
+    def _drop_partial_record(self):
+        # a crash in the middle of append() leaves a record without its
+        # newline; the next append would run on from it, and pending() would
+        # skip both as one corrupt line
+        try:
+            f = open(self.filename, 'rb+')
+        except FileNotFoundError:
+            return
+
+        with f:
+            size = end = f.seek(0, os.SEEK_END)
+            while end > 0:
+                start = max(0, end - 4096)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b'\n')
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end < size:
+                print(f"Dropping a spooled record cut short by a crash ({size - end} bytes)")
+                f.truncate(end)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _load_offset(self):
+        try:
+            with open(self.offset_filename) as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _save_offset(self, offset):
+        temp_filename = self.offset_filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            f.write(str(offset))
+        os.replace(temp_filename, self.offset_filename)
+        self._offset = offset
+
+    def _size(self):
+        try:
+            return os.path.getsize(self.filename)
+        except OSError:
+            return 0
+
+    def __len__(self):
+        return len(self.pending())
+
+    def has_pending(self):
+        return self._size() > self._offset
+
+    def append(self, record):
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def pending(self, limit=None):
+        # [(offset after the record, record), ...] in the order they were spooled
+        records = []
+        try:
+            f = open(self.filename, 'rb')
+        except FileNotFoundError:
+            return records
+
+        with f:
+            f.seek(self._offset)
+            while limit is None or len(records) < limit:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    # end of file, or a record cut short by a crash
+                    break
+                try:
+                    records.append((f.tell(), json.loads(line.decode('utf-8'))))
+                except ValueError:
+                    print(f"Skipping corrupt spooled record {line!r}")
+        return records
+
+    def commit(self, offset):
+        if offset >= self._size():
+            # everything has been delivered, so start the log over
+            with open(self.filename, 'w'):
+                pass
+            offset = 0
+        self._save_offset(offset)
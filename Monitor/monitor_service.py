@@ -3,10 +3,20 @@
 import kasa
 import asyncio
 import json
+import time
 import paho.mqtt.client as mqtt
 
 from datetime import datetime, timezone, timedelta
 from variables import *
+from monitor.outlet_inventory import OutletInventory
+from monitor.command_queue import OutletCommandQueue
+from monitor.sample_buffer import SampleBuffer
+from monitor.usage_spool import UsageSpool
+from monitor.usage_encoder import UsageDeltaEncoder
+from monitor.poll_scheduler import PollScheduler
+from monitor.energy_meter import EnergyMeter
+from monitor.metrics import Metrics
+from monitor.average_profile import AverageProfile
 
 MQTT_CLIENT_ID = "monitor_service"
 
@@ -18,17 +28,41 @@ class InvalidMessage(Exception):
 class MonitorService(object):
 
     def __init__(self):
+        self.metrics = Metrics()
         self._client = self._create_and_configure_broker_client()
-        self.outlets = asyncio.run(kasa.Discover.discover(on_discovered=self.on_discovered))
+        self.inventory = OutletInventory(OUTLET_INVENTORY_FILENAME)
+        # start from the saved inventory; discovery keeps it current in the background
+        self.outlets = self.inventory.load()
         self.outlet_statuses = {}
+        self._outlet_aliases = {}
+        self._sampled_aliases = None
+        self.samples = SampleBuffer(SAMPLE_BUFFER_CAPACITY,
+                                    SAMPLE_BUFFER_MAX_OUTLETS,
+                                    filename=SAMPLE_BUFFER_FILENAME)
         self.current_wattage = 0
         self.hour_wattage = 0
+        self.hour_outlet_wattage = {}
+        self.energy_meter = EnergyMeter()
         self.last_poll = datetime.now(timezone.utc)
+        self.averages = AverageProfile(AVERAGE_PROFILE_FILENAME)
         self.hour_average = 0
         self.difference = 0
         self.diff_color = [.2, 1, 0.5]
-        self.to_enable = None
-        self.enable_state = True
+        self._lamp_config = None
+        self._lamp_config_sent = 0
+        self.scheduler = PollScheduler(POLL_INTERVAL_MIN_SECS,
+                                       POLL_INTERVAL_MAX_SECS,
+                                       POLL_CHANGE_THRESHOLD_WATTS,
+                                       backoff=POLL_INTERVAL_BACKOFF)
+        self.usage_encoder = UsageDeltaEncoder(USAGE_OUTLET_DEADBAND_WATTS,
+                                               USAGE_TOTAL_DEADBAND_WATTS,
+                                               USAGE_KEYFRAME_INTERVAL_SECS)
+        self.spool = UsageSpool(SPOOL_FILENAME)
+        self.bridge_connected = False
+        self._spool_wakeup = None
+        self.commands = OutletCommandQueue(COMMAND_TIMEOUT_SECS,
+                                           on_applied=self.on_command_applied)
+        self._loop = None
 
     async def on_discovered(self, dev):
         # filter out non-emeters
@@ -52,98 +86,301 @@ class MonitorService(object):
                              qos=2, retain=True)
         self._client.subscribe(TOPIC_ENABLE_OUTLETS, qos=1)
         self._client.subscribe(TOPIC_HOUR_AVERAGE, qos=1)
+        self._client.message_callback_add(broker_bridge_connection_topic(),
+                                          self.on_message_bridge_state)
+        self._client.subscribe(broker_bridge_connection_topic(), qos=1)
 
     def default_on_message(self, client, userdata, msg):
         print("Received unexpected message on topic " +
               msg.topic + " with payload '" + str(msg.payload) + "'")
 
+    def on_message_bridge_state(self, client, userdata, msg):
+        self.bridge_connected = msg.payload == b"1"
+        if self.bridge_connected:
+            self._loop.call_soon_threadsafe(self._spool_wakeup.set)
+
     def on_message_average(self, client, userdata, msg):
         try:
-            new_average = json.loads(msg.payload.decode('utf-8'))
-            if 'hour' not in new_average or new_average['hour'] != datetime.now(timezone.utc).hour:
+            new_averages = json.loads(msg.payload.decode('utf-8'))
+            if not isinstance(new_averages, dict) or not self.averages.update(new_averages):
                 raise InvalidMessage()
 
-            self.hour_average = new_average["wattage"]
-
-        except InvalidMessage:
-            print("Invalid configuration or incorrect hour. " + str(msg.payload))
+        except (InvalidMessage, ValueError, TypeError):
+            print("Invalid average profile. " + str(msg.payload))
 
     def on_message_set_enabled(self, client, userdata, msg):
         try:
             new_config = json.loads(msg.payload.decode('utf-8'))
-            if 'outlets' not in new_config:
+            if not isinstance(new_config, dict) or \
+                    not isinstance(new_config.get('outlets'), dict):
                 raise InvalidMessage()
-            
-            for outlet_name in new_config['outlets']:
-                for dev in self.outlets.values():
-                    if outlet_name == dev.alias:
-                        self.schedule_enable(dev, new_config['outlets'][outlet_name])
-                    
-        except InvalidMessage:
+            commands = new_config['outlets']
+            if not all(isinstance(outlet_name, str) and isinstance(state, bool)
+                       for outlet_name, state in commands.items()):
+                raise InvalidMessage()
+
+            # this runs on the MQTT network thread; hand the commands to the event loop
+            for outlet_name, state in commands.items():
+                self._loop.call_soon_threadsafe(self.schedule_enable,
+                                                outlet_name, state)
+
+        except (InvalidMessage, ValueError, TypeError, AttributeError):
             print("Invalid outlet configuration. " + str(msg.payload))
 
-    def schedule_enable(self, device, state):
-        self.to_enable = device
-        self.enable_state = state
+    def schedule_enable(self, alias, state):
+        for host, device in self.outlets.items():
+            if self._outlet_aliases.get(host) == alias:
+                self.commands.put(alias, device, state)
+                return
+        print(f"Unknown outlet {alias}")
+
+    def on_command_applied(self, alias, state, latency):
+        print(f"Turned {'on' if state else 'off'} {alias} in {latency * 1000:.0f} ms")
+        if alias in self.outlet_statuses:
+            self.outlet_statuses[alias]['enabled'] = state
+            self.publish_current_usage()
+        self.scheduler.poke()
+
+    async def discover_outlets(self):
+        while True:
+            try:
+                await self.check_for_outlets()
+            except (OSError, kasa.SmartDeviceException) as e:
+                print(f"Outlet discovery failed: {e}")
+            await asyncio.sleep(DISCOVERY_INTERVAL_SECS)
 
     async def check_for_outlets(self):
-        new_outlets = await kasa.Discover.discover(on_discovered=self.on_discovered)
-        if self.outlets.keys() != new_outlets.keys():
-            self.outlets = new_outlets
+        with self.metrics.timer('discovery'):
+            found = await kasa.Discover.discover(on_discovered=self.on_discovered)
+        changed = False
+
+        # self.outlets is updated in place so a poll in progress is unaffected
+        for host, device in found.items():
+            if host not in self.outlets:
+                self.outlets[host] = device
+                changed = True
+
+        missing = [host for host in self.outlets if host not in found]
+        for host in missing:
+            # broadcasts get dropped, so probe directly before forgetting an outlet
+            try:
+                await kasa.Discover.discover_single(host, timeout=DISCOVERY_PROBE_TIMEOUT_SECS)
+            except (OSError, asyncio.TimeoutError, kasa.SmartDeviceException):
+                print(f"Outlet at {host} is gone")
+                del self.outlets[host]
+                changed = True
+
+        if changed:
+            self.inventory.save(self.outlets)
+
+    async def _update_device(self, device, semaphore=None):
+        try:
+            if semaphore is None:
+                with self.metrics.timer('device_update'):
+                    await asyncio.wait_for(device.update(), POLL_DEVICE_TIMEOUT_SECS)
+            else:
+                async with semaphore:
+                    with self.metrics.timer('device_update'):
+                        await asyncio.wait_for(device.update(), POLL_DEVICE_TIMEOUT_SECS)
+            return True
+        except asyncio.TimeoutError:
+            self.metrics.increment('device_timeouts')
+            print(f"Timed out updating outlet at {device.host}")
+            # the cancelled query can leave its reply unread on the socket,
+            # and the next update would take it for its own; reconnect instead
+            await device.protocol.close()
+        except kasa.SmartDeviceException as e:
+            self.metrics.increment('device_errors')
+            print(f"Failed to update outlet at {device.host}: {e}")
+        return False
 
     async def poll_usage_data(self):
-        if self.to_enable:
-            if self.enable_state:
-                await self.to_enable.turn_on()
+        devices = list(self.outlets.values())
+        if POLL_CONCURRENTLY:
+            # fan out the updates so one slow plug can't stall the whole cycle
+            semaphore = asyncio.Semaphore(POLL_MAX_CONCURRENCY or max(1, len(devices)))
+            updated = await asyncio.gather(*[self._update_device(device, semaphore)
+                                             for device in devices])
+        else:
+            updated = [await self._update_device(device) for device in devices]
+
+        statuses = {}
+        counters = {}
+        self.current_wattage = 0
+        for device, is_updated in zip(devices, updated):
+            if is_updated:
+                alias = device.alias
+                self._outlet_aliases[device.host] = alias
+                status = { 'enabled': device.is_on,
+                           'wattage': device.emeter_realtime.power }
+                if device.emeter_realtime.total is not None:
+                    counters[alias] = device.emeter_realtime.total * 1000
             else:
-                await self.to_enable.turn_off()
-            self.to_enable = None
+                # keep the last known reading, but flag it so consumers know it's old
+                alias = self._outlet_aliases.get(device.host)
+                if alias not in self.outlet_statuses:
+                    continue
+                status = dict(self.outlet_statuses[alias], stale=True)
 
-        self.current_wattage = 0
-        for device in self.outlets.values():
-            await device.update()
-            self.outlet_statuses[device.alias] = { 'enabled': device.is_on, 
-                                                   'wattage': device.emeter_realtime.power }
-            self.current_wattage += device.emeter_realtime.power
+            statuses[alias] = status
+            self.current_wattage += status['wattage']
+        self.outlet_statuses = statuses
 
         poll_time = datetime.now(timezone.utc)
-        watt_hours = self.current_wattage * ((poll_time - self.last_poll) / timedelta(hours=1))
-        print(f"Polling at {poll_time.strftime('%H:%M:%S (UTC)')}, added {watt_hours} Wh")
-        self.hour_wattage += watt_hours
+        self._retain_sample_columns()
+        self.samples.append(self.outlet_statuses, poll_time.timestamp())
+        with self.metrics.timer('integration'):
+            energy = self._outlet_energy(counters, (poll_time - self.last_poll) / timedelta(hours=1))
+        print(f"Polling at {poll_time.strftime('%H:%M:%S (UTC)')}, added {sum(energy.values())} Wh")
 
         if poll_time.hour != self.last_poll.hour:
+            # split the energy across the boundary in proportion to the time on each side
+            hour_start = poll_time.replace(minute=0, second=0, microsecond=0)
+            before = (hour_start - self.last_poll) / (poll_time - self.last_poll)
+            self._add_hour_energy(energy, before)
             print(f"Publishing last hour's usage: {self.hour_wattage} Wh for hour {self.last_poll.hour} (UTC)")
             self.publish_hour_usage()
             self.hour_wattage = 0
+            self.hour_outlet_wattage = {}
+            self._add_hour_energy(energy, 1 - before)
+        else:
+            self._add_hour_energy(energy, 1)
 
         self.last_poll = poll_time
 
+    def _retain_sample_columns(self):
+        # once every outlet's alias is known, let go of the history columns of
+        # outlets that were removed or renamed
+        if not all(host in self._outlet_aliases for host in self.outlets):
+            return
+        aliases = { self._outlet_aliases[host] for host in self.outlets }
+        if aliases != self._sampled_aliases:
+            self.samples.retain(aliases)
+            self._sampled_aliases = aliases
+
+    def _outlet_energy(self, counters, interval_hours):
+        energy = {}
+        if ENERGY_ACCOUNTING == 'counter':
+            energy = self.energy_meter.update(counters)
+            self.energy_meter.retain(self.outlet_statuses)
+
+        for alias, status in self.outlet_statuses.items():
+            if alias in energy:
+                continue
+            if status.get('stale') and alias in self.energy_meter:
+                # the counter will catch up once the outlet answers again
+                continue
+            # no counter delta yet (or rectangle mode): integrate the power reading
+            energy[alias] = status['wattage'] * interval_hours
+        return energy
+
+    def _add_hour_energy(self, energy, fraction):
+        for alias, watt_hours in energy.items():
+            watt_hours *= fraction
+            self.hour_outlet_wattage[alias] = self.hour_outlet_wattage.get(alias, 0) + watt_hours
+            self.hour_wattage += watt_hours
+
+    def outlet_usage_window(self, alias, minutes):
+        return self.samples.window_stats(alias, minutes)
+
     def publish_hour_usage(self):
-        last_hour = { 'hour': self.last_poll.hour,
-                      'wattage': self.hour_wattage }
-        self._client.publish(TOPIC_HOUR_USAGE,
-                             json.dumps(last_hour).encode('utf-8'), qos=1,
-                             retain=True)
+        # spool first so the hour survives a broker or bridge outage; the key
+        # lets the backend ignore records it has already seen on replay
+        hour_start = self.last_poll.replace(minute=0, second=0, microsecond=0)
+        last_hour = { 'key': hour_start.isoformat(),
+                      'hour': self.last_poll.hour,
+                      'wattage': self.hour_wattage,
+                      'outlets': self.hour_outlet_wattage }
+        with self.metrics.timer('publish_hour_usage'):
+            self.spool.append(last_hour)
+        self._spool_wakeup.set()
+
+    async def replay_spooled_usage(self):
+        while True:
+            await self._spool_wakeup.wait()
+            self._spool_wakeup.clear()
+
+            # replay in rate-limited batches so a long outage doesn't flood
+            # the cloud broker on reconnect
+            while self.bridge_connected:
+                batch = self.spool.pending(SPOOL_REPLAY_BATCH_SIZE)
+                if not batch:
+                    break
+                if not await self._publish_spooled_batch(batch):
+                    break
+                if self.spool.has_pending():
+                    await asyncio.sleep(SPOOL_REPLAY_INTERVAL_SECS)
+
+    def _is_published(self, info):
+        # paho raises rather than answering for messages it couldn't send
+        # (e.g. queued while disconnected); those get replayed later
+        try:
+            return info.is_published()
+        except (RuntimeError, ValueError):
+            return False
+
+    async def _publish_spooled_batch(self, batch):
+        sent = [(offset, self._client.publish(TOPIC_HOUR_USAGE,
+                                              json.dumps(record).encode('utf-8'),
+                                              qos=1, retain=True))
+                for offset, record in batch]
+
+        deadline = self._loop.time() + SPOOL_PUBLISH_TIMEOUT_SECS
+        while not all(self._is_published(info) for _, info in sent):
+            if self._loop.time() > deadline:
+                break
+            await asyncio.sleep(0.1)
+
+        # only commit the records the broker acknowledged, in order
+        delivered = 0
+        for offset, info in sent:
+            if not self._is_published(info):
+                break
+            delivered += 1
+        if delivered:
+            self.spool.commit(sent[delivered - 1][0])
+            print(f"Delivered {delivered} spooled hourly usage record(s)")
+        return delivered == len(sent)
 
     def publish_current_usage(self):
         usage = { 'wattage': self.current_wattage,
                   'difference': self.difference,
                   'diff_color': self.diff_color,
                   'outlets': self.outlet_statuses }
-        self._client.publish(TOPIC_CURRENT_USAGE,
-                             json.dumps(usage).encode('utf-8'), qos=1,
-                             retain=True)
+        if not USAGE_DELTA_PUBLISHING:
+            self._client.publish(TOPIC_CURRENT_USAGE,
+                                 json.dumps(usage).encode('utf-8'), qos=1,
+                                 retain=True)
+            return
+
+        encoded = self.usage_encoder.encode(usage, time.monotonic())
+        if encoded is None:
+            return
+        payload, is_keyframe = encoded
+        # only keyframes are retained, so late subscribers always start from full state
+        self._client.publish(TOPIC_CURRENT_USAGE, payload, qos=1,
+                             retain=is_keyframe)
 
     def publish_difference_color(self):
         config = { 'client': 'monitor_service',
-                   'color': { 'h': self.diff_color[0],
+                   'color': { 'h': round(self.diff_color[0], 3),
                               's': 1.0 },
-                   'brightness': self.diff_color[2],
+                   'brightness': round(self.diff_color[2], 3),
                    'on': True }
+        # the lamp only needs to hear about changes, plus the odd refresh
+        # in case it restarted
+        now = time.monotonic()
+        if config == self._lamp_config and now - self._lamp_config_sent < LAMP_CONFIG_REFRESH_SECS:
+            return
+        self._lamp_config = config
+        self._lamp_config_sent = now
         self._client.publish(TOPIC_LAMP_CONFIG,
                              json.dumps(config).encode('utf-8'), qos=1)
 
     def calculate_difference(self):
+        # the profile covers the whole day, so the new hour's average is
+        # there as soon as the hour turns over
+        self.hour_average = self.averages.average(datetime.now(timezone.utc).hour)
         self.difference = self.current_wattage - self.hour_average
         normalized_diff = self.difference / (self.hour_average + 0.001)
         normalized_diff = min(1, max(normalized_diff, -1))
@@ -153,25 +390,79 @@ class MonitorService(object):
 
         self.diff_color = [hue, 1.0, value]
 
+    async def run_cycle(self):
+        with self.metrics.timer('cycle'):
+            with self.metrics.timer('poll'):
+                await self.poll_usage_data()
+            with self.metrics.timer('calculate_difference'):
+                self.calculate_difference()
+            with self.metrics.timer('publish_current_usage'):
+                self.publish_current_usage()
+            with self.metrics.timer('publish_difference_color'):
+                self.publish_difference_color()
+        self.scheduler.observe(self.current_wattage)
+
+    def collect_metrics(self):
+        # point-in-time values from the other components, read when exporting
+        self.metrics.set_gauge('outlets', len(self.outlets))
+        self.metrics.set_gauge('stale_outlets',
+                               sum(1 for s in self.outlet_statuses.values() if s.get('stale')))
+        self.metrics.set_gauge('poll_interval_seconds', self.scheduler.interval)
+        self.metrics.set_gauge('poll_overruns', self.scheduler.overruns)
+        self.metrics.set_gauge('command_queue_depth', len(self.commands))
+        self.metrics.set_gauge('commands_coalesced', self.commands.coalesced)
+        self.metrics.set_gauge('commands_failed', self.commands.failed)
+        latency = self.commands.latency_stats()
+        if latency:
+            self.metrics.set_gauge('command_latency_p50_seconds', latency['p50'])
+            self.metrics.set_gauge('command_latency_max_seconds', latency['max'])
+        self.metrics.set_gauge('spool_pending', len(self.spool))
+        for name, value in self.usage_encoder.stats().items():
+            self.metrics.set_gauge(f'usage_{name}', value)
+        return self.metrics
+
+    async def publish_metrics(self):
+        while True:
+            await asyncio.sleep(METRICS_INTERVAL_SECS)
+            snapshot = self.collect_metrics().snapshot()
+            self._client.publish(TOPIC_METRICS,
+                                 json.dumps(snapshot).encode('utf-8'), qos=1,
+                                 retain=True)
+
+    async def _handle_metrics_request(self, reader, writer):
+        try:
+            await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+            body = self.collect_metrics().prometheus_text().encode('utf-8')
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n' +
+                         f'Content-Length: {len(body)}\r\n\r\n'.encode('utf-8') +
+                         body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
     async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._spool_wakeup = asyncio.Event()
         self._client.connect(MQTT_BROKER_HOST,
                              port=MQTT_BROKER_PORT,
                              keepalive=MQTT_BROKER_KEEP_ALIVE_SECS)
         self._client.loop_start()
 
-        count = 0
-        while True:
-            if (count >= 10):
-                await self.check_for_outlets()
-                count = 0
-
-            await self.poll_usage_data()
-            self.calculate_difference()
-            self.publish_current_usage()
-            self.publish_difference_color()
+        self._discovery_task = asyncio.create_task(self.discover_outlets())
+        self._command_task = asyncio.create_task(self.commands.run())
+        self._metrics_task = asyncio.create_task(self.publish_metrics())
+        if METRICS_HTTP_PORT is not None:
+            self._metrics_server = await asyncio.start_server(
+                self._handle_metrics_request, port=METRICS_HTTP_PORT)
+        self._spool_task = asyncio.create_task(self.replay_spooled_usage())
 
-            await asyncio.sleep(3)
-            count += 1
+        while True:
+            await self.run_cycle()
+            await self.scheduler.wait()
 
         
 
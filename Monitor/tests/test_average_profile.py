@@ -0,0 +1,52 @@
+import json
+import os
+import tempfile
+import unittest
+
+from monitor.average_profile import AverageProfile, HOURS
+
+
+class AverageProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.state_dir.name, 'averages.json')
+
+    def tearDown(self):
+        self.state_dir.cleanup()
+
+    def test_starts_at_zero(self):
+        self.assertEqual(AverageProfile(self.filename).hours, [0] * HOURS)
+
+    def test_full_profile_is_kept_across_restarts(self):
+        hours = [float(hour) for hour in range(HOURS)]
+        self.assertTrue(AverageProfile(self.filename).update({ 'hours': hours }))
+
+        reloaded = AverageProfile(self.filename)
+        self.assertEqual(reloaded.hours, hours)
+        self.assertEqual(reloaded.average(5), 5.0)
+
+    def test_single_hour_fills_its_slot(self):
+        profile = AverageProfile(self.filename)
+        profile.update({ 'hours': [1.0] * HOURS })
+        self.assertTrue(profile.update({ 'hour': 3, 'wattage': 40 }))
+        self.assertEqual(profile.average(3), 40)
+        self.assertEqual(profile.average(4), 1.0)
+        self.assertEqual(AverageProfile(self.filename).hours, profile.hours)
+
+    def test_invalid_messages_change_nothing(self):
+        profile = AverageProfile(self.filename)
+        for message in ({ 'hours': [1.0] * (HOURS - 1) }, { 'hours': ['x'] * HOURS },
+                        { 'hours': [True] * HOURS }, { 'hours': [float('nan')] * HOURS },
+                        { 'hour': 3, 'wattage': 'x' }, { 'hour': 3, 'wattage': None },
+                        { 'hour': 3.0, 'wattage': 1.0 }, { 'hour': 24, 'wattage': 1.0 },
+                        { 'hour': '3', 'wattage': 1.0 }, { 'wattage': 1.0 }, {}):
+            self.assertFalse(profile.update(message), message)
+        self.assertEqual(profile.hours, [0] * HOURS)
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_damaged_file_falls_back_to_zero(self):
+        for content in ('{', json.dumps({ 'hours': [None] * HOURS }), json.dumps([1])):
+            with open(self.filename, 'w') as f:
+                f.write(content)
+            self.assertEqual(AverageProfile(self.filename).hours, [0] * HOURS)
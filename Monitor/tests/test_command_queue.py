@@ -0,0 +1,95 @@
+import asyncio
+import contextlib
+import io
+import unittest
+from unittest import mock
+
+import kasa
+
+from monitor.command_queue import OutletCommandQueue
+
+
+class FakePlug(object):
+
+    def __init__(self, error=None, delay=0):
+        self.error = error
+        self.delay = delay
+        self.calls = []
+        self.protocol = mock.AsyncMock()
+
+    async def turn_on(self):
+        self.calls.append(True)
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+
+    async def turn_off(self):
+        self.calls.append(False)
+        if self.error:
+            raise self.error
+
+
+class OutletCommandQueueTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.applied = []
+        self.commands = OutletCommandQueue(1, on_applied=self.on_applied)
+        self.task = asyncio.create_task(self.commands.run())
+        await asyncio.sleep(0)
+
+    async def asyncTearDown(self):
+        self.task.cancel()
+
+    def on_applied(self, alias, state, latency):
+        self.applied.append((alias, state))
+
+    async def drain(self):
+        # the fake plugs answer straight away
+        await asyncio.sleep(0.05)
+
+    async def test_applies_commands(self):
+        plug = FakePlug()
+        self.commands.put('lamp', plug, True)
+        await self.drain()
+
+        self.assertEqual(plug.calls, [True])
+        self.assertEqual(self.applied, [('lamp', True)])
+        self.assertEqual(self.commands.latency_stats()['count'], 1)
+
+    async def test_coalesces_toggles_of_one_outlet(self):
+        plug = FakePlug()
+        self.commands.put('lamp', plug, True)
+        self.commands.put('lamp', plug, False)
+        self.commands.put('lamp', plug, True)
+        await self.drain()
+
+        self.assertEqual(plug.calls, [True])
+        self.assertEqual(self.commands.coalesced, 2)
+
+    async def test_failures_dont_stop_command_handling(self):
+        for error in (kasa.SmartDeviceException('refused'),
+                      ConnectionResetError('dropped mid-write')):
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.commands.put('broken', FakePlug(error), True)
+                await self.drain()
+
+        plug = FakePlug()
+        self.commands.put('lamp', plug, False)
+        await self.drain()
+
+        self.assertEqual(self.commands.failed, 2)
+        self.assertEqual(plug.calls, [False])
+        self.assertEqual(self.applied, [('lamp', False)])
+        self.assertFalse(self.task.done())
+
+    async def test_timeout_reconnects_the_plug(self):
+        # the late reply mustn't be left for the plug's next query to read
+        self.commands.timeout = 0.05
+        plug = FakePlug(delay=1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.commands.put('lamp', plug, True)
+            await asyncio.sleep(0.2)
+
+        self.assertEqual(self.commands.failed, 1)
+        plug.protocol.close.assert_awaited_once()
+        self.assertEqual(self.applied, [])
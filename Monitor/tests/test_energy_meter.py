@@ -0,0 +1,36 @@
+import unittest
+
+from monitor.energy_meter import EnergyMeter
+
+
+class EnergyMeterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.meter = EnergyMeter()
+
+    def test_first_reading_only_sets_a_baseline(self):
+        self.assertEqual(self.meter.update({ 'lamp': 1000.0 }), {})
+        self.assertIn('lamp', self.meter)
+
+    def test_energy_is_the_counter_delta(self):
+        self.meter.update({ 'lamp': 1000.0, 'fan': 50.0 })
+        self.assertEqual(self.meter.update({ 'lamp': 1012.5, 'fan': 50.0 }),
+                         { 'lamp': 12.5, 'fan': 0.0 })
+
+    def test_counter_reset(self):
+        self.meter.update({ 'lamp': 1000.0 })
+        # everything counted since the reset happened after the last reading
+        self.assertEqual(self.meter.update({ 'lamp': 3.0 }), { 'lamp': 3.0 })
+        self.assertEqual(self.meter.resets, 1)
+        self.assertEqual(self.meter.update({ 'lamp': 5.0 }), { 'lamp': 2.0 })
+
+    def test_missing_outlets_keep_their_baseline(self):
+        self.meter.update({ 'lamp': 1000.0 })
+        self.assertEqual(self.meter.update({}), {})
+        self.assertEqual(self.meter.update({ 'lamp': 1010.0 }), { 'lamp': 10.0 })
+
+    def test_retain_forgets_outlets_that_went_away(self):
+        self.meter.update({ 'lamp': 1000.0, 'fan': 50.0 })
+        self.meter.retain({'lamp'})
+        self.assertNotIn('fan', self.meter)
+        self.assertEqual(self.meter.update({ 'fan': 60.0 }), {})
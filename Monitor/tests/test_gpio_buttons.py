@@ -0,0 +1,56 @@
+import os
+import time
+import unittest
+from unittest import mock
+
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+os.environ.setdefault('KIVY_LOG_MODE', 'PYTHON')
+
+import pigpio
+from kivy.clock import Clock
+
+from monitor.gpio_buttons import GPIOButtons
+
+
+class GPIOButtonsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pi = mock.Mock()
+        self.pi.read.return_value = 1
+        self.buttons = GPIOButtons(self.pi, debounce=0.01)
+        self.changes = []
+        self.buttons.add_button(17, self.changes.append)
+        self.tick(0)
+
+    def tick(self, seconds):
+        deadline = time.monotonic() + seconds
+        Clock.tick()
+        while time.monotonic() < deadline:
+            time.sleep(0.005)
+            Clock.tick()
+
+    def test_sets_up_the_pin(self):
+        self.pi.set_pull_up_down.assert_called_once_with(17, pigpio.PUD_UP)
+        self.pi.set_glitch_filter.assert_called_once_with(17, 10000)
+        self.pi.callback.assert_called_once_with(17, pigpio.EITHER_EDGE, self.buttons._on_edge)
+        # the starting state is reported once
+        self.assertEqual(self.changes, [False])
+
+    def test_press_and_release(self):
+        self.buttons._on_edge(17, 0, 0)
+        self.tick(0.05)
+        self.buttons._on_edge(17, 1, 0)
+        self.tick(0.05)
+        self.assertEqual(self.changes, [False, True, False])
+
+    def test_acts_on_the_level_that_settled(self):
+        for level in (0, 1, 0, 1):
+            self.buttons._on_edge(17, level, 0)
+        self.buttons._on_edge(17, pigpio.TIMEOUT, 0)
+        self.tick(0.05)
+        self.assertEqual(self.changes, [False])
+
+    def test_cancel(self):
+        callback = self.pi.callback.return_value
+        self.buttons.cancel()
+        callback.cancel.assert_called_once_with()
@@ -0,0 +1,95 @@
+import contextlib
+import io
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+
+import lamp_service
+from lamp_service import LampService, OFF, hue_distance
+from monitor.lamp_driver import LampDriver, FakePi, PWM_RANGE, RED_GPIO, GREEN_GPIO, BLUE_GPIO
+
+
+class Message(object):
+
+    def __init__(self, payload):
+        self.payload = json.dumps(payload).encode('utf-8')
+
+
+class HueDistanceTest(unittest.TestCase):
+
+    def test_takes_the_short_way_around(self):
+        self.assertAlmostEqual(hue_distance(0.1, 0.3), 0.2)
+        self.assertAlmostEqual(hue_distance(0.95, 0.05), 0.1)
+        self.assertAlmostEqual(hue_distance(0.05, 0.95), -0.1)
+
+
+class LampServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pi = FakePi()
+        self.lamp = LampService(LampDriver(self.pi))
+
+    def test_invisible_changes_are_skipped(self):
+        self.lamp.set_target((0.5, 1.0, 0.5))
+        self.lamp.set_target((0.505, 1.0, 0.5))
+        self.lamp.set_target((0.5, 0.99, 0.51))
+        self.assertEqual((self.lamp.messages, self.lamp.skipped), (3, 2))
+
+        self.lamp.set_target((0.52, 1.0, 0.5))
+        self.assertEqual(self.lamp.skipped, 2)
+
+    def test_hysteresis_wraps_around_the_hue_circle(self):
+        self.lamp.set_target((0.998, 1.0, 0.5))
+        self.lamp.set_target((0.002, 1.0, 0.5))
+        self.assertEqual(self.lamp.skipped, 1)
+
+    def test_off_and_on_are_always_visible(self):
+        self.lamp.set_target(OFF)
+        self.assertEqual(self.lamp.skipped, 1)
+        self.lamp.set_target((0.5, 1.0, 0.001))
+        self.lamp.set_target(OFF)
+        self.assertEqual(self.lamp.skipped, 1)
+
+    def test_set_config(self):
+        self.lamp.on_message_set_config(None, None, Message(
+            { 'color': { 'h': 0.25 }, 'brightness': 0.75 }))
+        self.assertEqual(self.lamp._target, (0.25, 1.0, 0.75))
+
+        self.lamp.on_message_set_config(None, None, Message(
+            { 'color': { 'h': 0.25 }, 'brightness': 0.75, 'on': False }))
+        self.assertEqual(self.lamp._target, OFF)
+
+    def test_invalid_configs_are_ignored(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            for payload in ({ 'brightness': 0.5 }, { 'color': 0.5, 'brightness': 0.5 },
+                            { 'color': { 's': 1.0 }, 'brightness': 0.5 }):
+                self.lamp.on_message_set_config(None, None, Message(payload))
+            self.lamp.on_message_set_config(None, None, mock.Mock(payload=b'{'))
+        self.assertEqual(self.lamp.messages, 0)
+
+    def test_fades_in_from_black_at_the_target_colour(self):
+        start = self.lamp._blend(OFF, (0.25, 0.5, 1.0), 0.5)
+        self.assertEqual(start, (0.25, 0.5, 0.5))
+
+    def test_fades_across_the_short_way_round(self):
+        hue, saturation, brightness = self.lamp._blend((0.9, 1.0, 1.0), (0.1, 1.0, 0.0), 0.5)
+        self.assertAlmostEqual(hue, 0.0)
+        self.assertAlmostEqual(brightness, 0.5)
+
+    @mock.patch.object(lamp_service, 'LAMP_FADE_SECS', 0.1)
+    @mock.patch.object(lamp_service, 'LAMP_FADE_STEPS_PER_SEC', 50)
+    def test_fade_ends_at_the_target(self):
+        thread = threading.Thread(target=self.lamp.run_fades, daemon=True)
+        thread.start()
+        self.lamp.set_target((0.0, 1.0, 0.5))
+
+        deadline = time.monotonic() + 5
+        while self.lamp._rendered != (0.0, 1.0, 0.5) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(self.lamp._rendered, (0.0, 1.0, 0.5))
+        self.assertEqual(self.lamp.fade_steps, 5)
+        self.assertEqual(self.pi.duty_cycles,
+                         { RED_GPIO: PWM_RANGE // 2, GREEN_GPIO: 0, BLUE_GPIO: 0 })
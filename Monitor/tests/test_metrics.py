@@ -0,0 +1,52 @@
+import unittest
+
+from monitor.metrics import Histogram, Metrics
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_counts_into_fixed_buckets(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.snapshot(),
+                         { 'count': 4, 'sum': 3.65,
+                           'buckets': { '0.1': 2, '1.0': 1, '+Inf': 1 } })
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_snapshot(self):
+        metrics = Metrics()
+        with metrics.timer('poll'):
+            pass
+        metrics.increment('device_timeouts')
+        metrics.increment('device_timeouts', 2)
+        metrics.set_gauge('outlets', 4)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['timings']['poll']['count'], 1)
+        self.assertEqual(snapshot['counters'], { 'device_timeouts': 3 })
+        self.assertEqual(snapshot['gauges'], { 'outlets': 4 })
+
+    def test_prometheus_buckets_are_cumulative(self):
+        metrics = Metrics(prefix='test_')
+        metrics.histograms['poll'] = Histogram(buckets=(0.1, 1.0))
+        for seconds in (0.05, 0.5, 3.0):
+            metrics.observe('poll', seconds)
+        metrics.increment('errors')
+        metrics.set_gauge('outlets', 2)
+
+        self.assertEqual(metrics.prometheus_text(), '\n'.join([
+            '# TYPE test_poll_seconds histogram',
+            'test_poll_seconds_bucket{le="0.1"} 1',
+            'test_poll_seconds_bucket{le="1.0"} 2',
+            'test_poll_seconds_bucket{le="+Inf"} 3',
+            'test_poll_seconds_sum 3.55',
+            'test_poll_seconds_count 3',
+            '# TYPE test_errors_total counter',
+            'test_errors_total 1',
+            '# TYPE test_outlets gauge',
+            'test_outlets 2',
+        ]) + '\n')
@@ -0,0 +1,155 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import struct
+import tempfile
+import types
+import unittest
+from datetime import datetime, timezone
+from unittest import mock
+
+import kasa
+
+import monitor_service
+
+
+class FakePlug(object):
+
+    def __init__(self, host, alias, power, total):
+        self.host = host
+        self.alias = alias
+        self.is_on = True
+        self.set_reading(power, total)
+
+    def set_reading(self, power, total):
+        self.emeter_realtime = kasa.EmeterStatus({ 'power': power, 'total': total })
+
+    async def update(self):
+        pass
+
+
+class EchoPlug(object):
+    # talks the real kasa protocol to a local echo server, so the test sees
+    # whatever a timed-out query leaves on the socket
+
+    def __init__(self, port):
+        self.host = '127.0.0.1'
+        self.protocol = kasa.TPLinkSmartHomeProtocol(self.host, port=port)
+        self.polls = 0
+        self.response = None
+
+    async def update(self):
+        self.polls += 1
+        self.response = await self.protocol.query({ 'poll': self.polls })
+
+
+class MonitorServiceTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.TemporaryDirectory()
+        for name in ('OUTLET_INVENTORY_FILENAME', 'SAMPLE_BUFFER_FILENAME',
+                     'SPOOL_FILENAME', 'AVERAGE_PROFILE_FILENAME'):
+            filename = os.path.join(self.state_dir.name,
+                                    os.path.basename(getattr(monitor_service, name)))
+            patcher = mock.patch.object(monitor_service, name, filename)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.service = monitor_service.MonitorService()
+
+    def tearDown(self):
+        self.state_dir.cleanup()
+
+    async def poll_at(self, when):
+        class FixedDateTime(datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return when
+
+        with mock.patch.object(monitor_service, 'datetime', FixedDateTime), \
+                contextlib.redirect_stdout(io.StringIO()):
+            await self.service.poll_usage_data()
+
+    async def test_hour_boundary_splits_the_energy(self):
+        self.service._spool_wakeup = asyncio.Event()
+        plug = FakePlug('10.0.0.1', 'lamp', 60.0, 1.0)
+        self.service.outlets = { plug.host: plug }
+        self.service.last_poll = datetime(2026, 1, 1, 10, 58, tzinfo=timezone.utc)
+        await self.poll_at(datetime(2026, 1, 1, 10, 58, tzinfo=timezone.utc))
+
+        # 120 Wh over four minutes, half of them before 11:00
+        plug.set_reading(60.0, 1.12)
+        await self.poll_at(datetime(2026, 1, 1, 11, 2, tzinfo=timezone.utc))
+
+        (_, last_hour), = self.service.spool.pending()
+        self.assertEqual(last_hour['key'], '2026-01-01T10:00:00+00:00')
+        self.assertAlmostEqual(last_hour['wattage'], 60.0)
+        self.assertAlmostEqual(last_hour['outlets']['lamp'], 60.0)
+        self.assertAlmostEqual(self.service.hour_wattage, 60.0)
+        self.assertAlmostEqual(self.service.hour_outlet_wattage['lamp'], 60.0)
+
+    async def test_counter_reset_counts_the_new_total(self):
+        self.service._spool_wakeup = asyncio.Event()
+        plug = FakePlug('10.0.0.1', 'lamp', 60.0, 5.0)
+        self.service.outlets = { plug.host: plug }
+        self.service.last_poll = datetime(2026, 1, 1, 10, 0, tzinfo=timezone.utc)
+        await self.poll_at(datetime(2026, 1, 1, 10, 0, tzinfo=timezone.utc))
+
+        plug.set_reading(60.0, 0.002)
+        await self.poll_at(datetime(2026, 1, 1, 10, 1, tzinfo=timezone.utc))
+        self.assertAlmostEqual(self.service.hour_wattage, 2.0)
+
+    def test_invalid_set_enabled_payloads_are_dropped(self):
+        loop = mock.Mock()
+        self.service._loop = loop
+        with contextlib.redirect_stdout(io.StringIO()):
+            for payload in (b'[]', b'"x"', b'{"outlets": 1}', b'{"outlets": {"lamp": "on"}}',
+                            b'not json', b'\xff'):
+                self.service.on_message_set_enabled(
+                    None, None, types.SimpleNamespace(payload=payload))
+        loop.call_soon_threadsafe.assert_not_called()
+
+        self.service.on_message_set_enabled(
+            None, None, types.SimpleNamespace(payload=b'{"outlets": {"lamp": false}}'))
+        loop.call_soon_threadsafe.assert_called_once_with(
+            self.service.schedule_enable, 'lamp', False)
+
+    def test_invalid_average_profiles_are_ignored(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            for payload in (b'[]', b'3', b'{"hour": 3.0, "wattage": 1.0}',
+                            b'{"hour": 3, "wattage": "x"}', b'not json'):
+                self.service.on_message_average(
+                    None, None, types.SimpleNamespace(payload=payload))
+        self.assertEqual(self.service.averages.hours, [0] * 24)
+
+        self.service.on_message_average(
+            None, None, types.SimpleNamespace(payload=b'{"hour": 3, "wattage": 1.5}'))
+        self.assertEqual(self.service.averages.average(3), 1.5)
+
+    async def echo(self, reader, writer):
+        while True:
+            try:
+                length, = struct.unpack('>I', await reader.readexactly(4))
+                request = kasa.TPLinkSmartHomeProtocol.decrypt(await reader.readexactly(length))
+            except (asyncio.IncompleteReadError, ConnectionError):
+                writer.close()
+                return
+            if json.loads(request)['poll'] == 1:
+                # answer the first poll too late
+                await asyncio.sleep(0.2)
+            writer.write(kasa.TPLinkSmartHomeProtocol.encrypt(request))
+
+    async def test_timed_out_update_doesnt_leave_its_reply_behind(self):
+        server = await asyncio.start_server(self.echo, '127.0.0.1', 0)
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        plug = EchoPlug(server.sockets[0].getsockname()[1])
+        self.addAsyncCleanup(plug.protocol.close)
+
+        with mock.patch.object(monitor_service, 'POLL_DEVICE_TIMEOUT_SECS', 0.05), \
+                contextlib.redirect_stdout(io.StringIO()):
+            self.assertFalse(await self.service._update_device(plug))
+            await asyncio.sleep(0.3)
+            self.assertTrue(await self.service._update_device(plug))
+        self.assertEqual(plug.response, { 'poll': 2 })
@@ -0,0 +1,51 @@
+import os
+import threading
+import types
+import unittest
+
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+os.environ.setdefault('KIVY_LOG_MODE', 'PYTHON')
+
+from monitor.monitor_ui import MonitorApp
+
+
+class MonitorAppStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = MonitorApp()
+        # what on_start sets up, without the broker and the GPIOs
+        self.app._state_lock = threading.Lock()
+        self.app._pending_state = {}
+        self.app._apply_state_trigger = lambda: None
+        self.dispatched = []
+        for name in ('outlets', 'wattage', 'difference', 'diff_color', 'diff_text'):
+            self.app.bind(**{ name: lambda instance, value, name=name:
+                              self.dispatched.append(name) })
+
+    def receive(self, payload):
+        self.app.receive_new_state(None, None, types.SimpleNamespace(payload=payload.encode()))
+
+    def test_a_frame_is_applied_as_one_update(self):
+        self.receive('{"outlets": {"lamp": {"enabled": true, "wattage": 10}}, "wattage": 10,'
+                     ' "difference": 2, "diff_color": [0.1, 1.0, 0.5]}')
+        self.receive('{"keyframe": false, "wattage": 12, "difference": -3,'
+                     ' "diff_color": [0.0, 1.0, 0.5]}')
+        self.app._apply_pending_state(0)
+
+        # diff_text depends on both difference and diff_color, yet updates once
+        self.assertEqual(sorted(self.dispatched),
+                         ['diff_color', 'diff_text', 'difference', 'outlets', 'wattage'])
+        self.assertEqual(self.app.wattage, 12)
+        self.assertEqual(self.app.outlets, { 'lamp': { 'enabled': True, 'wattage': 10 } })
+        self.assertIn('- 3.00 W', self.app.diff_text)
+
+    def test_unchanged_state_dispatches_nothing(self):
+        self.receive('{"outlets": {"lamp": {"enabled": true, "wattage": 10}}, "wattage": 10,'
+                     ' "difference": 2, "diff_color": [0.1, 1.0, 0.5]}')
+        self.app._apply_pending_state(0)
+        del self.dispatched[:]
+
+        self.receive('{"keyframe": false, "outlets": {"lamp": {"enabled": true, "wattage": 10}},'
+                     ' "wattage": 10}')
+        self.app._apply_pending_state(0)
+        self.assertEqual(self.dispatched, [])
@@ -0,0 +1,50 @@
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+
+import kasa
+
+from monitor.outlet_inventory import OutletInventory
+
+
+class OutletInventoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.state_dir.name, 'monitor', 'outlets.json')
+        self.inventory = OutletInventory(self.filename)
+
+    def tearDown(self):
+        self.state_dir.cleanup()
+
+    def test_nothing_saved_yet(self):
+        self.assertEqual(self.inventory.load(), {})
+
+    def test_round_trips_hosts_and_device_classes(self):
+        self.inventory.save({ '10.0.0.1': kasa.SmartPlug('10.0.0.1'),
+                              '10.0.0.2': kasa.SmartStrip('10.0.0.2') })
+
+        outlets = OutletInventory(self.filename).load()
+        self.assertEqual(sorted(outlets), ['10.0.0.1', '10.0.0.2'])
+        self.assertIs(type(outlets['10.0.0.1']), kasa.SmartPlug)
+        self.assertIs(type(outlets['10.0.0.2']), kasa.SmartStrip)
+        self.assertEqual(outlets['10.0.0.2'].host, '10.0.0.2')
+
+    def test_unknown_device_types_are_skipped(self):
+        os.makedirs(os.path.dirname(self.filename))
+        with open(self.filename, 'w') as f:
+            json.dump({ '10.0.0.1': 'SmartPlug', '10.0.0.2': 'Discover',
+                        '10.0.0.3': 'NoSuchDevice' }, f)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            outlets = self.inventory.load()
+        self.assertEqual(list(outlets), ['10.0.0.1'])
+
+    def test_damaged_file_is_ignored(self):
+        os.makedirs(os.path.dirname(self.filename))
+        with open(self.filename, 'w') as f:
+            f.write('{"10.0.0.1": ')
+        self.assertEqual(self.inventory.load(), {})
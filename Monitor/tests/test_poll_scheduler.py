@@ -0,0 +1,59 @@
+import asyncio
+import time
+import unittest
+
+from monitor.poll_scheduler import PollScheduler
+
+
+class PollSchedulerTest(unittest.IsolatedAsyncioTestCase):
+
+    def test_backs_off_while_steady(self):
+        scheduler = PollScheduler(3, 30, 5, backoff=2)
+        scheduler.observe(100)
+        self.assertEqual(scheduler.interval, 3)
+        for expected in (6, 12, 24, 30, 30):
+            scheduler.observe(101)
+            self.assertEqual(scheduler.interval, expected)
+
+    def test_change_drops_to_the_minimum(self):
+        scheduler = PollScheduler(3, 30, 5, backoff=2)
+        for wattage in (100, 101, 102, 103):
+            scheduler.observe(wattage)
+        self.assertEqual(scheduler.interval, 24)
+
+        # drift is measured from the reference reading, not the last one
+        scheduler.observe(105)
+        self.assertEqual(scheduler.interval, 3)
+
+    def test_poke_resets_the_interval(self):
+        scheduler = PollScheduler(3, 30, 5)
+        scheduler.interval = 30
+        scheduler.poke()
+        self.assertEqual(scheduler.interval, 3)
+
+    async def test_deadlines_absorb_the_cycle_time(self):
+        scheduler = PollScheduler(0.1, 0.1, 5)
+        await scheduler.wait()
+        start = time.monotonic()
+        for _ in range(3):
+            # a cycle taking half the period doesn't stretch it
+            await asyncio.sleep(0.05)
+            await scheduler.wait()
+        self.assertAlmostEqual(time.monotonic() - start, 0.3, delta=0.05)
+        self.assertEqual(scheduler.overruns, 0)
+
+    async def test_overrun_skips_ahead(self):
+        scheduler = PollScheduler(0.05, 0.05, 5)
+        await scheduler.wait()
+        await asyncio.sleep(0.2)
+        start = time.monotonic()
+        await scheduler.wait()
+        self.assertLess(time.monotonic() - start, 0.03)
+        self.assertEqual(scheduler.overruns, 1)
+
+    async def test_poke_wakes_a_waiting_loop(self):
+        scheduler = PollScheduler(10, 10, 5)
+        asyncio.get_running_loop().call_later(0.05, scheduler.poke)
+        start = time.monotonic()
+        await scheduler.wait()
+        self.assertLess(time.monotonic() - start, 1)
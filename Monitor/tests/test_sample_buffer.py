@@ -0,0 +1,111 @@
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+from monitor.sample_buffer import SampleBuffer
+
+
+def statuses(**wattages):
+    return { alias: { 'enabled': wattage > 0, 'wattage': wattage }
+             for alias, wattage in wattages.items() }
+
+
+class SampleBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.state_dir.name, 'samples.bin')
+
+    def tearDown(self):
+        self.state_dir.cleanup()
+
+    def test_window_stats(self):
+        samples = SampleBuffer(10, 4)
+        for second, wattage in enumerate([10.0, 0.0, 20.0]):
+            samples.append(statuses(lamp=wattage), timestamp=1000 + second)
+
+        stats = samples.window_stats('lamp', 1, now=1003)
+        self.assertEqual(stats['samples'], 3)
+        self.assertEqual(stats['min'], 0.0)
+        self.assertEqual(stats['max'], 20.0)
+        self.assertEqual(stats['mean'], 10.0)
+        self.assertAlmostEqual(stats['on_fraction'], 2 / 3)
+
+    def test_window_excludes_older_samples(self):
+        samples = SampleBuffer(10, 4)
+        samples.append(statuses(lamp=100.0), timestamp=0)
+        samples.append(statuses(lamp=10.0), timestamp=500)
+
+        stats = samples.window_stats('lamp', 5, now=600)
+        self.assertEqual(stats['samples'], 1)
+        self.assertEqual(stats['max'], 10.0)
+
+    def test_unknown_outlet_has_no_stats(self):
+        samples = SampleBuffer(10, 4)
+        samples.append(statuses(lamp=10.0), timestamp=0)
+        self.assertIsNone(samples.window_stats('fan', 5, now=0))
+
+    def test_wraps_around_keeping_newest(self):
+        samples = SampleBuffer(3, 4)
+        for second in range(5):
+            samples.append(statuses(lamp=float(second)), timestamp=1000 + second)
+
+        self.assertEqual(len(samples), 3)
+        stats = samples.window_stats('lamp', 1, now=1005)
+        self.assertEqual(stats['samples'], 3)
+        self.assertEqual((stats['min'], stats['max']), (2.0, 4.0))
+
+    def test_reloads_from_file(self):
+        samples = SampleBuffer(3, 4, filename=self.filename)
+        for second in range(5):
+            samples.append(statuses(lamp=float(second), fan=1.0),
+                           timestamp=1000 + second)
+        samples.flush()
+
+        reloaded = SampleBuffer(3, 4, filename=self.filename)
+        self.assertEqual(len(reloaded), 3)
+        self.assertEqual(reloaded.window_stats('lamp', 1, now=1005),
+                         samples.window_stats('lamp', 1, now=1005))
+        self.assertEqual(reloaded.window_stats('fan', 1, now=1005)['mean'], 1.0)
+
+        # and keeps writing where it left off
+        reloaded.append(statuses(lamp=9.0), timestamp=1005)
+        self.assertEqual(reloaded.window_stats('lamp', 1, now=1006)['max'], 9.0)
+
+    def test_layout_change_starts_over(self):
+        samples = SampleBuffer(3, 4, filename=self.filename)
+        samples.append(statuses(lamp=1.0), timestamp=1000)
+        samples.flush()
+
+        resized = SampleBuffer(5, 4, filename=self.filename)
+        self.assertEqual(len(resized), 0)
+        self.assertIsNone(resized.window_stats('lamp', 1, now=1000))
+
+    def test_outlets_past_max_are_dropped(self):
+        samples = SampleBuffer(3, 2)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            samples.append(statuses(lamp=1.0, fan=2.0, heater=3.0), timestamp=1000)
+            samples.append(statuses(lamp=1.0, fan=2.0, heater=3.0), timestamp=1001)
+        # warned about, once
+        self.assertEqual(output.getvalue().count('heater'), 1)
+        self.assertIsNotNone(samples.window_stats('lamp', 1, now=1000))
+        self.assertIsNotNone(samples.window_stats('fan', 1, now=1000))
+        self.assertIsNone(samples.window_stats('heater', 1, now=1000))
+
+    def test_retain_frees_columns_for_new_outlets(self):
+        samples = SampleBuffer(3, 2, filename=self.filename)
+        samples.append(statuses(lamp=1.0, fan=2.0), timestamp=1000)
+
+        samples.retain({'lamp'})
+        samples.append(statuses(lamp=1.0, heater=3.0), timestamp=1001)
+
+        self.assertIsNone(samples.window_stats('fan', 1, now=1001))
+        # the freed column was cleared, so the heater doesn't inherit the fan's history
+        heater = samples.window_stats('heater', 1, now=1001)
+        self.assertEqual((heater['min'], heater['max']), (0.0, 3.0))
+        # the new mapping is saved with the buffer
+        samples.flush()
+        reloaded = SampleBuffer(3, 2, filename=self.filename)
+        self.assertEqual(reloaded.window_stats('heater', 1, now=1001), heater)
@@ -0,0 +1,66 @@
+import json
+import unittest
+
+from monitor.usage_encoder import UsageDeltaEncoder
+
+
+def usage(**wattages):
+    outlets = { alias: { 'enabled': True, 'wattage': wattage }
+                for alias, wattage in wattages.items() }
+    return { 'wattage': sum(wattages.values()), 'outlets': outlets }
+
+
+class UsageDeltaEncoderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.encoder = UsageDeltaEncoder(outlet_deadband=0.5, total_deadband=1.0,
+                                         keyframe_interval=60)
+
+    def decode(self, encoded):
+        payload, retain = encoded
+        return json.loads(payload), retain
+
+    def test_first_message_is_a_retained_keyframe(self):
+        message, retain = self.decode(self.encoder.encode(usage(lamp=10, fan=20), 0))
+        self.assertTrue(retain)
+        self.assertTrue(message['keyframe'])
+        self.assertEqual(set(message['outlets']), {'lamp', 'fan'})
+
+    def test_changes_within_the_deadband_are_suppressed(self):
+        self.encoder.encode(usage(lamp=10, fan=20), 0)
+        self.assertIsNone(self.encoder.encode(usage(lamp=10.2, fan=20.2), 1))
+        self.assertEqual(self.encoder.stats()['messages_suppressed'], 1)
+
+    def test_delta_carries_only_changed_outlets(self):
+        self.encoder.encode(usage(lamp=10, fan=20), 0)
+        message, retain = self.decode(self.encoder.encode(usage(lamp=10, fan=25), 1))
+        self.assertFalse(retain)
+        self.assertFalse(message['keyframe'])
+        self.assertEqual(message['outlets'], { 'fan': { 'enabled': True, 'wattage': 25 } })
+        self.assertEqual(message['wattage'], 35)
+
+    def test_small_changes_add_up_against_the_last_sent_value(self):
+        self.encoder.encode(usage(lamp=10), 0)
+        self.assertIsNone(self.encoder.encode(usage(lamp=10.3), 1))
+        message, _ = self.decode(self.encoder.encode(usage(lamp=10.6), 2))
+        self.assertEqual(message['outlets']['lamp']['wattage'], 10.6)
+
+    def test_switching_an_outlet_is_sent(self):
+        self.encoder.encode(usage(lamp=0), 0)
+        switched = usage(lamp=0)
+        switched['outlets']['lamp']['enabled'] = False
+        message, _ = self.decode(self.encoder.encode(switched, 1))
+        self.assertFalse(message['outlets']['lamp']['enabled'])
+
+    def test_keyframe_when_the_outlets_change(self):
+        self.encoder.encode(usage(lamp=10), 0)
+        message, retain = self.decode(self.encoder.encode(usage(lamp=10, fan=5), 1))
+        self.assertTrue(retain)
+        self.assertTrue(message['keyframe'])
+
+    def test_keyframe_every_interval(self):
+        self.encoder.encode(usage(lamp=10), 0)
+        self.assertIsNone(self.encoder.encode(usage(lamp=10), 59))
+        message, retain = self.decode(self.encoder.encode(usage(lamp=10), 60))
+        self.assertTrue(retain)
+        self.assertTrue(message['keyframe'])
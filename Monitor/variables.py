@@ -1,3 +1,4 @@
+import os
 import paho.mqtt.client
 
 DEVICE_ID_FILENAME = '/sys/class/net/eth0/address'
@@ -8,6 +9,7 @@ TOPIC_HOUR_USAGE = "monitor/usage/last_hour"
 TOPIC_HOUR_AVERAGE = "monitor/average"
 TOPIC_ENABLE_OUTLETS = "monitor/set_enabled"
 TOPIC_LAMP_CONFIG = "lamp/set_config"
+TOPIC_METRICS = "monitor/metrics"
 
 def get_device_id():
     mac_addr = open(DEVICE_ID_FILENAME).read().strip()
@@ -28,3 +30,64 @@ MQTT_VERSION = paho.mqtt.client.MQTTv311
 MQTT_BROKER_HOST = "localhost"
 MQTT_BROKER_PORT = 1883
 MQTT_BROKER_KEEP_ALIVE_SECS = 60
+
+# Outlet polling; the poll period adapts between the min and max intervals
+POLL_INTERVAL_MIN_SECS = 3
+POLL_INTERVAL_MAX_SECS = 30
+POLL_INTERVAL_BACKOFF = 1.5
+POLL_CHANGE_THRESHOLD_WATTS = 5
+POLL_CONCURRENTLY = True
+# cap on device updates in flight at once; None polls every outlet at once,
+# which keeps the cycle as long as the slowest plug (at most the timeout)
+POLL_MAX_CONCURRENCY = None
+POLL_DEVICE_TIMEOUT_SECS = 2.0
+
+# Energy accounting: 'counter' uses the plugs' cumulative emeter totals,
+# 'rectangle' integrates the instantaneous power between polls
+ENERGY_ACCOUNTING = 'counter'
+
+# Outlet commands
+COMMAND_TIMEOUT_SECS = 2.0
+
+# Outlet discovery
+DISCOVERY_INTERVAL_SECS = 30
+DISCOVERY_PROBE_TIMEOUT_SECS = 3
+OUTLET_INVENTORY_FILENAME = os.path.expanduser('~/.monitor/outlets.json')
+
+# On-device sample history (one sample per poll); set the filename to None
+# to keep the history in memory only
+SAMPLE_BUFFER_CAPACITY = 3600
+SAMPLE_BUFFER_MAX_OUTLETS = 32
+SAMPLE_BUFFER_FILENAME = os.path.expanduser('~/.monitor/samples.bin')
+
+# Hourly usage spool, replayed while the bridge to the cloud broker is up
+SPOOL_FILENAME = os.path.expanduser('~/.monitor/usage_spool.jsonl')
+SPOOL_REPLAY_BATCH_SIZE = 24
+SPOOL_REPLAY_INTERVAL_SECS = 5
+SPOOL_PUBLISH_TIMEOUT_SECS = 10
+
+# Last hourly average profile received from the backend
+AVERAGE_PROFILE_FILENAME = os.path.expanduser('~/.monitor/averages.json')
+
+# monitor/usage publishing: a retained full keyframe every
+# USAGE_KEYFRAME_INTERVAL_SECS, and only outlets that moved past the deadband
+# in between
+USAGE_DELTA_PUBLISHING = True
+USAGE_OUTLET_DEADBAND_WATTS = 0.5
+USAGE_TOTAL_DEADBAND_WATTS = 1.0
+USAGE_KEYFRAME_INTERVAL_SECS = 60
+
+# Service metrics, published retained on TOPIC_METRICS; set the port to serve
+# them in the Prometheus text format over HTTP as well
+METRICS_INTERVAL_SECS = 60
+METRICS_HTTP_PORT = None
+
+# Lamp: color changes smaller than the hysteresis are ignored, the rest fade
+# in over LAMP_FADE_SECS; unchanged lamp configs are re-sent at most every
+# LAMP_CONFIG_REFRESH_SECS
+LAMP_HUE_HYSTERESIS = 0.01
+LAMP_SATURATION_HYSTERESIS = 0.02
+LAMP_BRIGHTNESS_HYSTERESIS = 0.02
+LAMP_FADE_SECS = 0.5
+LAMP_FADE_STEPS_PER_SEC = 50
+LAMP_CONFIG_REFRESH_SECS = 60
@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import Monitor
+from .models import Monitor, HourlyUsage
 
 # Register your models here.
 admin.site.register(Monitor)
+admin.site.register(HourlyUsage)
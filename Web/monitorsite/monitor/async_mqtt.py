@@ -0,0 +1,215 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import paho.mqtt.client as mqtt
+
+
+def shared_topic(topic_filter, group):
+    return f'$share/{group}/{topic_filter}'
+
+
+class _Handler(object):
+
+    def __init__(self, callback, concurrency, timeout, max_pending, key):
+        self.callback = callback
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.key = key
+        # keyed handlers get one queue per consumer, so messages with the same
+        # key are handled one at a time and in order; otherwise the consumers
+        # share a queue
+        self.queues = [asyncio.Queue() for _ in range(concurrency if key else 1)]
+        self.pending = 0
+        self.handled = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def consumer_queues(self):
+        if self.key is None:
+            return self.queues * self.concurrency
+        return self.queues
+
+    def queue_for(self, message):
+        if self.key is None:
+            return self.queues[0]
+        return self.queues[hash(self.key(message)) % len(self.queues)]
+
+    def stats(self):
+        return { 'pending': self.pending,
+                 'handled': self.handled,
+                 'timeouts': self.timeouts,
+                 'errors': self.errors }
+
+
+class AsyncMQTTClient(object):
+    # A paho client driven by the asyncio event loop instead of a network
+    # thread of its own: socket readiness callbacks do the reads and writes,
+    # so paho's callbacks all run on the loop. Each topic filter is routed to
+    # an async handler with a fixed number of consumers and a timeout per
+    # message. When a handler has max_pending messages waiting, the client
+    # stops reading from the socket until it catches up, which pushes back on
+    # the broker rather than queueing without bound.
+    #
+    # Add handlers before run(); run() connects, reconnects after a lost
+    # connection, and disconnects when it's cancelled. Connecting (name
+    # lookup and TCP connect) blocks, so it happens on a thread of its own
+    # rather than stalling everything else on the loop.
+
+    def __init__(self, host, port, keepalive=60, reconnect_delay=5):
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.reconnect_delay = reconnect_delay
+        self.client = mqtt.Client()
+        self.client.on_connect = self._on_connect
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
+        self.client.on_socket_unregister_write = self._on_socket_unregister_write
+        self._handlers = {}
+        self._subscriptions = {}
+        self._loop = None
+        self._loop_thread = None
+        self._connector = ThreadPoolExecutor(1, thread_name_prefix='mqtt-connect')
+        self._sock = None
+        self._paused = False
+
+    def add_handler(self, topic_filter, callback, concurrency=1, timeout=10,
+                    max_pending=1000, key=None, subscribe=True, share_group=None):
+        # callback(message) is a coroutine function; key(message), if given,
+        # names the stream whose messages must be handled in order. With a
+        # share_group the broker spreads the messages over the group's clients
+        # instead of sending each of them every message.
+        handler = _Handler(callback, concurrency, timeout, max_pending, key)
+        self._handlers[topic_filter] = handler
+        self.client.message_callback_add(
+            topic_filter,
+            lambda client, userdata, message: self._on_message(handler, message))
+        if subscribe:
+            self.subscribe(topic_filter if share_group is None
+                           else shared_topic(topic_filter, share_group))
+
+    def subscribe(self, topic_filter, qos=1):
+        self._subscriptions[topic_filter] = qos
+        if self.client.is_connected():
+            self.client.subscribe(topic_filter, qos)
+
+    def unsubscribe(self, topic_filter):
+        self._subscriptions.pop(topic_filter, None)
+        if self.client.is_connected():
+            self.client.unsubscribe(topic_filter)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != mqtt.CONNACK_ACCEPTED:
+            print(f"MQTT connection refused: {mqtt.connack_string(rc)}")
+            return
+        for topic_filter, qos in self._subscriptions.items():
+            client.subscribe(topic_filter, qos)
+
+    def _on_loop(self, function, *args):
+        # paho calls the socket callbacks on the connecting thread too; the
+        # loop's readers and writers may only be changed from the loop
+        if threading.get_ident() == self._loop_thread:
+            function(*args)
+        else:
+            self._loop.call_soon_threadsafe(function, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._on_loop(self._open_socket, sock)
+
+    def _open_socket(self, sock):
+        self._sock = sock
+        if not self._paused:
+            self._loop.add_reader(sock, self.client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._on_loop(self._close_socket, sock)
+
+    def _close_socket(self, sock):
+        self._loop.remove_reader(sock)
+        if self._sock is sock:
+            self._sock = None
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._on_loop(self._loop.add_writer, sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._on_loop(self._loop.remove_writer, sock)
+
+    def _on_message(self, handler, message):
+        handler.pending += 1
+        handler.queue_for(message).put_nowait(message)
+        if handler.pending >= handler.max_pending and not self._paused:
+            self._paused = True
+            if self._sock is not None:
+                self._loop.remove_reader(self._sock)
+
+    def _resume_if_drained(self):
+        if self._paused and all(handler.pending < handler.max_pending
+                                for handler in self._handlers.values()):
+            self._paused = False
+            if self._sock is not None:
+                self._loop.add_reader(self._sock, self.client.loop_read)
+
+    async def _consume(self, topic_filter, handler, queue):
+        while True:
+            message = await queue.get()
+            try:
+                await asyncio.wait_for(handler.callback(message), handler.timeout)
+                handler.handled += 1
+            except asyncio.TimeoutError:
+                # work already handed to a thread still runs to completion,
+                # but the consumer moves on
+                handler.timeouts += 1
+                print(f"Timed out handling {message.topic}")
+            except Exception as e:
+                handler.errors += 1
+                print(f"Failed to handle {message.topic} ({topic_filter}): {e!r}")
+            finally:
+                handler.pending -= 1
+                self._resume_if_drained()
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        consumers = []
+        for topic_filter, handler in self._handlers.items():
+            for queue in handler.consumer_queues():
+                consumers.append(asyncio.create_task(
+                    self._consume(topic_filter, handler, queue)))
+
+        first = True
+        try:
+            while True:
+                try:
+                    # bounded by paho's connect timeout
+                    if first:
+                        await self._loop.run_in_executor(
+                            self._connector, self.client.connect,
+                            self.host, self.port, self.keepalive)
+                        first = False
+                    else:
+                        await self._loop.run_in_executor(
+                            self._connector, self.client.reconnect)
+                except OSError as e:
+                    print(f"MQTT connection failed: {e}")
+                    await asyncio.sleep(self.reconnect_delay)
+                    continue
+
+                # keepalives and retries; fails once the connection is gone
+                while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+                    await asyncio.sleep(1)
+                print("MQTT connection lost, reconnecting")
+                await asyncio.sleep(self.reconnect_delay)
+        finally:
+            for consumer in consumers:
+                consumer.cancel()
+            if self.client.is_connected():
+                self.client.disconnect()
+                self.client.loop_write()
+            self._connector.shutdown(wait=False)
+
+    def stats(self):
+        return { topic_filter: handler.stats()
+                 for topic_filter, handler in self._handlers.items() }
@@ -0,0 +1,41 @@
+import asyncio
+from .models import Monitor, publish_averages
+
+
+def averages_page(after, limit):
+    # the next page of (device_id, averages) for associated monitors; keyset
+    # paging keeps each query cheap however far into the fleet we are
+    return list(Monitor.objects.associated()
+                .filter(device_id__gt=after)
+                .order_by('device_id')
+                .values_list('device_id', 'averages')[:limit])
+
+
+async def publish_fleet_averages(run_orm, jitter_window, chunk_size):
+    # Republishes every associated device's average profile, evenly spaced
+    # over jitter_window seconds so the broker sees a steady trickle rather
+    # than a burst. The database sees one count and one query per chunk_size
+    # devices. run_orm(function, *args) runs blocking ORM work off the event
+    # loop. Returns the number of profiles published.
+    loop = asyncio.get_running_loop()
+    total = await run_orm(Monitor.objects.associated().count)
+    if total == 0:
+        return 0
+    spacing = jitter_window / total
+    start = loop.time()
+
+    published = 0
+    after = ''
+    while True:
+        page = await run_orm(averages_page, after, chunk_size)
+        for device_id, averages in page:
+            delay = start + published * spacing - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # queued on the process's one publisher connection, which
+            # pipelines the QoS 1 handshakes
+            publish_averages(device_id, averages)
+            published += 1
+        if len(page) < chunk_size:
+            return published
+        after = page[-1][0]
@@ -0,0 +1,192 @@
+import math
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.db import transaction, close_old_connections, InterfaceError, OperationalError
+from django.utils import timezone
+from .models import Monitor, HourlyUsage, publish_averages
+from .rollups import update_rollups
+
+
+def usage_hour(last_hour, received_at):
+    # the UTC hour a last_hour message covers; older devices only send the hour of day
+    if 'key' in last_hour:
+        return datetime.fromisoformat(last_hour['key'])
+    hour = received_at.replace(hour=last_hour['hour'], minute=0, second=0,
+                               microsecond=0)
+    if hour > received_at:
+        hour -= timedelta(days=1)
+    return hour
+
+
+def hourly_reading(device_id, last_hour, received_at):
+    # the (device_id, hour, wattage, outlets) reading of a last_hour message,
+    # or None if the message isn't one a device would send: a single bad
+    # value must not fail the batch it would be ingested with
+    if not isinstance(last_hour, dict):
+        return None
+    hour, wattage = last_hour.get('hour'), last_hour.get('wattage')
+    if type(hour) is not int or not 0 <= hour < 24:
+        return None
+    if type(wattage) not in (int, float) or not math.isfinite(wattage):
+        return None
+    outlets = last_hour.get('outlets')
+    if outlets is not None and not isinstance(outlets, dict):
+        return None
+    try:
+        usage_start = usage_hour(last_hour, received_at)
+    except (TypeError, ValueError):
+        return None
+    if usage_start.tzinfo is None:
+        return None
+    return (device_id, usage_start, float(wattage), outlets)
+
+
+def ingest_hourly_usage(readings):
+    # readings: [(device_id, hour, wattage, outlets), ...] for any number of
+    # devices. Stores the readings we haven't seen before and folds them into
+    # the monitors' averages and usage rollups in a few statements, however
+    # many devices the batch covers. Replayed readings are ignored, so
+    # ingesting is idempotent, also when workers sharing the subscription
+    # get readings of the same device at once. Devices whose averages changed are sent their
+    # new profile once the batch is committed. Returns the newly stored
+    # HourlyUsage rows.
+    latest = {}
+    # older readings may already have been compacted away, and would be
+    # counted in the rollups twice if they were replayed
+    horizon = timezone.now() - timedelta(days=settings.USAGE_RAW_RETENTION_DAYS)
+    for device_id, hour, wattage, outlets in readings:
+        if hour < horizon:
+            print(f"Ignoring hourly usage for {device_id} from {hour}, past retention")
+            continue
+        latest[(device_id, hour)] = HourlyUsage(monitor_id=device_id, hour=hour,
+                                                wattage=wattage, outlets=outlets)
+    if not latest:
+        return []
+
+    with transaction.atomic():
+        device_ids = {device_id for device_id, _ in latest}
+        # lock the monitors, in a fixed order so concurrent batches can't
+        # deadlock: a device's readings are then ingested one batch at a
+        # time, and a replay ingested by another worker is seen as existing
+        known = dict(Monitor.objects.select_for_update().filter(pk__in=device_ids)
+                     .order_by('pk').values_list('pk', 'user_id'))
+        for device_id in device_ids - known.keys():
+            print(f"Ignoring hourly usage for unknown device {device_id}")
+
+        existing = set(HourlyUsage.objects.filter(
+            monitor_id__in=known.keys(),
+            hour__in={hour for _, hour in latest}).values_list('monitor_id', 'hour'))
+        new_rows = [row for key, row in latest.items()
+                    if row.monitor_id in known and key not in existing]
+        HourlyUsage.objects.bulk_create(new_rows, ignore_conflicts=True)
+
+        averages = Monitor.objects.update_averages(
+            (row.monitor_id, row.hour.hour, row.wattage)
+            for row in sorted(new_rows, key=lambda row: row.hour))
+        update_rollups(new_rows, known)
+
+    for device_id, device_averages in averages.items():
+        publish_averages(device_id, device_averages)
+    return new_rows
+
+
+class IngestWorker(object):
+    # Drains hourly readings from a bounded queue on its own thread and
+    # ingests them in micro-batches, so the MQTT network thread never waits
+    # on the database. A batch closes when it reaches batch_size or when
+    # batch_window seconds have passed since its first reading.
+
+    _STOP = object()
+
+    def __init__(self, maxsize, batch_size, batch_window):
+        self.queue = queue.Queue(maxsize)
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.enqueued = 0
+        self.ingested = 0
+        self.failed = 0
+        self.batches = 0
+        self.full_waits = 0
+        self.max_depth = 0
+        self._thread = threading.Thread(target=self._run, name='ingest-worker',
+                                        daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def put(self, reading, block=True):
+        # returns False, without queueing, if the queue is full and block is False
+        try:
+            self.queue.put_nowait(reading)
+        except queue.Full:
+            if not block:
+                return False
+            # backpressure: hold the caller (and so the broker's inflight
+            # window) until the worker catches up rather than drop data
+            self.full_waits += 1
+            self.queue.put(reading)
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.batch_window
+        while batch[-1] is not self._STOP and len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0
+                             else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = self._next_batch()
+            if batch[-1] is self._STOP:
+                stopping = True
+                batch.pop()
+            if batch:
+                self.batches += 1
+                self._ingest(batch)
+
+    def _ingest(self, batch):
+        for attempt in range(2):
+            # the daemon runs for months; don't trust a connection the server may have dropped
+            close_old_connections()
+            try:
+                ingest_hourly_usage(batch)
+                self.ingested += len(batch)
+                return
+            except (InterfaceError, OperationalError) as e:
+                print(f"Database unavailable ingesting {len(batch)} reading(s): {e}")
+            except Exception as e:
+                if len(batch) == 1:
+                    print(f"Failed to ingest {batch[0]}: {e}")
+                    break
+                # one bad reading fails the whole batch; ingest the readings
+                # one at a time so it only costs itself
+                print(f"Failed to ingest {len(batch)} reading(s), retrying one at a time: {e}")
+                for reading in batch:
+                    self._ingest([reading])
+                return
+        self.failed += len(batch)
+
+    def stop(self, timeout=None):
+        # everything queued before stop() is ingested before the worker exits
+        self.queue.put(self._STOP)
+        self._thread.join(timeout)
+
+    def stats(self):
+        return { 'depth': self.queue.qsize(),
+                 'max_depth': self.max_depth,
+                 'full_waits': self.full_waits,
+                 'enqueued': self.enqueued,
+                 'ingested': self.ingested,
+                 'failed': self.failed,
+                 'batches': self.batches }
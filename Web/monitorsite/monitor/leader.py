@@ -0,0 +1,58 @@
+import zlib
+from django.db import connection
+
+
+def lock_key(name):
+    return zlib.crc32(name.encode('utf-8'))
+
+
+class LeaderLock(object):
+    # Leader election over a session-level Postgres advisory lock. Whichever
+    # process holds the lock is the leader until its session ends, so a dead
+    # leader's lock is released by the server and another process takes over
+    # on its next try. The session is a connection of its own, so Django
+    # closing or recycling its connections never gives the lock away.
+
+    def __init__(self, name):
+        self.key = lock_key(name)
+        self.held = False
+        self._connection = None
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = connection.get_new_connection(
+                connection.get_connection_params())
+            self._connection.autocommit = True
+        return self._connection
+
+    def _disconnect(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except connection.Database.Error:
+                pass
+        self._connection = None
+        self.held = False
+
+    def try_acquire(self):
+        # returns whether we're the leader; call it periodically, which also
+        # notices when the session (and with it the lock) has been lost
+        if connection.vendor != 'postgresql':
+            # nothing to elect with; only ever run one worker against sqlite
+            self.held = True
+            return self.held
+        try:
+            with self._connect().cursor() as cursor:
+                if self.held:
+                    cursor.execute('SELECT 1')
+                else:
+                    cursor.execute('SELECT pg_try_advisory_lock(%s)', [self.key])
+                    self.held = cursor.fetchone()[0]
+        except connection.Database.Error as e:
+            # a raw connection raises the driver's errors, not Django's
+            print(f"Leader lock connection lost: {e}")
+            self._disconnect()
+        return self.held
+
+    def release(self):
+        self._disconnect()
@@ -0,0 +1,126 @@
+import json
+import threading
+import time
+from django.core.cache import cache
+from .models import Monitor
+from .mqtt_publisher import get_publisher
+
+
+def device_snapshot_key(device_id):
+    return f'monitor:live:device:{device_id}'
+
+
+def user_snapshot_key(user_id):
+    return f'monitor:live:user:{user_id}'
+
+
+def user_usage_topic(user_id):
+    return f'users/{user_id}/monitor/usage'
+
+
+class LiveState(object):
+    # Latest usage of every device, merged from the keyframes and deltas on
+    # devices/+/monitor/usage. flush() publishes one retained aggregate per
+    # user on users/<id>/monitor/usage for the users whose devices changed,
+    # and stores device and user snapshots in the cache so pages can render
+    # the current state without waiting on MQTT. Calling flush() every
+    # interval throttles each user's topic to one message per interval.
+    #
+    # update() runs on the MQTT network thread and only touches memory;
+    # flush() does the database, cache and publishing work elsewhere.
+
+    def __init__(self, stale_after, owner_refresh_interval, cache_timeout,
+                 excluded_user_ids=()):
+        self.stale_after = stale_after
+        self.owner_refresh_interval = owner_refresh_interval
+        self.cache_timeout = cache_timeout
+        self.excluded_user_ids = set(excluded_user_ids)
+
+        self.messages = 0
+        self.published = 0
+
+        self._lock = threading.Lock()
+        # states are replaced rather than changed, so flush() can read them unlocked
+        self._devices = {}
+        self._dirty = set()
+        self._owners = {}
+        self._owners_refreshed = None
+
+    def update(self, device_id, usage, received_at=None):
+        if received_at is None:
+            received_at = time.time()
+        with self._lock:
+            self.messages += 1
+            state = self._devices.get(device_id)
+            if state is None or usage.get('keyframe', True):
+                state = dict(usage)
+            else:
+                # deltas only carry the outlets that changed
+                outlets = dict(state.get('outlets') or {}, **usage.get('outlets', {}))
+                state = dict(state, **usage)
+                state['outlets'] = outlets
+            state['received_at'] = received_at
+            state['stale'] = False
+            self._devices[device_id] = state
+            self._dirty.add(device_id)
+
+    def _refresh_owners(self, device_ids, now):
+        # device -> user, reloaded now and then to follow re-associations
+        if self._owners_refreshed is None or \
+                now - self._owners_refreshed >= self.owner_refresh_interval:
+            self._owners = dict(Monitor.objects.filter(pk__in=device_ids)
+                                .values_list('pk', 'user_id'))
+            self._owners_refreshed = now
+            # republish everyone, which also keeps the cached snapshots alive
+            return set(device_ids)
+
+        missing = [device_id for device_id in device_ids if device_id not in self._owners]
+        if missing:
+            self._owners.update(Monitor.objects.filter(pk__in=missing)
+                                .values_list('pk', 'user_id'))
+        return set()
+
+    def flush(self, now=None):
+        # returns the number of user aggregates published
+        if now is None:
+            now = time.time()
+        with self._lock:
+            for device_id, state in self._devices.items():
+                if not state['stale'] and now - state['received_at'] > self.stale_after:
+                    self._devices[device_id] = dict(state, stale=True)
+                    self._dirty.add(device_id)
+            dirty, self._dirty = self._dirty, set()
+            devices = dict(self._devices)
+
+        dirty |= self._refresh_owners(list(devices), now)
+        if not dirty:
+            return 0
+
+        users = {self._owners[device_id] for device_id in dirty
+                 if device_id in self._owners} - self.excluded_user_ids
+        user_devices = {}
+        for device_id, state in devices.items():
+            user_id = self._owners.get(device_id)
+            if user_id in users:
+                user_devices.setdefault(user_id, {})[device_id] = state
+
+        snapshots = { device_snapshot_key(device_id): devices[device_id]
+                      for device_id in dirty if device_id in devices }
+        for user_id, states in user_devices.items():
+            aggregate = { 'wattage': sum(state.get('wattage', 0) for state in states.values()
+                                         if not state['stale']),
+                          'devices': { device_id: { 'wattage': state.get('wattage', 0),
+                                                    'stale': state['stale'] }
+                                       for device_id, state in states.items() },
+                          'updated_at': now }
+            get_publisher().publish(user_usage_topic(user_id), json.dumps(aggregate),
+                                    qos=1, retain=True)
+            snapshots[user_snapshot_key(user_id)] = aggregate
+        cache.set_many(snapshots, self.cache_timeout)
+        self.published += len(user_devices)
+        return len(user_devices)
+
+    def stats(self):
+        return { 'devices': len(self._devices),
+                 'messages': self.messages,
+                 'published': self.published }
@@ -0,0 +1,28 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from monitor.rollups import compact_usage, rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = 'Delete raw hourly usage and hourly rollups past their retention (run daily)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--raw-days', type=int,
+                            default=settings.USAGE_RAW_RETENTION_DAYS)
+        parser.add_argument('--hourly-rollup-days', type=int,
+                            default=settings.USAGE_HOURLY_ROLLUP_RETENTION_DAYS)
+        parser.add_argument('--rebuild-rollups', action='store_true',
+                            help='recompute all rollups from the raw rows first '
+                                 '(stop the mqtt-daemon while this runs)')
+
+    def handle(self, *args, **options):
+        if options['rebuild_rollups']:
+            print("Rebuilding usage rollups")
+            rebuild_rollups()
+
+        now = timezone.now()
+        raw, hourly = compact_usage(now - timedelta(days=options['raw_days']),
+                                    now - timedelta(days=options['hourly_rollup_days']))
+        print(f"Deleted {raw} raw hourly readings and {hourly} hourly rollups")
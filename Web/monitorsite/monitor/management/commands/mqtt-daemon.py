@@ -1,27 +1,102 @@
 import re
+import sys
 import json
+import time
+import zlib
+import signal
 import asyncio
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from paho.mqtt.client import Client
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand
 from django.conf import settings
+from django.db import close_old_connections, connection
 from monitor.models import *
+from monitor.async_mqtt import AsyncMQTTClient
+from monitor.fleet import publish_fleet_averages
+from monitor.ingest import IngestWorker, hourly_reading
+from monitor.leader import LeaderLock
+from monitor.live_state import LiveState
+from monitor.mqtt_publisher import get_publisher
 
 
 MQTT_BROKER_RE_PATTERN = (r'\$sys\/broker\/connection\/'
                           r'(?P<device_id>[0-9a-f]*)_broker/state')
 
+HOURLY_USAGE_TOPIC = 'devices/+/monitor/usage/last_hour'
+
 HOURLY_USAGE_RE_PATTERN = r'devices\/(?P<device_id>[0-9a-f]*)\/monitor\/usage\/last_hour'
 
+USAGE_RE_PATTERN = r'devices\/(?P<device_id>[0-9a-f]*)\/monitor\/usage$'
+
+# all ORM work runs on this many threads, each with its own connection
+ORM_THREADS = 4
+
+# per topic: consumers (each device's messages are still handled in order),
+# seconds allowed per message, and how many may wait before we stop reading
+BRIDGE_STATE_CONCURRENCY = 4
+BRIDGE_STATE_TIMEOUT_SECS = 10
+HOURLY_USAGE_CONCURRENCY = 1
+HOURLY_USAGE_TIMEOUT_SECS = 30
+USAGE_TIMEOUT_SECS = 1
+MAX_PENDING_MESSAGES = 1000
+
+# hourly readings are queued for the ingest worker and written in batches
+INGEST_QUEUE_SIZE = 10000
+INGEST_BATCH_SIZE = 500
+INGEST_BATCH_WINDOW_SECS = 0.5
+
+# live usage is aggregated per user and published at most this often
+LIVE_STATE_PUBLISH_INTERVAL_SECS = 2
+# devices send a keyframe every minute, so this is several missed in a row
+LIVE_STATE_STALE_SECS = 180
+LIVE_STATE_OWNER_REFRESH_SECS = 60
+LIVE_STATE_CACHE_SECONDS = 600
+
+# one worker at a time leads: it resyncs the average profiles and runs the
+# live state, which needs every device of a user in one place
+LEADER_LOCK_NAME = 'monitor.mqtt-daemon.leader'
+LEADER_RETRY_SECS = 15
+
+# averages are pushed (retained) whenever they change; the resync only
+# repairs a broker that has lost its retained messages
+AVERAGES_RESYNC_SECS = 6 * 60 * 60
+# each resync is spread over this window and read this many monitors at a time
+AVERAGES_RESYNC_JITTER_SECS = 10 * 60
+AVERAGES_RESYNC_CHUNK_SIZE = 1000
+
+STATS_INTERVAL_SECS = 180
+
+# workers share the hourly usage subscription under this group
+SHARE_GROUP = 'mqtt-daemon'
+
+# how often the supervisor checks for (and restarts) dead workers
+WORKER_CHECK_SECS = 5
+
 
 def generate_averages_topic(device_id):
     return f'devices/{device_id}/monitor/average'
 
 
+def device_partition(device_id, partitions):
+    # stable across processes and restarts, unlike hash()
+    return zlib.crc32(device_id.encode('utf-8')) % partitions
+
+
 class Command(BaseCommand):
     help = 'Long-running Daemon Process to Integrate MQTT Messages with Django'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help='run as a supervisor of this many worker processes')
+        parser.add_argument('--worker-index', type=int, default=0,
+                            help=argparse.SUPPRESS)
+        parser.add_argument('--worker-count', type=int, default=1,
+                            help=argparse.SUPPRESS)
+
     def _create_default_user_if_needed(self):
         # make sure the user account exists that holds all new devices
         try:
@@ -35,31 +110,56 @@ class Command(BaseCommand):
             new_user.is_active = False
             new_user.save()
 
-    def _on_connect(self, client, userdata, flags, rc):
-        self.client.message_callback_add('$SYS/broker/connection/+/state',
-                                         self._on_broker_bridges)
-        self.client.subscribe('$SYS/broker/connection/+/state')
-        self.client.message_callback_add('devices/+/monitor/usage/last_hour',
-                                         self._on_hourly_usage)
-        self.client.subscribe('devices/+/monitor/usage/last_hour')
-
-    def _create_mqtt_client_and_loop(self):
-        self.client = Client()
-        self.client.on_connect = self._on_connect
-        self.client.connect('localhost', port=50001)
-        self.client.loop_start()
-
-    def _on_new_devices(self, client, userdata, message):
-        print("RECV: '{}' on '{}'".format(message.payload, message.topic))
+    def _owns(self, device_id):
+        # for subscriptions every worker receives: each handles its partition
+        # of the devices, so each device's messages are processed in order by
+        # one worker
+        return device_partition(device_id, self.worker_count) == self.worker_index
+
+    async def _orm(self, function, *args):
+        # runs blocking ORM work on the bounded executor; Django connections
+        # are per thread, so no connection is ever shared between threads
+        def run():
+            close_old_connections()
+            return function(*args)
+        return await sync_to_async(run, thread_sensitive=False)()
+
+    def _create_mqtt_client(self):
+        client = AsyncMQTTClient(settings.MQTT_BROKER_HOST,
+                                 settings.MQTT_BROKER_PORT)
+        client.add_handler('$SYS/broker/connection/+/state',
+                           self._on_broker_bridges,
+                           concurrency=BRIDGE_STATE_CONCURRENCY,
+                           timeout=BRIDGE_STATE_TIMEOUT_SECS,
+                           max_pending=MAX_PENDING_MESSAGES,
+                           # $SYS/broker/connection/<device_id>_broker/state
+                           key=lambda message: message.topic.split('/')[3])
+        # the bulk of the traffic: shared, so each reading reaches one worker.
+        # Ingest doesn't rely on a device's readings arriving at one worker in
+        # order, see ingest_hourly_usage
+        client.add_handler(HOURLY_USAGE_TOPIC,
+                           self._on_hourly_usage,
+                           concurrency=HOURLY_USAGE_CONCURRENCY,
+                           timeout=HOURLY_USAGE_TIMEOUT_SECS,
+                           max_pending=MAX_PENDING_MESSAGES,
+                           key=lambda message: message.topic.split('/')[1],
+                           share_group=SHARE_GROUP if self.share_hourly_usage else None)
+        # only the leader subscribes, see _elect_leader
+        client.add_handler('devices/+/monitor/usage',
+                           self._on_usage,
+                           timeout=USAGE_TIMEOUT_SECS,
+                           max_pending=MAX_PENDING_MESSAGES,
+                           subscribe=False)
+        return client
+
+    def _on_new_devices(self, device_id, payload):
         # message payload has to treated as type "bytes" in Python 3
-        if message.payload == b'1':
+        if payload == b'1':
             # broker connected
-            results = re.search(MQTT_BROKER_RE_PATTERN, message.topic.lower())
-            device_id = results.group('device_id')
             try:
                 device = Monitor.objects.get(device_id=device_id)
                 print("Found {}".format(device))
-                device.publish_average_msg(datetime.now(timezone.utc).hour)
+                device.publish_averages_msg()
             except Monitor.DoesNotExist:
                 # this is a new device - create new record for it
                 new_device = Monitor(device_id=device_id)
@@ -70,53 +170,189 @@ class Command(BaseCommand):
                 # send association MQTT message
                 new_device.publish_unassociated_msg()
 
-    def _on_broker_bridges(self, client, userdata, message):
-        self._on_new_devices(client, userdata, message)
-        self._on_connection_events(client, userdata, message)
-
-    def _on_connection_events(self, client, userdata, message):
+    async def _on_broker_bridges(self, message):
         results = re.search(MQTT_BROKER_RE_PATTERN, message.topic.lower())
+        if results is None or not self._owns(results.group('device_id')):
+            return
+        print("RECV: '{}' on '{}'".format(message.payload, message.topic))
         device_id = results.group('device_id')
+        await self._orm(self._on_new_devices, device_id, message.payload)
+        self._on_connection_events(device_id, message.payload)
+
+    def _on_connection_events(self, device_id, payload):
         connection_state = 'unknown'
-        if message.payload == b'1':
+        if payload == b'1':
             print("DEVICE {} CONNECTED".format(device_id))
             connection_state = 'Connected'
         else:
             print("DEVICE {} DISCONNECTED".format(device_id))
             connection_state = 'Disconnected'
 
-    def _on_hourly_usage(self, client, userdata, message):
+    async def _on_hourly_usage(self, message):
         results = re.search(HOURLY_USAGE_RE_PATTERN, message.topic.lower())
         device_id = results.group('device_id')
+        if not self.share_hourly_usage and not self._owns(device_id):
+            return
 
-        last_hour = json.loads(message.payload.decode('utf-8'))
+        try:
+            last_hour = json.loads(message.payload.decode('utf-8'))
+        except ValueError:
+            print(f"Invalid hourly usage message on {message.topic}: {message.payload}")
+            return
+
+        # no database work on the event loop; the ingest worker batches it.
+        # Replayed readings are dropped by the (device, hour) uniqueness of HourlyUsage
+        reading = hourly_reading(device_id, last_hour, datetime.now(timezone.utc))
+        if reading is None:
+            print(f"Invalid hourly usage message on {message.topic}: {message.payload}")
+            return
+        if not self.ingest_worker.put(reading, block=False):
+            # backpressure: wait for room off the loop; this consumer (and,
+            # once enough messages pile up, the socket) waits with it
+            await sync_to_async(self.ingest_worker.put, thread_sensitive=False)(reading)
 
-        if ('hour' not in last_hour) or ('wattage' not in last_hour):
+    async def _on_usage(self, message):
+        results = re.search(USAGE_RE_PATTERN, message.topic.lower())
+        if results is None:
+            return
+        try:
+            usage = json.loads(message.payload.decode('utf-8'))
+        except ValueError:
+            print(f"Invalid usage message on {message.topic}: {message.payload}")
+            return
+        if not isinstance(usage, dict):
             return
+        self.live_state.update(results.group('device_id'), usage)
 
+    def _flush_live_state(self):
         try:
-            monitor = Monitor.objects.get(device_id=device_id)
-            print(f"Updating hour average for device {monitor}")
-            monitor.update_averages(last_hour['hour'], last_hour['wattage'])
-        except Monitor.DoesNotExist:
-            print(f"Invalid device ID (topic: {message.topic})")
+            self.live_state.flush()
+        except Exception as e:
+            # the database, the cache or their sockets; ending the task would
+            # take the whole worker down, and the next flush tries again
+            print(f"Failed to publish live state: {e}")
+
+    async def _publish_live_state(self):
+        while True:
+            await asyncio.sleep(LIVE_STATE_PUBLISH_INTERVAL_SECS)
+            if self.is_leader:
+                await self._orm(self._flush_live_state)
+
+    def _new_live_state(self):
+        return LiveState(LIVE_STATE_STALE_SECS,
+                         LIVE_STATE_OWNER_REFRESH_SECS,
+                         LIVE_STATE_CACHE_SECONDS,
+                         excluded_user_ids=[self.parked_user_id])
+
+    async def _elect_leader(self):
+        while True:
+            was_leader = self.is_leader
+            self.is_leader = await self._orm(self.leader_lock.try_acquire)
+            if self.is_leader and not was_leader:
+                print(f'Worker {self.worker_index} is now the leader')
+                # retained usage messages rebuild the live state straight away
+                self.live_state = self._new_live_state()
+                self.mqtt.subscribe('devices/+/monitor/usage')
+            elif was_leader and not self.is_leader:
+                print(f'Worker {self.worker_index} lost the leadership')
+                self.mqtt.unsubscribe('devices/+/monitor/usage')
+            await asyncio.sleep(LEADER_RETRY_SECS)
 
     async def _handle_averages(self):
-        last_poll = datetime.now(timezone.utc)
         while True:
-            print('Polling...')
-            current_poll = datetime.now(timezone.utc)
-            if current_poll.hour != last_poll.hour:
-                for monitor in Monitor.objects.all():
-                    if monitor.user == User.objects.get(username=settings.DEFAULT_USER):
-                        continue
-                    print(f'Publishing hourly average for device {monitor}')
-                    monitor.publish_average_msg(current_poll.hour)
+            await asyncio.sleep(AVERAGES_RESYNC_SECS)
+            if self.is_leader:
+                published = await publish_fleet_averages(self._orm,
+                                                         AVERAGES_RESYNC_JITTER_SECS,
+                                                         AVERAGES_RESYNC_CHUNK_SIZE)
+                print(f'Resynced {published} average profiles')
 
-            last_poll = current_poll
-            await asyncio.sleep(180)
+    async def _report_stats(self):
+        while True:
+            print(f'Worker {self.worker_index}/{self.worker_count}, '
+                  f'leader: {self.is_leader}, ingest: {self.ingest_worker.stats()}, '
+                  f'live state: {self.live_state.stats()}, '
+                  f'handlers: {self.mqtt.stats()}')
+            await asyncio.sleep(STATS_INTERVAL_SECS)
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(ORM_THREADS,
+                                                     thread_name_prefix='orm'))
+        stopping = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, stopping.set)
+
+        tasks = [asyncio.create_task(coroutine) for coroutine in (
+            self.mqtt.run(),
+            self._elect_leader(),
+            self._handle_averages(),
+            self._publish_live_state(),
+            self._report_stats(),
+        )]
+        stop = asyncio.create_task(stopping.wait())
+        done, _ = await asyncio.wait(tasks + [stop],
+                                     return_when=asyncio.FIRST_COMPLETED)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for task in done:
+            if task is not stop:
+                # a task that should run forever ended; surface why
+                task.result()
+
+    def _on_sigterm(self, signum, frame):
+        sys.exit(0)
+
+    def _supervise(self, workers):
+        if workers > 1 and connection.vendor != 'postgresql':
+            print("Warning: leader election needs Postgres; every worker will lead")
+        command = [sys.executable, sys.argv[0], 'mqtt-daemon',
+                   '--worker-count', str(workers)]
+        processes = {}
+        signal.signal(signal.SIGTERM, self._on_sigterm)
+        try:
+            while True:
+                for index in range(workers):
+                    process = processes.get(index)
+                    if process is not None and process.poll() is None:
+                        continue
+                    if process is not None:
+                        print(f'Worker {index} exited with {process.returncode}, restarting')
+                    processes[index] = subprocess.Popen(
+                        command + ['--worker-index', str(index)])
+                time.sleep(WORKER_CHECK_SECS)
+        finally:
+            # workers drain their ingest queues on SIGTERM
+            for process in processes.values():
+                process.terminate()
+            for process in processes.values():
+                process.wait()
 
     def handle(self, *args, **options):
         self._create_default_user_if_needed()
-        self._create_mqtt_client_and_loop()
-        asyncio.run(self._handle_averages())
+        if options['workers'] > 1:
+            self._supervise(options['workers'])
+            return
+
+        self.worker_index = options['worker_index']
+        self.worker_count = options['worker_count']
+        self.share_hourly_usage = self.worker_count > 1 and settings.MQTT_SHARED_SUBSCRIPTIONS
+        self.parked_user_id = User.objects.get(username=settings.DEFAULT_USER).pk
+        # from here on the ORM is only used from the executor's threads
+        connection.close()
+
+        self.leader_lock = LeaderLock(LEADER_LOCK_NAME)
+        self.is_leader = False
+        self.ingest_worker = IngestWorker(INGEST_QUEUE_SIZE, INGEST_BATCH_SIZE,
+                                          INGEST_BATCH_WINDOW_SECS)
+        self.ingest_worker.start()
+        self.live_state = self._new_live_state()
+        self.mqtt = self._create_mqtt_client()
+        try:
+            asyncio.run(self._serve())
+        finally:
+            # the MQTT client has disconnected; drain whatever is already queued
+            self.ingest_worker.stop()
+            print(f'Ingest worker stopped: {self.ingest_worker.stats()}')
+            get_publisher().flush()
+            self.leader_lock.release()
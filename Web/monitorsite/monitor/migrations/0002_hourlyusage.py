@@ -0,0 +1,28 @@
+# Generated by Django 4.1.7 on 2026-10-18 10:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitor', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HourlyUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('wattage', models.FloatField()),
+                ('outlets', models.JSONField(blank=True, null=True)),
+                ('monitor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='hourly_usage', to='monitor.monitor')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='hourlyusage',
+            constraint=models.UniqueConstraint(fields=('monitor', 'hour'), name='unique_monitor_hour'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.1.7 on 2026-10-18 10:50
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('monitor', '0002_hourlyusage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserUsageRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day'), ('month', 'Month')], max_length=5)),
+                ('period_start', models.DateTimeField()),
+                ('total', models.FloatField(default=0)),
+                ('minimum', models.FloatField()),
+                ('maximum', models.FloatField()),
+                ('count', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='usage_rollups', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DeviceUsageRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day'), ('month', 'Month')], max_length=5)),
+                ('period_start', models.DateTimeField()),
+                ('total', models.FloatField(default=0)),
+                ('minimum', models.FloatField()),
+                ('maximum', models.FloatField()),
+                ('count', models.IntegerField(default=0)),
+                ('monitor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='usage_rollups', to='monitor.monitor')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='userusagerollup',
+            constraint=models.UniqueConstraint(fields=('user', 'resolution', 'period_start'), name='unique_user_rollup'),
+        ),
+        migrations.AddConstraint(
+            model_name='deviceusagerollup',
+            constraint=models.UniqueConstraint(fields=('monitor', 'resolution', 'period_start'), name='unique_device_rollup'),
+        ),
+    ]
@@ -1,9 +1,10 @@
-from django.db import models
+from django.db import models, connection, transaction
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.core.cache import cache
 from uuid import uuid4
 import json
-import paho.mqtt.publish
+from .mqtt_publisher import get_publisher
 
 # Create your models here.
 DEFAULT_USER = 'parked_device_user'
@@ -20,6 +21,122 @@ def generate_association_code():
 def default_averages():
     return { "hours": [0] * 24 }
 
+def profiles_cache_key(user_id):
+    return f'monitor:profiles:{user_id}'
+
+
+def invalidate_profiles(user_ids):
+    # drops the cached usage profiles (see views.ProfilesView) of these users
+    # once the current transaction commits; before then a request would just
+    # cache the old averages again
+    keys = [profiles_cache_key(user_id) for user_id in set(user_ids)]
+
+    def delete():
+        # best effort: the entries expire anyway, and the change that made
+        # them stale mustn't fail because the cache is down
+        try:
+            cache.delete_many(keys)
+        except Exception as e:
+            print(f"Failed to invalidate cached profiles: {e}")
+    transaction.on_commit(delete)
+
+
+# weight of the newest sample in the exponential recency weighted average (ERWA)
+# This favors more recent data, which makes sense for energy usage, and allows us
+# to save just the average instead of a large amount of historical data.
+ERWA_WEIGHT = .2
+
+
+def erwa(average, wattage):
+    # an empty slot starts at the first sample rather than decaying up from zero
+    if not average:
+        return wattage
+    return average * (1 - ERWA_WEIGHT) + wattage * ERWA_WEIGHT
+
+
+def publish_averages(device_id, averages):
+    # the whole day's profile, retained: devices pick the current hour's slot
+    # themselves, so this only needs sending when an average changes
+    averages_msg = { "hours": (averages or default_averages())["hours"] }
+    get_publisher().publish(f'devices/{device_id}/monitor/average',
+                            json.dumps(averages_msg),
+                            qos=1,
+                            retain=True)
+
+
+class MonitorManager(models.Manager):
+
+    def associated(self):
+        # monitors claimed by a user, i.e. not parked with DEFAULT_USER
+        return self.exclude(user__username=DEFAULT_USER)
+
+    def update_averages(self, readings):
+        # readings: [(device_id, hour of day, wattage), ...] in the order they
+        # should be applied. Each reading updates just its hour slot in the
+        # database, so concurrent writers can't lose each other's updates, and
+        # a batch costs one UPDATE per reading of the busiest device rather
+        # than a load and save per monitor. Returns the new averages of the
+        # monitors that were updated, keyed by device id.
+        readings = [(device_id, hour, wattage) for device_id, hour, wattage in readings
+                    if hour in range(24)]
+        if connection.vendor != 'postgresql':
+            return self._update_averages_locked(readings)
+
+        # a device can only appear once per UPDATE ... FROM, so a batch holding
+        # several hours for one device is applied over several rounds
+        rounds = []
+        seen = {}
+        for device_id, hour, wattage in readings:
+            round_index = seen.get(device_id, 0)
+            seen[device_id] = round_index + 1
+            if round_index == len(rounds):
+                rounds.append([])
+            rounds[round_index].append((device_id, hour, wattage))
+
+        user_ids = set()
+        averages = {}
+        with transaction.atomic(), connection.cursor() as cursor:
+            for batch in rounds:
+                cursor.execute(self._update_averages_sql(len(batch)),
+                               [json.dumps(default_averages())] +
+                               [value for reading in batch for value in reading])
+                for device_id, user_id, updated in cursor.fetchall():
+                    user_ids.add(user_id)
+                    # Django has psycopg2 hand jsonb back undecoded
+                    averages[device_id] = json.loads(updated) if isinstance(updated, str) else updated
+        invalidate_profiles(user_ids)
+        return averages
+
+    def _update_averages_sql(self, count):
+        slot = "COALESCE((m.averages #>> ARRAY['hours', v.hour::text])::float8, 0)"
+        return f"""
+            UPDATE {self.model._meta.db_table} AS m
+            SET averages = jsonb_set(
+                COALESCE(m.averages, %s::jsonb),
+                ARRAY['hours', v.hour::text],
+                to_jsonb(CASE WHEN {slot} = 0 THEN v.wattage
+                              ELSE {slot} * {1 - ERWA_WEIGHT} + v.wattage * {ERWA_WEIGHT}
+                         END))
+            FROM (VALUES {', '.join(['(%s, %s::int, %s::float8)'] * count)})
+                AS v(device_id, hour, wattage)
+            WHERE m.device_id = v.device_id
+            RETURNING m.device_id, m.user_id, m.averages
+        """
+
+    def _update_averages_locked(self, readings):
+        # databases without jsonb_set (sqlite in development) lock the rows
+        # and apply the same arithmetic in Python
+        with transaction.atomic():
+            monitors = self.select_for_update().in_bulk(
+                {device_id for device_id, _, _ in readings})
+            for device_id, hour, wattage in readings:
+                if device_id in monitors:
+                    monitors[device_id].apply_hour_usage(hour, wattage)
+            self.bulk_update(monitors.values(), ['averages'])
+        invalidate_profiles(monitor.user_id for monitor in monitors.values())
+        return { device_id: monitor.averages for device_id, monitor in monitors.items() }
+
+
 class Monitor(models.Model):
     name = models.CharField(max_length=50, default="New Monitor")
     device_id = models.CharField(db_index=True,
@@ -33,33 +150,30 @@ class Monitor(models.Model):
 
     averages = models.JSONField(null=True, default=default_averages)
 
+    objects = MonitorManager()
+
     def __str__(self):
         return "{}: {}".format(self.device_id, self.name)
 
-    def update_averages(self, hour, wattage):
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        invalidate_profiles([self.user_id])
+
+    def apply_hour_usage(self, hour, wattage):
+        # updates the in-memory averages only; use update_averages to store them
         if hour not in range(24):
             return
+        if self.averages is None:
+            self.averages = default_averages()
+        self.averages["hours"][hour] = erwa(self.averages["hours"][hour], wattage)
 
-        if self.averages["hours"][hour] == 0:
-            self.averages["hours"][hour] == wattage
-        else:
-            # calculating the new average as an exponential recency weighted average (ERWA)
-            # This favors more recent data, which makes sense for energy usage, and allows us
-            # to save just the average instead of a large amount of historical data.
-            new_erwa = self.averages["hours"][hour] * .8 + wattage * .2
-            self.averages["hours"][hour] = new_erwa
-            self.save()
-
-    def _generate_averages_topic(self):
-        return f'devices/{self.device_id}/monitor/average'
-
-    def publish_average_msg(self, hour):
-        average_msg = { "hour": hour, "wattage": self.averages["hours"][hour] }
-        paho.mqtt.publish.single(self._generate_averages_topic(),
-                                 json.dumps(average_msg),
-                                 qos=1,
-                                 retain=True,
-                                 port=50001)
+    def update_averages(self, hour, wattage):
+        Monitor.objects.update_averages([(self.device_id, hour, wattage)])
+        self.refresh_from_db(fields=['averages'])
+        self.publish_averages_msg()
+
+    def publish_averages_msg(self):
+        publish_averages(self.device_id, self.averages)
 
     def _generate_device_association_topic(self):
         return 'devices/{}/lamp/associated'.format(self.device_id)
@@ -69,25 +183,94 @@ class Monitor(models.Model):
         assoc_msg = {}
         assoc_msg['associated'] = False
         assoc_msg['code'] = self.association_code
-        paho.mqtt.publish.single(
+        get_publisher().publish(
             self._generate_device_association_topic(),
             json.dumps(assoc_msg),
             qos=2,
             retain=True,
-            port=50001,
             )
 
     def associate_and_publish_associated_msg(self,  user):
         # update Lampi instance with new user
+        previous_user_id = self.user_id
         self.user = user
         self.save()
+        invalidate_profiles([previous_user_id])
         # publish associated message
         assoc_msg = {}
         assoc_msg['associated'] = True
-        paho.mqtt.publish.single(
+        get_publisher().publish(
             self._generate_device_association_topic(),
             json.dumps(assoc_msg),
             qos=2,
             retain=True,
-            port=50001,
             )
+
+
+class HourlyUsage(models.Model):
+    # one row per device per UTC hour, as reported on .../monitor/usage/last_hour
+    monitor = models.ForeignKey(Monitor, on_delete=models.CASCADE,
+                                related_name='hourly_usage')
+    hour = models.DateTimeField()
+    wattage = models.FloatField()
+    outlets = models.JSONField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            # also the (device_id, hour) index that history queries use
+            models.UniqueConstraint(fields=['monitor', 'hour'],
+                                    name='unique_monitor_hour'),
+        ]
+
+    def __str__(self):
+        return "{} {}: {} Wh".format(self.monitor_id, self.hour, self.wattage)
+
+
+class UsageRollup(models.Model):
+    # sum, min, max and count of the hourly readings (Wh) falling in one UTC
+    # hour, day or month; maintained incrementally by monitor.rollups
+    HOUR = 'hour'
+    DAY = 'day'
+    MONTH = 'month'
+    RESOLUTIONS = [(HOUR, 'Hour'), (DAY, 'Day'), (MONTH, 'Month')]
+
+    resolution = models.CharField(max_length=5, choices=RESOLUTIONS)
+    period_start = models.DateTimeField()
+    total = models.FloatField(default=0)
+    minimum = models.FloatField()
+    maximum = models.FloatField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+
+class DeviceUsageRollup(UsageRollup):
+    monitor = models.ForeignKey(Monitor, on_delete=models.CASCADE,
+                                related_name='usage_rollups')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['monitor', 'resolution', 'period_start'],
+                                    name='unique_device_rollup'),
+        ]
+
+    def __str__(self):
+        return "{} {} {}: {} Wh".format(self.monitor_id, self.resolution,
+                                        self.period_start, self.total)
+
+
+class UserUsageRollup(UsageRollup):
+    # readings are attributed to whoever owned the monitor when they arrived
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+                             related_name='usage_rollups')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'resolution', 'period_start'],
+                                    name='unique_user_rollup'),
+        ]
+
+    def __str__(self):
+        return "{} {} {}: {} Wh".format(self.user_id, self.resolution,
+                                        self.period_start, self.total)
@@ -0,0 +1,89 @@
+import atexit
+import os
+import threading
+import time
+from uuid import uuid4
+import paho.mqtt.client as mqtt
+from django.conf import settings
+
+
+class MQTTPublisher(object):
+    # One long-lived broker connection per process for everything Django
+    # publishes. publish() only queues the message: paho's network thread
+    # pipelines the QoS 1/2 handshakes (up to max_inflight unacknowledged at
+    # once), holds up to max_queued messages while disconnected, and
+    # reconnects with backoff.
+
+    def __init__(self, host, port, max_inflight, max_queued):
+        self.dropped = 0
+        # mids waiting for the broker's acknowledgement; tracked through
+        # on_publish because paho's MessageInfo can't report on messages
+        # that were queued while disconnected
+        self._pending = set()
+        self._acked_early = set()
+        self._pending_lock = threading.Lock()
+        self.client = mqtt.Client(
+            client_id=f'django_publisher_{os.getpid()}_{uuid4().hex[:8]}')
+        self.client.on_publish = self._on_publish
+        self.client.max_inflight_messages_set(max_inflight)
+        self.client.max_queued_messages_set(max_queued)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+        self.client.connect_async(host, port=port)
+        self.client.loop_start()
+
+    def _on_publish(self, client, userdata, mid):
+        with self._pending_lock:
+            if mid in self._pending:
+                self._pending.remove(mid)
+            else:
+                # acknowledged before publish() got to record it
+                self._acked_early.add(mid)
+
+    def publish(self, topic, payload, qos=1, retain=False):
+        # paho calls on_publish holding its own locks, so ours can't be held here
+        info = self.client.publish(topic, payload, qos=qos, retain=retain)
+        if info.rc == mqtt.MQTT_ERR_QUEUE_SIZE:
+            self.dropped += 1
+            print(f"MQTT outbound queue full, dropped message on {topic}")
+            return info
+
+        with self._pending_lock:
+            if info.mid in self._acked_early:
+                self._acked_early.remove(info.mid)
+            elif qos > 0:
+                self._pending.add(info.mid)
+        return info
+
+    def pending(self):
+        return len(self._pending)
+
+    def flush(self, timeout=10):
+        # waits for the broker to acknowledge everything published so far
+        deadline = time.monotonic() + timeout
+        while self._pending and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return not self._pending
+
+    def close(self, timeout=10):
+        self.flush(timeout)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+_publisher = None
+_publisher_pid = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    # created lazily so each forked uwsgi worker gets its own connection
+    global _publisher, _publisher_pid
+    with _publisher_lock:
+        if _publisher is None or _publisher_pid != os.getpid():
+            _publisher = MQTTPublisher(settings.MQTT_BROKER_HOST,
+                                       settings.MQTT_BROKER_PORT,
+                                       settings.MQTT_PUBLISHER_MAX_INFLIGHT,
+                                       settings.MQTT_PUBLISHER_MAX_QUEUED)
+            _publisher_pid = os.getpid()
+            atexit.register(_publisher.close)
+        return _publisher
@@ -0,0 +1,150 @@
+from datetime import timedelta
+from django.db import connection, transaction
+from .models import UsageRollup, DeviceUsageRollup, UserUsageRollup, HourlyUsage
+
+# finest first
+RESOLUTIONS = [UsageRollup.HOUR, UsageRollup.DAY, UsageRollup.MONTH]
+
+# close enough to pick a resolution; months are bucketed by the calendar
+PERIOD_LENGTHS = { UsageRollup.HOUR: timedelta(hours=1),
+                   UsageRollup.DAY: timedelta(days=1),
+                   UsageRollup.MONTH: timedelta(days=30.44) }
+
+# rows per INSERT, keeping well under sqlite's limit on query parameters
+UPSERT_BATCH_SIZE = 100
+
+
+def period_start(when, resolution):
+    when = when.replace(minute=0, second=0, microsecond=0)
+    if resolution == UsageRollup.HOUR:
+        return when
+    when = when.replace(hour=0)
+    if resolution == UsageRollup.DAY:
+        return when
+    return when.replace(day=1)
+
+
+def rollup_deltas(rows, owner_of):
+    # {(owner, resolution, period start): [total, minimum, maximum, count]}
+    # for a batch of HourlyUsage rows, ready to be merged into the rollups
+    deltas = {}
+    for row in rows:
+        owner = owner_of(row)
+        for resolution in RESOLUTIONS:
+            key = (owner, resolution, period_start(row.hour, resolution))
+            delta = deltas.get(key)
+            if delta is None:
+                deltas[key] = [row.wattage, row.wattage, row.wattage, 1]
+            else:
+                delta[0] += row.wattage
+                delta[1] = min(delta[1], row.wattage)
+                delta[2] = max(delta[2], row.wattage)
+                delta[3] += 1
+    return deltas
+
+
+def _upsert_sql(model, owner_column, count):
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+    if connection.vendor == 'postgresql':
+        least, greatest = 'LEAST', 'GREATEST'
+    else:
+        least, greatest = 'MIN', 'MAX'
+    return f"""
+        INSERT INTO {table}
+            ({quote(owner_column)}, resolution, period_start, total, minimum, maximum, {quote('count')})
+        VALUES {', '.join(['(%s, %s, %s, %s, %s, %s, %s)'] * count)}
+        ON CONFLICT ({quote(owner_column)}, resolution, period_start) DO UPDATE SET
+            total = {table}.total + EXCLUDED.total,
+            minimum = {least}({table}.minimum, EXCLUDED.minimum),
+            maximum = {greatest}({table}.maximum, EXCLUDED.maximum),
+            {quote('count')} = {table}.{quote('count')} + EXCLUDED.{quote('count')}
+    """
+
+
+def _merge(model, owner_column, deltas):
+    # adds the deltas to the existing rollups in place; keys are sorted so
+    # concurrent ingests lock rows in the same order
+    items = sorted(deltas.items())
+    with connection.cursor() as cursor:
+        for start in range(0, len(items), UPSERT_BATCH_SIZE):
+            batch = items[start:start + UPSERT_BATCH_SIZE]
+            params = []
+            for (owner, resolution, period), (total, minimum, maximum, count) in batch:
+                params += [owner, resolution,
+                           connection.ops.adapt_datetimefield_value(period),
+                           total, minimum, maximum, count]
+            cursor.execute(_upsert_sql(model, owner_column, len(batch)), params)
+
+
+def update_rollups(rows, owners):
+    # folds newly stored HourlyUsage rows into the device and user rollups;
+    # owners maps device ids to the user ids the readings count towards.
+    # Each row must be folded in exactly once, in the transaction that stores it.
+    _merge(DeviceUsageRollup, 'monitor_id',
+           rollup_deltas(rows, lambda row: row.monitor_id))
+    _merge(UserUsageRollup, 'user_id',
+           rollup_deltas(rows, lambda row: owners[row.monitor_id]))
+
+
+def rebuild_rollups(batch_size=10000):
+    # recomputes every rollup from the raw rows still stored, e.g. for usage
+    # recorded before rollups existed. Stop the mqtt-daemon first, and note
+    # that history older than the raw retention is lost from the rollups.
+    with transaction.atomic():
+        DeviceUsageRollup.objects.all().delete()
+        UserUsageRollup.objects.all().delete()
+        rows = HourlyUsage.objects.select_related('monitor').only(
+            'monitor_id', 'hour', 'wattage', 'monitor__user_id').order_by('pk')
+        batch = []
+        for row in rows.iterator(chunk_size=batch_size):
+            batch.append(row)
+            if len(batch) == batch_size:
+                update_rollups(batch, { row.monitor_id: row.monitor.user_id for row in batch })
+                batch = []
+        update_rollups(batch, { row.monitor_id: row.monitor.user_id for row in batch })
+
+
+def choose_resolution(start, end, max_points):
+    # the finest resolution that covers start..end in at most max_points
+    for resolution in RESOLUTIONS:
+        if (end - start) / PERIOD_LENGTHS[resolution] <= max_points:
+            return resolution
+    return RESOLUTIONS[-1]
+
+
+def usage_history(rollups, start, end, max_points):
+    # rollups: a DeviceUsageRollup or UserUsageRollup queryset already
+    # filtered to one device or user. Returns (resolution, [row, ...]).
+    resolution = choose_resolution(start, end, max_points)
+    rows = rollups.filter(resolution=resolution,
+                          period_start__gte=period_start(start, resolution),
+                          period_start__lt=end) \
+                  .order_by('period_start') \
+                  .values('period_start', 'total', 'minimum', 'maximum', 'count')
+    return resolution, list(rows)
+
+
+def compact_usage(raw_before, hourly_before, batch_size=10000):
+    # retention: raw readings and hourly rollups older than the cutoffs are
+    # deleted in batches; daily and monthly rollups are kept indefinitely.
+    # Returns (raw rows deleted, hourly rollups deleted).
+    raw = _delete_in_batches(HourlyUsage.objects.filter(hour__lt=raw_before),
+                             batch_size)
+    hourly = 0
+    for model in (DeviceUsageRollup, UserUsageRollup):
+        hourly += _delete_in_batches(
+            model.objects.filter(resolution=UsageRollup.HOUR,
+                                 period_start__lt=hourly_before),
+            batch_size)
+    return raw, hourly
+
+
+def _delete_in_batches(queryset, batch_size):
+    # short transactions, so the ingest worker isn't held up behind a huge delete
+    deleted = 0
+    while True:
+        pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        deleted += queryset.model.objects.filter(pk__in=pks).delete()[0]
@@ -17,9 +17,8 @@ function GraphHandler($){
         },
 
         onConnect: function(response) {
-	    Object.keys(window_global.averages).forEach(deviceId => {
-                obj.client.subscribe("devices/" + deviceId + "/monitor/usage", {qos:1});
-	    });
+	    // the mqtt-daemon sums the user's devices into one retained topic
+            obj.client.subscribe("users/" + window_global.user_id + "/monitor/usage", {qos:1});
         },
 
 	onConnectionLost: function(responseObject) {
@@ -30,16 +29,14 @@ function GraphHandler($){
         },
 
         onMessageArrived: function(message) {
-            monitor_state = JSON.parse(message.payloadString);
-	    
-	    deviceId = message.destinationName.split('/')[1];
-            obj.wattages[deviceId] = Number.parseFloat(monitor_state.wattage);
+            user_state = JSON.parse(message.payloadString);
+            obj.wattage = Number.parseFloat(user_state.wattage);
 
             obj.updateUI();
         },
 
 	updateUI: function() {
-	    var sum = Object.values(obj.wattages).reduce((a, b) => a + b, 0);
+	    var sum = obj.wattage;
             $('#graph-header').text(`Total Current Usage: ${sum.toFixed(1)} W`);
 
 	    var x_pos = new Date().getHours() + new Date().getMinutes() / 60;
@@ -48,7 +45,7 @@ function GraphHandler($){
         },
 
 	labels: ["12 AM","","","3 AM","","","6 AM","","","9 AM","","","12 PM","","","3 PM","","","6 PM","","","9 PM","",""],
-	wattages: {},
+	wattage: 0,
 	data: {
 	    datasets: []
 	},
@@ -60,6 +57,16 @@ function GraphHandler($){
 	client: new Paho.MQTT.Client(hostAddress, Number(hostPort),
             clientId),
 
+	loadProfiles: function() {
+	    // the page itself doesn't carry the averages, so it stays small and cacheable
+	    return $.getJSON(window_global.profiles_url).done(profiles => {
+		profiles.monitors.forEach(monitor => {
+		    window_global.labels[monitor.device_id] = monitor.name;
+		    window_global.averages[monitor.device_id] = monitor.hours;
+		});
+	    });
+	},
+
 	createGraphData: function() {
 	    obj.data.datasets.push(obj.currentUsagePoint);
 
@@ -82,21 +89,65 @@ function GraphHandler($){
             obj.client.onConnectionLost = obj.onConnectionLost;
             obj.client.onMessageArrived = obj.onMessageArrived;
 
+	    obj.loadProfiles().done(obj.createGraph).fail(obj.onFailure);
+        },
+
+	// days of history per range; 'day' is the averages profile
+	ranges: { week: 7, month: 31, year: 366 },
+	historyPoints: 200,
+	range: 'day',
+
+	hourAxis: {
+	    type: 'linear',
+	    min: 0,
+	    max: 23,
+	    title: { display: true, text: 'Hour of the Day' },
+	    ticks: {
+	        callback: (value, i, ticks) => obj.labels[i],
+		stepSize: 1
+	    }
+	},
+
+	showRange: function(range) {
+	    obj.range = range;
+	    if (!(range in obj.ranges)) {
+		obj.graph.data = obj.data;
+		obj.graph.options.scales.x = obj.hourAxis;
+		obj.graph.update();
+		return;
+	    }
+
+	    var end = new Date();
+	    var start = new Date(end.getTime() - obj.ranges[range] * 24 * 60 * 60 * 1000);
+	    // the server picks hourly, daily or monthly totals to fit historyPoints
+	    $.getJSON(window_global.history_url,
+		      { start: start.toISOString(), end: end.toISOString(), points: obj.historyPoints })
+		.done(history => {
+		    if (obj.range !== range) {
+			return;
+		    }
+		    var format = history.resolution === 'hour' ? 'toLocaleString' : 'toLocaleDateString';
+		    obj.graph.data = {
+			labels: history.points.map(point => new Date(point.start)[format]()),
+			datasets: [{ type: 'bar',
+				     label: 'Energy per ' + history.resolution + ' (Wh)',
+				     data: history.points.map(point => point.total),
+				     backgroundColor: 'rgba(70, 189, 198, 0.62)' }]
+		    };
+		    obj.graph.options.scales.x = { type: 'category',
+						   title: { display: true, text: history.resolution } };
+		    obj.graph.update();
+		})
+		.fail(obj.onFailure);
+	},
+
+	createGraph: function() {
 	    obj.createGraphData()
 	    obj.graph = new Chart($('#graph'), { 
 		data: obj.data, 
 		options: { 
 		    scales: {
-			x: {
-			    type: 'linear',
-			    min: 0,
-			    max: 23,
-			    title: { display: true, text: 'Hour of the Day' },
-			    ticks: {
-			        callback: (value, i, ticks) => obj.labels[i],
-				stepSize: 1
-			    }
-			},
+			x: obj.hourAxis,
 			y: { 
 			    stacked: true,
 			    title: { display: true, text: 'Wattage (W or Wh)'}
@@ -105,6 +156,16 @@ function GraphHandler($){
 		}
 	    });
 
+	    if (window_global.live_state) {
+		obj.wattage = Number.parseFloat(window_global.live_state.wattage);
+		obj.updateUI();
+	    }
+
+	    $('#graph-ranges a').click(function(event) {
+		event.preventDefault();
+		obj.showRange($(this).data('range'));
+	    });
+
             obj.connect();
         }
     };
@@ -54,10 +54,19 @@ function MonitorPage($){
             new_state = JSON.parse(message.payloadString);
             console.log(new_state)
 
+            obj.applyUsage(new_state);
+        },
+
+        applyUsage: function(new_state) {
             obj.state.wattage = Number.parseFloat(new_state.wattage).toFixed(0);
             obj.state.difference = Number.parseFloat(new_state.difference).toFixed(2);
 	    obj.state.diff_color = new_state.diff_color;
-	    obj.state.outlets = new_state.outlets;
+	    if (new_state.keyframe === false) {
+	        // deltas only carry the outlets that changed
+	        Object.assign(obj.state.outlets, new_state.outlets);
+	    } else {
+	        obj.state.outlets = new_state.outlets;
+	    }
 
             obj.updateUI();
         },
@@ -138,6 +147,10 @@ function MonitorPage($){
             obj.client.onMessageArrived = obj.onMessageArrived;
 
 	    setInterval(obj.updateTime, 500);
+	    if (window_global.live_state) {
+	        // paint the mqtt-daemon's snapshot without waiting for a retained message
+	        obj.applyUsage(window_global.live_state);
+	    }
             obj.connect();
         },
     };
@@ -1,3 +1,780 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import json
+import socket
+import zlib
+from importlib import import_module
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest import mock
+import paho.mqtt.client as mqtt
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from .async_mqtt import AsyncMQTTClient
+from .fleet import publish_fleet_averages
+from .ingest import IngestWorker, ingest_hourly_usage, hourly_reading, usage_hour
+from .leader import LeaderLock, lock_key
+from .live_state import (LiveState, device_snapshot_key, user_snapshot_key,
+                         user_usage_topic)
+from .models import (Monitor, HourlyUsage, UsageRollup, DeviceUsageRollup, UserUsageRollup,
+                     DEFAULT_USER, ERWA_WEIGHT, profiles_cache_key)
+from .mqtt_publisher import MQTTPublisher
+from .rollups import update_rollups, rebuild_rollups, usage_history, compact_usage
+from django.core.cache import cache
 
-# Create your tests here.
+
+def utc(*args):
+    return datetime(*args, tzinfo=dt_timezone.utc)
+
+
+@override_settings(CACHES={ 'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache' } },
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class MonitorTestCase(TestCase):
+
+    def setUp(self):
+        # nothing here talks to a broker
+        patcher = mock.patch('monitor.models.get_publisher')
+        self.publisher = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        cache.clear()
+
+        self.user = User.objects.create_user('alice', password='secret')
+        self.parked = User.objects.create_user(DEFAULT_USER)
+        self.monitor = Monitor.objects.create(device_id='b827eb000001', user=self.user)
+        self.other = Monitor.objects.create(device_id='b827eb000002', user=self.user)
+
+    def recent_hour(self, hours_ago):
+        return timezone.now().replace(minute=0, second=0, microsecond=0) - \
+            timedelta(hours=hours_ago)
+
+    def averages(self, monitor):
+        monitor.refresh_from_db()
+        return monitor.averages['hours']
+
+
+class IngestHourlyUsageTest(MonitorTestCase):
+
+    def test_stores_readings_and_updates_averages(self):
+        hour = self.recent_hour(2)
+        rows = ingest_hourly_usage([(self.monitor.pk, hour, 120.0, { 'lamp': 120.0 }),
+                                    (self.other.pk, hour, 30.0, None)])
+
+        self.assertEqual(len(rows), 2)
+        stored = HourlyUsage.objects.get(monitor=self.monitor, hour=hour)
+        self.assertEqual((stored.wattage, stored.outlets), (120.0, { 'lamp': 120.0 }))
+        self.assertEqual(self.averages(self.monitor)[hour.hour], 120.0)
+        self.assertEqual(self.averages(self.other)[hour.hour], 30.0)
+
+    def test_duplicate_reading_leaves_everything_unchanged(self):
+        hour = self.recent_hour(2)
+        ingest_hourly_usage([(self.monitor.pk, hour, 120.0, None)])
+        averages = self.averages(self.monitor)
+        rollups = list(DeviceUsageRollup.objects.values_list('resolution', 'total', 'count'))
+        self.publisher.publish.reset_mock()
+
+        # a replay from the device's spool, possibly with a different value
+        self.assertEqual(ingest_hourly_usage([(self.monitor.pk, hour, 80.0, None)]), [])
+
+        self.assertEqual(self.averages(self.monitor), averages)
+        self.assertEqual(HourlyUsage.objects.filter(monitor=self.monitor).count(), 1)
+        self.assertEqual(list(DeviceUsageRollup.objects.values_list(
+            'resolution', 'total', 'count')), rollups)
+        self.publisher.publish.assert_not_called()
+
+    def test_repeated_reading_within_a_batch_is_stored_once(self):
+        hour = self.recent_hour(2)
+        rows = ingest_hourly_usage([(self.monitor.pk, hour, 100.0, None),
+                                    (self.monitor.pk, hour, 100.0, None)])
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(self.averages(self.monitor)[hour.hour], 100.0)
+
+    def test_several_hours_of_one_device_in_a_batch(self):
+        first, second = self.recent_hour(3), self.recent_hour(2)
+        ingest_hourly_usage([(self.monitor.pk, first, 10.0, None),
+                             (self.monitor.pk, second, 20.0, None)])
+        averages = self.averages(self.monitor)
+        self.assertEqual((averages[first.hour], averages[second.hour]), (10.0, 20.0))
+
+    def test_readings_past_retention_are_ignored(self):
+        old = self.recent_hour(24 * 40)
+        with override_settings(USAGE_RAW_RETENTION_DAYS=31), mock.patch('builtins.print'):
+            self.assertEqual(ingest_hourly_usage([(self.monitor.pk, old, 50.0, None)]), [])
+        self.assertFalse(HourlyUsage.objects.exists())
+        self.assertFalse(DeviceUsageRollup.objects.exists())
+
+    def test_unknown_devices_are_ignored(self):
+        with mock.patch('builtins.print'):
+            rows = ingest_hourly_usage([('ffffffffffff', self.recent_hour(2), 50.0, None)])
+        self.assertEqual(rows, [])
+        self.assertFalse(HourlyUsage.objects.exists())
+
+    def test_publishes_the_new_profile(self):
+        hour = self.recent_hour(2)
+        ingest_hourly_usage([(self.monitor.pk, hour, 42.0, None)])
+
+        (topic, payload), kwargs = self.publisher.publish.call_args
+        self.assertEqual(topic, f'devices/{self.monitor.pk}/monitor/average')
+        self.assertEqual(json.loads(payload)['hours'][hour.hour], 42.0)
+        self.assertTrue(kwargs['retain'])
+
+    def test_usage_hour(self):
+        received = utc(2026, 3, 2, 0, 10)
+        self.assertEqual(usage_hour({ 'key': '2026-03-01T22:00:00+00:00', 'hour': 22 }, received),
+                         utc(2026, 3, 1, 22))
+        # older devices only send the hour of day, which must be in the past
+        self.assertEqual(usage_hour({ 'hour': 23 }, received), utc(2026, 3, 1, 23))
+        self.assertEqual(usage_hour({ 'hour': 0 }, received), utc(2026, 3, 2, 0))
+
+
+class HourlyReadingTest(TestCase):
+
+    def test_accepts_what_devices_send(self):
+        received = utc(2026, 3, 2, 0, 10)
+        self.assertEqual(hourly_reading('b827eb000001', { 'key': '2026-03-01T22:00:00+00:00',
+                                                          'hour': 22, 'wattage': 5,
+                                                          'outlets': { 'lamp': 5.0 } },
+                                        received),
+                         ('b827eb000001', utc(2026, 3, 1, 22), 5.0, { 'lamp': 5.0 }))
+        self.assertEqual(hourly_reading('b827eb000001', { 'hour': 23, 'wattage': 1.5 }, received),
+                         ('b827eb000001', utc(2026, 3, 1, 23), 1.5, None))
+
+    def test_drops_malformed_messages(self):
+        received = utc(2026, 3, 2, 0, 10)
+        for last_hour in ([], 'hour wattage', { 'hour': 3 }, { 'wattage': 1.0 },
+                          { 'hour': 3, 'wattage': 'x' }, { 'hour': 3, 'wattage': None },
+                          { 'hour': 3, 'wattage': [1.0] }, { 'hour': 3, 'wattage': True },
+                          { 'hour': 3, 'wattage': float('nan') },
+                          { 'hour': 3.0, 'wattage': 1.0 }, { 'hour': 24, 'wattage': 1.0 },
+                          { 'hour': 3, 'wattage': 1.0, 'outlets': [1.0] },
+                          { 'hour': 3, 'wattage': 1.0, 'key': '2026-03-01T03:00:00' },
+                          { 'hour': 3, 'wattage': 1.0, 'key': 'yesterday' },
+                          { 'hour': 3, 'wattage': 1.0, 'key': 3 }):
+            self.assertIsNone(hourly_reading('b827eb000001', last_hour, received), last_hour)
+
+
+class IngestWorkerTest(MonitorTestCase):
+
+    def test_a_bad_reading_only_costs_itself(self):
+        worker = IngestWorker(10, 10, 0)
+        hour = self.recent_hour(2)
+        batch = [(self.monitor.pk, hour, 'x', None),
+                 (self.monitor.pk, hour - timedelta(hours=1), [1.0], None),
+                 (self.monitor.pk, hour.replace(tzinfo=None), 1.0, None),
+                 (self.other.pk, hour, 30.0, None)]
+        with mock.patch('builtins.print'):
+            worker._ingest(batch)
+
+        self.assertEqual((worker.ingested, worker.failed), (1, 3))
+        self.assertEqual(list(HourlyUsage.objects.values_list('monitor_id', 'wattage')),
+                         [(self.other.pk, 30.0)])
+
+    def test_keeps_running_after_a_failed_batch(self):
+        def ingest(batch):
+            if any(wattage is None for _, _, wattage, _ in batch):
+                raise TypeError('bad reading')
+            ingested.extend(batch)
+        ingested = []
+        worker = IngestWorker(10, 10, 0.05)
+        hour = self.recent_hour(2)
+        with mock.patch('monitor.ingest.ingest_hourly_usage', ingest), \
+                mock.patch('monitor.ingest.close_old_connections'), \
+                mock.patch('builtins.print'):
+            worker.start()
+            worker.put((self.monitor.pk, hour, None, None))
+            worker.put((self.other.pk, hour, 30.0, None))
+            worker.stop(timeout=5)
+            self.assertFalse(worker._thread.is_alive())
+
+        self.assertEqual(ingested, [(self.other.pk, hour, 30.0, None)])
+        self.assertEqual((worker.ingested, worker.failed), (1, 1))
+
+
+class UpdateAveragesTest(MonitorTestCase):
+
+    def test_first_sample_initializes_the_slot(self):
+        Monitor.objects.update_averages([(self.monitor.pk, 5, 100.0)])
+        self.assertEqual(self.averages(self.monitor)[5], 100.0)
+
+    def test_later_samples_are_weighted(self):
+        Monitor.objects.update_averages([(self.monitor.pk, 5, 100.0)])
+        updated = Monitor.objects.update_averages([(self.monitor.pk, 5, 200.0)])
+
+        expected = 100.0 * (1 - ERWA_WEIGHT) + 200.0 * ERWA_WEIGHT
+        self.assertAlmostEqual(self.averages(self.monitor)[5], expected)
+        self.assertAlmostEqual(updated[self.monitor.pk]['hours'][5], expected)
+
+    def test_applies_readings_in_order(self):
+        Monitor.objects.update_averages([(self.monitor.pk, 5, 100.0),
+                                         (self.monitor.pk, 5, 200.0),
+                                         (self.other.pk, 5, 10.0)])
+        self.assertAlmostEqual(self.averages(self.monitor)[5],
+                               100.0 * (1 - ERWA_WEIGHT) + 200.0 * ERWA_WEIGHT)
+        self.assertEqual(self.averages(self.other)[5], 10.0)
+
+    def test_ignores_invalid_hours_and_empty_averages(self):
+        Monitor.objects.filter(pk=self.monitor.pk).update(averages=None)
+        self.assertEqual(Monitor.objects.update_averages([(self.monitor.pk, 24, 1.0)]), {})
+        Monitor.objects.update_averages([(self.monitor.pk, 0, 1.0)])
+        self.assertEqual(self.averages(self.monitor)[0], 1.0)
+
+
+class RollupsTest(MonitorTestCase):
+
+    def store(self, readings):
+        rows = HourlyUsage.objects.bulk_create(
+            [HourlyUsage(monitor=monitor, hour=hour, wattage=wattage)
+             for monitor, hour, wattage in readings])
+        update_rollups(rows, { self.monitor.pk: self.user.pk, self.other.pk: self.user.pk })
+        return rows
+
+    def rollup(self, model, resolution, period_start, **owner):
+        return model.objects.values('total', 'minimum', 'maximum', 'count').get(
+            resolution=resolution, period_start=period_start, **owner)
+
+    def test_rolls_up_hours_days_and_months(self):
+        self.store([(self.monitor, utc(2026, 3, 1, 10), 10.0),
+                    (self.monitor, utc(2026, 3, 1, 11), 30.0),
+                    (self.monitor, utc(2026, 3, 2, 10), 20.0),
+                    (self.other, utc(2026, 3, 1, 10), 5.0)])
+
+        self.assertEqual(self.rollup(DeviceUsageRollup, UsageRollup.HOUR, utc(2026, 3, 1, 10),
+                                     monitor=self.monitor),
+                         { 'total': 10.0, 'minimum': 10.0, 'maximum': 10.0, 'count': 1 })
+        self.assertEqual(self.rollup(DeviceUsageRollup, UsageRollup.DAY, utc(2026, 3, 1),
+                                     monitor=self.monitor),
+                         { 'total': 40.0, 'minimum': 10.0, 'maximum': 30.0, 'count': 2 })
+        self.assertEqual(self.rollup(DeviceUsageRollup, UsageRollup.MONTH, utc(2026, 3, 1),
+                                     monitor=self.monitor),
+                         { 'total': 60.0, 'minimum': 10.0, 'maximum': 30.0, 'count': 3 })
+        # the user's rollups sum their monitors
+        self.assertEqual(self.rollup(UserUsageRollup, UsageRollup.HOUR, utc(2026, 3, 1, 10),
+                                     user=self.user),
+                         { 'total': 15.0, 'minimum': 5.0, 'maximum': 10.0, 'count': 2 })
+
+    def test_incremental_updates_merge(self):
+        self.store([(self.monitor, utc(2026, 3, 1, 10), 10.0)])
+        self.store([(self.monitor, utc(2026, 3, 1, 11), 4.0)])
+        self.assertEqual(self.rollup(DeviceUsageRollup, UsageRollup.DAY, utc(2026, 3, 1),
+                                     monitor=self.monitor),
+                         { 'total': 14.0, 'minimum': 4.0, 'maximum': 10.0, 'count': 2 })
+
+    def test_rebuild_matches_incremental(self):
+        self.store([(self.monitor, utc(2026, 3, 1, hour), float(hour)) for hour in range(24)] +
+                   [(self.other, utc(2026, 4, 1, 0), 7.0)])
+        fields = ('resolution', 'period_start', 'total', 'minimum', 'maximum', 'count')
+        before = (set(DeviceUsageRollup.objects.values_list('monitor', *fields)),
+                  set(UserUsageRollup.objects.values_list('user', *fields)))
+
+        rebuild_rollups(batch_size=5)
+        self.assertEqual((set(DeviceUsageRollup.objects.values_list('monitor', *fields)),
+                          set(UserUsageRollup.objects.values_list('user', *fields))),
+                         before)
+
+    def test_history_picks_the_resolution(self):
+        self.store([(self.monitor, utc(2026, 3, day, 12), 10.0) for day in range(1, 11)])
+        rollups = DeviceUsageRollup.objects.filter(monitor=self.monitor)
+
+        resolution, rows = usage_history(rollups, utc(2026, 3, 1), utc(2026, 3, 8), 200)
+        self.assertEqual(resolution, UsageRollup.HOUR)
+        self.assertEqual(len(rows), 7)
+
+        resolution, rows = usage_history(rollups, utc(2026, 3, 1), utc(2026, 3, 31), 100)
+        self.assertEqual(resolution, UsageRollup.DAY)
+        self.assertEqual([row['total'] for row in rows], [10.0] * 10)
+
+        resolution, rows = usage_history(rollups, utc(2025, 4, 1), utc(2026, 4, 1), 100)
+        self.assertEqual(resolution, UsageRollup.MONTH)
+        self.assertEqual([(row['period_start'], row['total']) for row in rows],
+                         [(utc(2026, 3, 1), 100.0)])
+
+    def test_compaction_keeps_daily_and_monthly_rollups(self):
+        self.store([(self.monitor, utc(2025, 1, 1, 10), 10.0),
+                    (self.monitor, utc(2026, 3, 1, 10), 20.0)])
+
+        raw, hourly = compact_usage(utc(2026, 1, 1), utc(2025, 6, 1), batch_size=1)
+        self.assertEqual(raw, 1)
+        self.assertEqual(hourly, 2)  # the device's and the user's
+        self.assertEqual(list(HourlyUsage.objects.values_list('wattage', flat=True)), [20.0])
+        self.assertTrue(DeviceUsageRollup.objects.filter(
+            resolution=UsageRollup.DAY, period_start=utc(2025, 1, 1)).exists())
+        self.assertFalse(DeviceUsageRollup.objects.filter(
+            resolution=UsageRollup.HOUR, period_start=utc(2025, 1, 1, 10)).exists())
+
+
+class ProfilesViewTest(MonitorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.login(username='alice', password='secret')
+        self.url = reverse('monitor:profiles')
+
+    def test_returns_the_users_profiles(self):
+        Monitor.objects.create(device_id='b827eb000003', user=self.parked)
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([monitor['device_id'] for monitor in response.json()['monitors']],
+                         [self.monitor.pk, self.other.pk])
+        self.assertIn('private', response['Cache-Control'])
+
+    def test_not_modified_when_the_etag_matches(self):
+        etag = self.client.get(self.url)['ETag']
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse([query for query in queries.captured_queries
+                          if 'monitor_monitor' in query['sql']])
+
+    def test_changed_averages_change_the_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Monitor.objects.update_averages([(self.monitor.pk, 5, 100.0)])
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['monitors'][0]['hours'][5], 100.0)
+
+    def test_requires_login(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url).status_code, 302)
+
+    def test_updated_averages_drop_the_cached_profiles_on_commit(self):
+        cache.set(profiles_cache_key(self.user.pk), 'stale')
+        with self.captureOnCommitCallbacks(execute=True):
+            Monitor.objects.update_averages([(self.monitor.pk, 5, 100.0)])
+            # a request before the commit would cache the old averages again
+            self.assertEqual(cache.get(profiles_cache_key(self.user.pk)), 'stale')
+        self.assertIsNone(cache.get(profiles_cache_key(self.user.pk)))
+
+    def test_cache_outage_doesnt_fail_saves(self):
+        with mock.patch('monitor.models.cache.delete_many',
+                        side_effect=ConnectionRefusedError), \
+                mock.patch('builtins.print'), \
+                self.captureOnCommitCallbacks(execute=True):
+            monitor = Monitor.objects.create(device_id='b827eb000003', user=self.parked)
+        self.assertTrue(Monitor.objects.filter(pk=monitor.pk).exists())
+
+
+class LiveStateTest(MonitorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('monitor.live_state.get_publisher')
+        self.live_publisher = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.live_state = LiveState(180, 60, 600, excluded_user_ids=[self.parked.pk])
+
+    def published(self):
+        return { topic: json.loads(payload)
+                 for (topic, payload), _ in self.live_publisher.publish.call_args_list }
+
+    def test_deltas_merge_into_the_last_keyframe(self):
+        self.live_state.update(self.monitor.pk, { 'wattage': 10,
+                                                  'outlets': { 'lamp': 10, 'fan': 0 } },
+                               received_at=1000)
+        self.live_state.update(self.monitor.pk, { 'keyframe': False, 'wattage': 15,
+                                                  'outlets': { 'fan': 5 } }, received_at=1001)
+        self.live_state.flush(now=1002)
+
+        snapshot = cache.get(device_snapshot_key(self.monitor.pk))
+        self.assertEqual(snapshot['wattage'], 15)
+        self.assertEqual(snapshot['outlets'], { 'lamp': 10, 'fan': 5 })
+
+    def test_publishes_one_aggregate_per_user(self):
+        self.live_state.update(self.monitor.pk, { 'wattage': 10 }, received_at=1000)
+        self.live_state.update(self.other.pk, { 'wattage': 5 }, received_at=1000)
+        self.assertEqual(self.live_state.flush(now=1001), 1)
+
+        aggregate = self.published()[user_usage_topic(self.user.pk)]
+        self.assertEqual(aggregate['wattage'], 15)
+        self.assertEqual(aggregate, cache.get(user_snapshot_key(self.user.pk)))
+        # nothing changed since
+        self.assertEqual(self.live_state.flush(now=1002), 0)
+
+    def test_stale_devices_leave_the_total(self):
+        self.live_state.update(self.monitor.pk, { 'wattage': 10 }, received_at=1000)
+        self.live_state.update(self.other.pk, { 'wattage': 5 }, received_at=1200)
+        self.live_state.flush(now=1201)
+
+        aggregate = self.published()[user_usage_topic(self.user.pk)]
+        self.assertEqual(aggregate['wattage'], 5)
+        self.assertTrue(aggregate['devices'][self.monitor.pk]['stale'])
+
+    def test_parked_devices_arent_aggregated(self):
+        parked = Monitor.objects.create(device_id='b827eb000003', user=self.parked)
+        self.live_state.update(parked.pk, { 'wattage': 10 }, received_at=1000)
+        self.assertEqual(self.live_state.flush(now=1001), 0)
+        self.live_publisher.publish.assert_not_called()
+
+    def test_daemon_survives_a_cache_outage(self):
+        command = import_module('monitor.management.commands.mqtt-daemon').Command()
+        command.live_state = self.live_state
+        self.live_state.update(self.monitor.pk, { 'wattage': 10 }, received_at=1000)
+        with mock.patch('monitor.live_state.cache.set_many',
+                        side_effect=ConnectionRefusedError), \
+                mock.patch('builtins.print') as log:
+            command._flush_live_state()
+        log.assert_called_once()
+
+
+class HistoryViewTest(MonitorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.login(username='alice', password='secret')
+        self.url = reverse('monitor:history')
+        rows = HourlyUsage.objects.bulk_create(
+            [HourlyUsage(monitor=self.monitor, hour=utc(2026, 3, day, hour), wattage=1.0)
+             for day in (1, 2) for hour in range(24)])
+        update_rollups(rows, { self.monitor.pk: self.user.pk })
+
+    def test_bounds_with_an_offset_use_utc_buckets(self):
+        # 05:30 on March 2nd in India is midnight UTC
+        response = self.client.get(self.url, { 'start': '2026-03-02T05:30:00+05:30',
+                                               'end': '2026-03-03T05:30:00+05:30',
+                                               'points': 10,
+                                               'device': self.monitor.pk })
+        data = response.json()
+        self.assertEqual(data['resolution'], UsageRollup.DAY)
+        self.assertEqual(data['start'], '2026-03-02T00:00:00+00:00')
+        self.assertEqual([(point['start'], point['total']) for point in data['points']],
+                         [('2026-03-02T00:00:00+00:00', 24.0)])
+
+    def test_sums_the_users_monitors(self):
+        response = self.client.get(self.url, { 'start': '2026-03-01T00:00:00Z',
+                                               'end': '2026-03-03T00:00:00Z',
+                                               'points': 10 })
+        self.assertEqual([point['total'] for point in response.json()['points']], [24.0, 24.0])
+
+    def test_rejects_bad_bounds(self):
+        self.assertEqual(self.client.get(self.url, { 'start': 'yesterday' }).status_code, 400)
+        self.assertEqual(self.client.get(self.url, { 'start': '2026-03-02T00:00:00Z',
+                                                     'end': '2026-03-01T00:00:00Z' }).status_code,
+                         400)
+
+
+class FleetAveragesTest(MonitorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.orm_calls = 0
+        self.queries = 0
+        self.published = []
+        patcher = mock.patch('monitor.fleet.publish_averages',
+                             lambda device_id, averages: self.published.append(device_id))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def orm(self, function, *args):
+        self.orm_calls += 1
+        with CaptureQueriesContext(connection) as queries:
+            result = function(*args)
+        self.queries += len(queries.captured_queries)
+        return result
+
+    async def publish_fleet(self, chunk_size, jitter_window=0):
+        # back on the test's thread, where its transaction is
+        return await publish_fleet_averages(sync_to_async(self.orm), jitter_window, chunk_size)
+
+    async def test_pages_through_the_associated_monitors(self):
+        await sync_to_async(self.create_monitors)()
+        self.assertEqual(await self.publish_fleet(chunk_size=3), 7)
+
+        self.assertEqual(self.published, [f'b827eb00000{index}' for index in range(1, 8)])
+        # one count, then one query per page
+        self.assertEqual((self.orm_calls, self.queries), (4, 4))
+
+    def create_monitors(self):
+        Monitor.objects.create(device_id='b827eb000000', user=self.parked)
+        for index in range(3, 8):
+            Monitor.objects.create(device_id=f'b827eb00000{index}', user=self.user)
+
+    async def test_an_exact_last_page(self):
+        self.assertEqual(await self.publish_fleet(chunk_size=2), 2)
+        self.assertEqual(len(self.published), 2)
+
+    async def test_nothing_to_publish(self):
+        await sync_to_async(Monitor.objects.all().delete)()
+        self.assertEqual(await self.publish_fleet(chunk_size=10), 0)
+        self.assertEqual(self.published, [])
+
+    async def test_spreads_publishes_over_the_window(self):
+        with mock.patch('monitor.fleet.asyncio.sleep') as sleep:
+            self.assertEqual(await self.publish_fleet(chunk_size=10, jitter_window=10), 2)
+        # the second of two publishes waits half the window
+        (delay,), _ = sleep.await_args
+        self.assertEqual(sleep.await_count, 1)
+        self.assertAlmostEqual(delay, 5, delta=0.5)
+
+
+class MQTTPublisherTest(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('monitor.mqtt_publisher.mqtt.Client')
+        self.client = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.publisher = MQTTPublisher('localhost', 1883, max_inflight=20, max_queued=100)
+        self.mids = iter(range(1, 100))
+        self.client.publish.side_effect = self.publish
+
+    def publish(self, topic, payload, qos, retain):
+        return mock.Mock(rc=mqtt.MQTT_ERR_SUCCESS, mid=next(self.mids))
+
+    def test_connects_in_the_background(self):
+        self.client.max_inflight_messages_set.assert_called_once_with(20)
+        self.client.max_queued_messages_set.assert_called_once_with(100)
+        self.client.connect_async.assert_called_once_with('localhost', port=1883)
+        self.client.loop_start.assert_called_once_with()
+
+    def test_tracks_acknowledgements(self):
+        first = self.publisher.publish('a', 'x')
+        self.publisher.publish('b', 'x', qos=0)
+        self.publisher.publish('c', 'x', qos=2)
+        self.assertEqual(self.publisher.pending(), 2)
+
+        self.publisher._on_publish(self.client, None, first.mid)
+        self.assertEqual(self.publisher.pending(), 1)
+        self.assertFalse(self.publisher.flush(timeout=0))
+        self.publisher._on_publish(self.client, None, first.mid + 2)
+        self.assertTrue(self.publisher.flush(timeout=0))
+
+    def test_acknowledged_before_publish_returns(self):
+        def publish_and_ack(topic, payload, qos, retain):
+            info = self.publish(topic, payload, qos, retain)
+            self.publisher._on_publish(self.client, None, info.mid)
+            return info
+        self.client.publish.side_effect = publish_and_ack
+
+        self.publisher.publish('a', 'x')
+        self.assertEqual(self.publisher.pending(), 0)
+        self.assertEqual(self.publisher._acked_early, set())
+
+    def test_counts_messages_dropped_by_a_full_queue(self):
+        self.client.publish.side_effect = None
+        self.client.publish.return_value = mock.Mock(rc=mqtt.MQTT_ERR_QUEUE_SIZE, mid=0)
+        with mock.patch('builtins.print'):
+            self.publisher.publish('a', 'x')
+        self.assertEqual((self.publisher.dropped, self.publisher.pending()), (1, 0))
+
+    def test_close_disconnects(self):
+        self.publisher.close(timeout=0)
+        self.client.disconnect.assert_called_once_with()
+        self.client.loop_stop.assert_called_once_with()
+
+
+class LeaderLockTest(TestCase):
+
+    class Error(Exception):
+        pass
+
+    def setUp(self):
+        patcher = mock.patch('monitor.leader.connection')
+        self.connection = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.connection.vendor = 'postgresql'
+        self.connection.Database.Error = self.Error
+        self.raw = self.connection.get_new_connection.return_value
+        self.cursor = self.raw.cursor.return_value.__enter__.return_value
+
+    def test_only_one_worker_runs_against_sqlite(self):
+        self.connection.vendor = 'sqlite'
+        self.assertTrue(LeaderLock('daemon').try_acquire())
+        self.connection.get_new_connection.assert_not_called()
+
+    def test_takes_the_lock_on_a_connection_of_its_own(self):
+        self.cursor.fetchone.return_value = (False,)
+        lock = LeaderLock('daemon')
+        self.assertFalse(lock.try_acquire())
+        self.cursor.fetchone.return_value = (True,)
+        self.assertTrue(lock.try_acquire())
+
+        self.cursor.execute.assert_called_with('SELECT pg_try_advisory_lock(%s)',
+                                               [lock_key('daemon')])
+        self.connection.get_new_connection.assert_called_once()
+        self.assertTrue(self.raw.autocommit)
+
+    def test_the_leader_only_checks_its_session(self):
+        self.cursor.fetchone.return_value = (True,)
+        lock = LeaderLock('daemon')
+        lock.try_acquire()
+        self.assertTrue(lock.try_acquire())
+        self.cursor.execute.assert_called_with('SELECT 1')
+
+    def test_a_lost_session_loses_the_lock(self):
+        self.cursor.fetchone.return_value = (True,)
+        lock = LeaderLock('daemon')
+        lock.try_acquire()
+        self.cursor.execute.side_effect = self.Error('server closed the connection')
+        with mock.patch('builtins.print'):
+            self.assertFalse(lock.try_acquire())
+        self.raw.close.assert_called_once_with()
+
+        # the next try reconnects
+        self.cursor.execute.side_effect = None
+        self.assertTrue(lock.try_acquire())
+        self.assertEqual(self.connection.get_new_connection.call_count, 2)
+
+    def test_release_ends_the_session(self):
+        self.cursor.fetchone.return_value = (True,)
+        lock = LeaderLock('daemon')
+        lock.try_acquire()
+        lock.release()
+        self.assertFalse(lock.held)
+        self.raw.close.assert_called_once_with()
+
+
+class DevicePartitionTest(TestCase):
+
+    def setUp(self):
+        self.daemon = import_module('monitor.management.commands.mqtt-daemon')
+
+    def test_is_stable(self):
+        # the same on every worker and after restarts, unlike hash()
+        self.assertEqual(self.daemon.device_partition('b827eb000001', 4),
+                         zlib.crc32(b'b827eb000001') % 4)
+
+    def test_every_device_has_one_owner(self):
+        device_ids = [f'b827eb{index:06x}' for index in range(100)]
+        workers = []
+        for index in range(3):
+            command = self.daemon.Command()
+            command.worker_index, command.worker_count = index, 3
+            workers.append(command)
+
+        owners = [[worker for worker in workers if worker._owns(device_id)]
+                  for device_id in device_ids]
+        self.assertTrue(all(len(owner) == 1 for owner in owners))
+        # and the devices are spread over all of them
+        self.assertEqual({ owner[0].worker_index for owner in owners }, { 0, 1, 2 })
+
+
+class AsyncMQTTClientTest(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch('monitor.async_mqtt.mqtt.Client')
+        self.paho = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.paho.is_connected.return_value = False
+        self.paho.loop_misc.return_value = mqtt.MQTT_ERR_SUCCESS
+        self.client = AsyncMQTTClient('localhost', 1883)
+        self.handled = []
+
+    def deliver(self, topic_filter, *topics):
+        for topic in topics:
+            self.client._on_message(self.client._handlers[topic_filter],
+                                    mock.Mock(topic=topic, payload=b''))
+
+    @contextlib.asynccontextmanager
+    async def serving(self):
+        # each async test runs on an event loop of its own
+        task = asyncio.create_task(self.client.run())
+        await asyncio.sleep(0.01)
+        try:
+            yield
+        finally:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+    async def drain(self):
+        while any(handler.pending for handler in self.client._handlers.values()):
+            await asyncio.sleep(0.01)
+
+    def test_shared_subscriptions(self):
+        self.client.add_handler('devices/+/monitor/hourly_usage', self.handle,
+                                share_group='mqtt-daemon')
+        self.assertEqual(self.client._subscriptions,
+                         { '$share/mqtt-daemon/devices/+/monitor/hourly_usage': 1 })
+
+    def test_resubscribes_on_connect(self):
+        self.client.add_handler('a/#', self.handle)
+        self.client.subscribe('b/#', qos=2)
+        self.client._on_connect(self.paho, None, {}, mqtt.CONNACK_ACCEPTED)
+        self.assertEqual(self.paho.subscribe.call_args_list,
+                         [mock.call('a/#', 1), mock.call('b/#', 2)])
+
+    async def handle(self, message):
+        self.handled.append(message.topic)
+
+    async def test_keeps_each_keys_messages_in_order(self):
+        async def handle(message):
+            # later messages would overtake the earlier ones if they could
+            await asyncio.sleep(0.02 if message.topic.endswith('/1') else 0)
+            self.handled.append(message.topic)
+
+        self.client.add_handler('devices/#', handle, concurrency=4,
+                                key=lambda message: message.topic.split('/')[1])
+        async with self.serving():
+            self.paho.connect.assert_called_once_with('localhost', 1883, 60)
+
+            self.deliver('devices/#', 'devices/a/1', 'devices/b/1', 'devices/a/2',
+                         'devices/b/2', 'devices/a/3')
+            await self.drain()
+            self.assertEqual([topic for topic in self.handled if '/a/' in topic],
+                             ['devices/a/1', 'devices/a/2', 'devices/a/3'])
+            self.assertEqual([topic for topic in self.handled if '/b/' in topic],
+                             ['devices/b/1', 'devices/b/2'])
+
+    async def test_counts_timeouts_and_errors(self):
+        async def handle(message):
+            if message.topic == 'slow':
+                await asyncio.sleep(1)
+            elif message.topic == 'broken':
+                raise ValueError(message.topic)
+            self.handled.append(message.topic)
+
+        self.client.add_handler('#', handle, timeout=0.05)
+        async with self.serving():
+            with mock.patch('builtins.print'):
+                self.deliver('#', 'slow', 'broken', 'fine')
+                await self.drain()
+
+            self.assertEqual(self.handled, ['fine'])
+            self.assertEqual(self.client.stats(), { '#': { 'pending': 0, 'handled': 1,
+                                                           'timeouts': 1, 'errors': 1 } })
+
+    async def test_stops_reading_until_the_handler_catches_up(self):
+        release = asyncio.Event()
+
+        async def handle(message):
+            await release.wait()
+
+        self.client.add_handler('#', handle, max_pending=2)
+        async with self.serving():
+            sock, other = socket.socketpair()
+            self.addCleanup(sock.close)
+            self.addCleanup(other.close)
+            self.client._open_socket(sock)
+
+            self.deliver('#', 'one')
+            self.assertFalse(self.client._paused)
+            self.deliver('#', 'two')
+            self.assertTrue(self.client._paused)
+            # no longer reading
+            other.send(b'x')
+            await asyncio.sleep(0.01)
+            self.paho.loop_read.assert_not_called()
+
+            release.set()
+            await self.drain()
+            self.assertFalse(self.client._paused)
+            await asyncio.sleep(0.01)
+            self.paho.loop_read.assert_called()
+            self.client._close_socket(sock)
+
+    async def test_retries_failed_connections(self):
+        self.paho.connect.side_effect = OSError('connection refused')
+        self.client.reconnect_delay = 0.01
+        with mock.patch('builtins.print'):
+            async with self.serving():
+                self.paho.connect.side_effect = None
+                await asyncio.sleep(0.05)
+        self.assertGreater(self.paho.connect.call_count, 1)
+        self.paho.reconnect.assert_not_called()
@@ -8,6 +8,8 @@ urlpatterns = [
     path('', views.IndexView.as_view(), name='index'),
     path('add/', views.AddMonitorView.as_view(), name='add'),
     path('graph/', views.GraphView.as_view(), name='graph'),
+    path('api/profiles/', views.ProfilesView.as_view(), name='profiles'),
+    path('api/history/', views.HistoryView.as_view(), name='history'),
     re_path(r'^device/(?P<device_id>[0-9a-fA-F]+)$',
             views.DetailView.as_view(), name='detail'),
 ]
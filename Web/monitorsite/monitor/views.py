@@ -1,7 +1,20 @@
+import hashlib
+import json
+import datetime
+from datetime import timedelta
 from django.views import generic
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.shortcuts import get_object_or_404
-from .models import Monitor
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.decorators import method_decorator
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from .models import Monitor, DeviceUsageRollup, UserUsageRollup, profiles_cache_key
+from .rollups import usage_history
+from .live_state import device_snapshot_key, user_snapshot_key
 from django.conf import settings
 from monitor.forms import AddMonitorForm
 
@@ -24,6 +37,8 @@ class DetailView(LoginRequiredMixin, generic.TemplateView):
         context = super(DetailView, self).get_context_data(**kwargs)
         context['device'] = get_object_or_404(
             Monitor, pk=kwargs['device_id'], user=self.request.user)
+        # the latest usage as seen by the mqtt-daemon, for the first paint
+        context['live_state'] = cache.get(device_snapshot_key(context['device'].pk))
         return context
 
 
@@ -31,14 +46,105 @@ class GraphView(LoginRequiredMixin, generic.ListView):
     template_name = 'monitor/graph.html'
 
     def get_queryset(self):
-        results = Monitor.objects.filter(user=self.request.user)
+        # the profiles themselves are fetched from ProfilesView by graph.js
+        results = Monitor.objects.filter(user=self.request.user).only('device_id')
         return results
 
     def get_context_data(self, **kwargs):
         context = super(GraphView, self).get_context_data(**kwargs)
+        context['live_state'] = cache.get(user_snapshot_key(self.request.user.pk))
         return context
 
 
+def get_usage_profiles(request):
+    # the user's monitors and their hourly averages as one JSON payload, cached
+    # until the models invalidate it (see models.invalidate_profiles)
+    if hasattr(request, '_usage_profiles'):
+        return request._usage_profiles
+
+    key = profiles_cache_key(request.user.pk)
+    profiles = cache.get(key)
+    if profiles is None:
+        monitors = Monitor.objects.filter(user=request.user).order_by('device_id') \
+                                  .values_list('device_id', 'name', 'averages')
+        body = json.dumps({ 'monitors': [
+            { 'device_id': device_id,
+              'name': name,
+              'hours': (averages or {}).get('hours', []) }
+            for device_id, name, averages in monitors ] })
+        profiles = { 'body': body,
+                     'etag': hashlib.md5(body.encode('utf-8')).hexdigest(),
+                     'last_modified': timezone.now().replace(microsecond=0) }
+        cache.set(key, profiles, settings.MONITOR_PROFILES_CACHE_SECONDS)
+    request._usage_profiles = profiles
+    return profiles
+
+
+@method_decorator(cache_control(private=True, no_cache=True), name='dispatch')
+@method_decorator(condition(
+    etag_func=lambda request, *args, **kwargs: get_usage_profiles(request)['etag'],
+    last_modified_func=lambda request, *args, **kwargs: get_usage_profiles(request)['last_modified']),
+    name='get')
+class ProfilesView(LoginRequiredMixin, generic.View):
+    # browsers revalidate on every load and get a 304 until an average changes
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(get_usage_profiles(request)['body'],
+                            content_type='application/json')
+
+
+HISTORY_DEFAULT_DAYS = 7
+HISTORY_DEFAULT_POINTS = 200
+HISTORY_MAX_POINTS = 2000
+
+
+class HistoryView(LoginRequiredMixin, generic.View):
+    # ?start=&end= (ISO 8601, default the last week), points= (the most the
+    # client wants to draw) and optionally device=; without a device the
+    # user's monitors are summed. Served from the coarsest rollups needed.
+
+    def get(self, request, *args, **kwargs):
+        try:
+            end = self._parse_time(request.GET.get('end')) or timezone.now()
+            start = self._parse_time(request.GET.get('start')) or \
+                end - timedelta(days=HISTORY_DEFAULT_DAYS)
+            points = min(int(request.GET.get('points', HISTORY_DEFAULT_POINTS)),
+                         HISTORY_MAX_POINTS)
+        except ValueError:
+            return HttpResponseBadRequest("start and end must be ISO 8601 times, points a number")
+        if start >= end or points < 1:
+            return HttpResponseBadRequest("empty time range")
+
+        device_id = request.GET.get('device')
+        if device_id:
+            device = get_object_or_404(Monitor, pk=device_id, user=request.user)
+            rollups = DeviceUsageRollup.objects.filter(monitor=device)
+        else:
+            rollups = UserUsageRollup.objects.filter(user=request.user)
+
+        resolution, rows = usage_history(rollups, start, end, points)
+        return JsonResponse({ 'resolution': resolution,
+                              'start': start.isoformat(),
+                              'end': end.isoformat(),
+                              'points': [ { 'start': row['period_start'].isoformat(),
+                                            'total': row['total'],
+                                            'min': row['minimum'],
+                                            'max': row['maximum'],
+                                            'count': row['count'] }
+                                          for row in rows ] })
+
+    def _parse_time(self, value):
+        if not value:
+            return None
+        parsed = parse_datetime(value)
+        if parsed is None:
+            raise ValueError(value)
+        if timezone.is_naive(parsed):
+            return parsed.replace(tzinfo=datetime.timezone.utc)
+        # the rollups are bucketed by UTC hour, day and month
+        return parsed.astimezone(datetime.timezone.utc)
+
+
 class AddMonitorView(LoginRequiredMixin, generic.FormView):
     template_name = 'monitor/addmonitor.html'
     form_class = AddMonitorForm
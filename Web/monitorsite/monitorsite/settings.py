@@ -99,6 +99,15 @@ CACHES = {
 #   limit possible inconsistencies
 CACHE_MIDDLEWARE_SECONDS = 5
 
+# usage profiles are invalidated whenever an average changes, so this only
+#   bounds how long an unused entry stays around
+MONITOR_PROFILES_CACHE_SECONDS = 60 * 60
+
+# retention (see the compact-usage command): raw hourly readings and hourly
+#   rollups are deleted after these many days, daily and monthly rollups are kept
+USAGE_RAW_RETENTION_DAYS = 31
+USAGE_HOURLY_ROLLUP_RETENTION_DAYS = 366
+
 SESSION_ENGINE = "django.contrib.sessions.backends.cached_db"
 
 
@@ -147,3 +156,14 @@ LOGIN_URL = 'login'
 
 DEFAULT_USER = 'parked_device_user'
 
+
+# Everything Django publishes goes over one long-lived connection per process
+MQTT_BROKER_HOST = 'localhost'
+MQTT_BROKER_PORT = 50001
+MQTT_PUBLISHER_MAX_INFLIGHT = 100
+MQTT_PUBLISHER_MAX_QUEUED = 10000
+
+# mqtt-daemon workers share the hourly usage subscription ($share/...), so the
+# broker delivers each reading to one worker; turn this off for brokers
+# without shared subscriptions and every worker filters out its own devices
+MQTT_SHARED_SUBSCRIPTIONS = True